@@ -4,14 +4,13 @@ import os
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from dotenv import load_dotenv
 
-import crud
-from database import SessionLocal, get_db
+import crud_async, passwords, schemas, user_cache
+from database import DBSession, SessionLocal, get_db
 
 load_dotenv()
 
@@ -20,16 +19,19 @@ SECRET_KEY = os.environ.get('SECRET_KEY')
 ALGORITHM = os.environ.get('ALGORITHM')
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES',30))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = passwords.pwd_context
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def authenticate_user(db: Session, username: str, password: str):
-    user = crud.get_user_by_username(db, username)
-    if not user or not verify_password(password, user.hashed_password):
+async def authenticate_user(db: DBSession, username: str, password: str):
+    user = await crud_async.get_user_by_username(db, username)
+    if not user:
+        return False
+    valid, new_hash = await passwords.verify_password(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        # The password was hashed with older cost parameters, store it with the current ones
+        await crud_async.update_user_password(db, user_id=user.id, hashed_password=new_hash)
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -42,7 +44,21 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+def token_payload(authorization: Optional[str]) -> Optional[dict]:
+    """The claims of a valid bearer token in an Authorization header, without a database lookup"""
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+
+def token_username(authorization: Optional[str]) -> Optional[str]:
+    payload = token_payload(authorization)
+    return payload.get("sub") if payload is not None else None
+
+async def get_current_user(db: DBSession = Depends(get_db), token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -55,8 +71,18 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_username(db, username=username)
-    if user is None:
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    # Tokens carry the user id, older ones only the username
+    user_id = payload.get("uid")
+    if user_id is not None:
+        db_user = await crud_async.get_user_by_id(db, user_id=user_id)
+    else:
+        db_user = await crud_async.get_user_by_username(db, username=username)
+    if db_user is None or db_user.username != username:
          raise credentials_exception
+    user = schemas.CurrentUser.model_validate(db_user, from_attributes=True)
+    user_cache.put(username, user, token_expires_at=payload.get("exp"))
     return user
 
@@ -0,0 +1,511 @@
+# benchmark.py
+"""
+Throughput and latency benchmark of every route in main.py.
+
+    python benchmark.py --seed --users 10000 --movies 10000 --ratings 100000 --comments 100000
+    python benchmark.py --requests 500 --concurrency 20 --output bench_results.json
+    python benchmark.py --server --workers 4 --baseline bench_baseline.json
+    python benchmark.py --serialization --items 1000 --requests 50
+    python benchmark.py --startup --starts 10
+
+--seed (re)creates the dataset in BENCH_DB_URL. The routes are driven through an
+in-process ASGI client, or with --server through a multi-worker run of serve.py.
+The results are written as JSON, and compared with --baseline: the run fails
+when a route's p99 latency or throughput is worse than the baseline by more
+than --tolerance.
+--serialization compares, on lists of --items movies, ratings and comments, the
+ORM objects validated and dumped by pydantic with the projected rows dumped by
+fast_json, timing the query and the serialization of each response.
+--startup times --starts cold starts of the app in new processes: the import of
+main, the startup run by its lifespan (STARTUP_PREWARM applies) and the first
+request.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+BENCH_DB_URL = os.environ.get("BENCH_DB_URL", "sqlite:///./bench_moviestore_db")
+BENCH_PASSWORD = "benchpassword"
+
+WORDS = [
+    "night", "city", "river", "last", "dark", "summer", "star", "iron", "silent", "broken",
+    "golden", "ghost", "storm", "red", "hidden", "lost", "wild", "empire", "dream", "shadow",
+]
+GENRES = ["Action", "Comedy", "Drama", "Horror", "Romance", "Thriller", "Documentary", "Animation"]
+LANGUAGES = ["English", "French", "Spanish", "Yoruba", "Hindi", "Japanese"]
+
+
+def seed(users: int, movies: int, ratings: int, comments: int, chunk: int = 10000):
+    """Recreates the schema and fills it with a deterministic synthetic catalog"""
+    from sqlalchemy import insert
+
+    import catalog, crud, leaderboard, models, passwords, search
+    from database import Base, SessionLocal, get_engine
+
+    engine = get_engine()
+    if ratings > users * movies:
+        raise ValueError("Every user can rate a movie only once, --ratings is larger than users x movies")
+    rng = random.Random(42)
+    # The same password for everybody, hashing it once per user would dominate the seeding
+    hashed_password = passwords.pwd_context.hash(BENCH_PASSWORD)
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    backend = search.init_search(engine)
+
+    def insert_chunks(model, count, make_row):
+        with SessionLocal() as db:
+            for start in range(0, count, chunk):
+                db.execute(insert(model), [make_row(index) for index in range(start, min(start + chunk, count))])
+                db.commit()
+        print(f"seeded {count} rows into {model.__tablename__}")
+
+    insert_chunks(models.User, users, lambda index: {
+        "username": f"user{index}",
+        "full_name": f"Bench User {index}",
+        "email": f"user{index}@bench.example.com",
+        "hashed_password": hashed_password,
+    })
+    insert_chunks(models.Movie, movies, lambda index: {
+        "title": " ".join(rng.sample(WORDS, 3)).title(),
+        "description": " ".join(rng.choices(WORDS, k=12)),
+        "genres": ", ".join(rng.sample(GENRES, 2)),
+        "writer": f"Writer {rng.randrange(1000)}",
+        "director": f"Director {rng.randrange(1000)}",
+        "cast": f"Actor {rng.randrange(5000)}, Actor {rng.randrange(5000)}",
+        "language": rng.choice(LANGUAGES),
+        "Runtime": f"{rng.randrange(1, 4)}hr.{rng.randrange(60)}mins",
+        "year_released": rng.randrange(1950, 2025),
+        "owner_id": rng.randrange(users) + 1,
+    })
+    # Rating n goes to user n % users, and each user rates consecutive movies
+    # from a start of their own: every pair is unique and the ratings spread
+    # evenly over the movies
+    insert_chunks(models.Rating, ratings, lambda index: {
+        "user_id": index % users + 1,
+        "movie_id": (index // users + index % users) % movies + 1,
+        "rating": rng.randrange(11) / 2,
+    })
+    # Comments are skewed towards the first movies, like the attention of real users
+    insert_chunks(models.Comment, comments, lambda index: {
+        "comment": " ".join(rng.choices(WORDS, k=8)),
+        "movie_id": int(movies ** rng.random()),
+        "user_id": rng.randrange(users) + 1,
+    })
+    leaderboard.init(engine)
+    with SessionLocal() as db:
+        crud.rebuild_rating_stats(db)
+        backend.rebuild(db)
+        catalog.backfill(db)
+        # Adds the top scores of the rated movies, the trending scores start from the benchmark's own writes
+        leaderboard.compact(db)
+    print("rebuilt the rating aggregates, the leaderboards, the search index and the catalog filters")
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    """Statistics of one route, latencies are in seconds"""
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p90": round(percentile(latencies, 0.90) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Returns a line per route that regressed against the baseline"""
+    regressions = []
+    for route, stats in results["routes"].items():
+        reference = baseline.get("routes", {}).get(route)
+        if reference is None:
+            continue
+        p99, reference_p99 = stats["latency_ms"]["p99"], reference["latency_ms"]["p99"]
+        if reference_p99 and p99 > reference_p99 * (1 + tolerance):
+            regressions.append(f"{route}: p99 {p99}ms, baseline {reference_p99}ms")
+        throughput, reference_throughput = stats["throughput_rps"], reference["throughput_rps"]
+        if reference_throughput and throughput < reference_throughput * (1 - tolerance):
+            regressions.append(f"{route}: {throughput} req/s, baseline {reference_throughput} req/s")
+    return regressions
+
+
+class Scenario:
+    """One route: make(i) returns the method, url and httpx keyword arguments of request i"""
+    def __init__(self, name: str, make: Callable[[int], tuple], ok: tuple = (200, 201, 202, 204)):
+        self.name = name
+        self.make = make
+        self.ok = ok
+
+
+def prepare_scenarios(requests: int) -> List[Scenario]:
+    """Creates the rows the write routes work on and returns a scenario per route"""
+    import crud, main, models, recommend, schemas, startup
+    from database import SessionLocal
+
+    startup.init_database()
+
+    run_id = uuid.uuid4().hex[:8]
+    with SessionLocal() as db:
+        movies = db.query(models.Movie.id).order_by(models.Movie.id.desc()).first()
+        movie_count = movies[0] if movies else 0
+        if movie_count < requests:
+            raise SystemExit(f"The dataset has {movie_count} movies, seed at least --requests {requests}")
+        owner = crud.get_user_by_username(db, "user0")
+        rater = crud.create_user(db, schemas.UserCreate(
+            username=f"rater-{run_id}", full_name="Bench Rater", email=f"rater-{run_id}@bench.example.com", password=BENCH_PASSWORD,
+        ), hashed_password=owner.hashed_password)
+        own_movie = schemas.MovieCreate(title="Bench Owned", cast="Bench", year_released=2000)
+        updated_movie = crud.create_movie(db, own_movie, user_id=owner.id).id
+        deletable_movies = [crud.create_movie(db, own_movie, user_id=owner.id).id for _ in range(requests)]
+        deletable_comments = [
+            crud.create_comment(db, schemas.CommentCreate(comment="to delete"), movie_id=updated_movie, user_id=owner.id).id
+            for _ in range(requests)
+        ]
+        owner_name, rater_name = owner.username, rater.username
+    # The server builds its own model at startup, the in-process app is never started
+    recommend.model.refresh(full=True)
+    movie = lambda index: index % movie_count + 1
+    update = {"title": "Bench Owned", "cast": "Bench", "year_released": 2001}
+    return [
+        Scenario("GET /", lambda i: ("GET", "/", {})),
+        Scenario("POST /Registration", lambda i: ("POST", "/Registration", {"json": {
+            "username": f"new-{run_id}-{i}", "full_name": "New", "email": f"new-{run_id}-{i}@bench.example.com", "password": BENCH_PASSWORD,
+        }})),
+        Scenario("POST /login", lambda i: ("POST", "/login", {"data": {"username": owner_name, "password": BENCH_PASSWORD}})),
+        Scenario("POST /movies/", lambda i: ("POST", "/movies/", {"json": dict(update, title=f"Bench {run_id} {i}"), "auth": owner_name})),
+        Scenario("GET /movies/", lambda i: ("GET", "/movies/", {"params": {"limit": 10, "skip": i % 50 * 10}})),
+        Scenario("GET /movies/ filtered and sorted", lambda i: ("GET", "/movies/", {"params": {
+            "genre": GENRES[i % len(GENRES)], "language": LANGUAGES[i % len(LANGUAGES)], "year_from": 1950 + i % 50,
+            "runtime_max": 150, "sort": ("-year", "-rating", "-created")[i % 3], "limit": 20,
+        }})),
+        Scenario("POST /movies/batch-get", lambda i: ("POST", "/movies/batch-get", {"json": {
+            "ids": [movie(i * 100 + offset) for offset in range(100)], "include": ["owner", "rating_stats", "latest_comments"],
+        }})),
+        Scenario("GET /movies/List", lambda i: ("GET", "/movies/List", {"auth": owner_name})),
+        Scenario("GET /movies/Search", lambda i: ("GET", "/movies/Search", {"params": {"search": WORDS[i % len(WORDS)][:4]}})),
+        Scenario("GET /movies/top", lambda i: ("GET", "/movies/top", {"params": {"genre": GENRES[i % len(GENRES)]} if i % 2 else {}})),
+        Scenario("GET /movies/trending", lambda i: ("GET", "/movies/trending", {"params": {"year": 1950 + i % 75} if i % 2 else {}})),
+        Scenario("GET /movies/{movie_id}", lambda i: ("GET", f"/movies/{movie(i)}", {})),
+        Scenario("PUT /movies/{movie_id}", lambda i: ("PUT", f"/movies/{updated_movie}", {"json": update, "auth": owner_name})),
+        Scenario("DELETE /movies/{movie_id}", lambda i: ("DELETE", f"/movies/{deletable_movies[i]}", {"auth": owner_name})),
+        Scenario("POST /movies/{movie_id}/rate/", lambda i: ("POST", f"/movies/{movie(i)}/rate/", {"json": {"rating": i % 6}, "auth": rater_name})),
+        Scenario("GET /movies/{movie_id}/ratings/", lambda i: ("GET", f"/movies/{movie(i)}/ratings/", {})),
+        Scenario("POST /movies/{movie_id}/comments/", lambda i: ("POST", f"/movies/{movie(i)}/comments/", {"json": {"comment": "bench"}, "auth": owner_name})),
+        Scenario("GET /movies/{movie_id}/comments/", lambda i: ("GET", f"/movies/{movie(i)}/comments/", {})),
+        Scenario("GET /movies/{movie_id}/similar", lambda i: ("GET", f"/movies/{movie(i)}/similar", {})),
+        Scenario("GET /users/me/recommendations", lambda i: ("GET", "/users/me/recommendations", {"auth": owner_name})),
+        Scenario("DELETE /comments/{comment_id}", lambda i: ("DELETE", f"/comments/{deletable_comments[i]}", {"auth": owner_name})),
+    ]
+
+
+async def drive(client, scenarios: List[Scenario], requests: int, concurrency: int, only: Optional[str] = None) -> Dict[str, dict]:
+    tokens = {}
+
+    async def headers_for(username: Optional[str]) -> dict:
+        if username is None:
+            return {}
+        if username not in tokens:
+            response = await client.post("/login", data={"username": username, "password": BENCH_PASSWORD})
+            response.raise_for_status()
+            tokens[username] = response.json()["access_token"]
+        return {"Authorization": f"Bearer {tokens[username]}"}
+
+    results = {}
+    for scenario in scenarios:
+        if only and only not in scenario.name:
+            continue
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: List[float] = []
+        errors = 0
+
+        # Logging in is not part of what is measured, except for the login route itself
+        prepared = []
+        for index in range(requests):
+            method, url, kwargs = scenario.make(index)
+            kwargs = dict(kwargs)
+            prepared.append((method, url, await headers_for(kwargs.pop("auth", None)), kwargs))
+
+        async def one(index: int):
+            nonlocal errors
+            method, url, headers, kwargs = prepared[index]
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.request(method, url, headers=headers, **kwargs)
+                latencies.append(time.perf_counter() - started)
+            if response.status_code not in scenario.ok:
+                errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(index) for index in range(requests)))
+        results[scenario.name] = summarize(latencies, errors, time.perf_counter() - started)
+        stats = results[scenario.name]
+        print(f"{scenario.name:40} {stats['throughput_rps']:>9} req/s  p50 {stats['latency_ms']['p50']:>8}ms  "
+              f"p99 {stats['latency_ms']['p99']:>8}ms  errors {stats['errors']}")
+    return results
+
+
+def load_objects(db, name: str, movie_id: Optional[int] = None, limit: int = 100) -> list:
+    """A list of ORM objects the way the list routes loaded it before the row projections of crud.py"""
+    from sqlalchemy.orm import selectinload
+
+    import crud, models
+
+    if name == "movies":
+        query = db.query(models.Movie).options(*crud.MOVIE_RELATIONS).order_by(*crud.MOVIE_ORDER)
+    elif name == "ratings":
+        query = db.query(models.Rating).options(selectinload(models.Rating.created_by)).filter(models.Rating.movie_id == movie_id).order_by(*crud.RATING_ORDER)
+    else:
+        query = db.query(models.Comment).options(selectinload(models.Comment.posted_by)).filter(models.Comment.movie_id == movie_id).order_by(*crud.COMMENT_ORDER)
+    return query.limit(limit).all()
+
+
+def bench_serialization(items: int, rounds: int) -> Dict[str, dict]:
+    """
+    Times the building of list responses of items entries, the way the list
+    routes used to do it and the way they do it now, in the same process
+    """
+    from pydantic import TypeAdapter
+    from sqlalchemy import func, select
+
+    import crud, fast_json, models, schemas
+    from database import SessionLocal
+
+    with SessionLocal() as db:
+        rated = db.execute(select(models.Rating.movie_id).group_by(models.Rating.movie_id).order_by(func.count().desc()).limit(1)).scalar()
+        commented = db.execute(select(models.Comment.movie_id).group_by(models.Comment.movie_id).order_by(func.count().desc()).limit(1)).scalar()
+    if rated is None or commented is None:
+        raise SystemExit("The dataset has no ratings or comments, run with --seed first")
+
+    def pydantic_dump(schema):
+        adapter = TypeAdapter(List[schema])
+        return lambda objects: adapter.dump_json(adapter.validate_python(objects, from_attributes=True))
+
+    cases = {
+        "movies": (
+            lambda db: load_objects(db, "movies", limit=items), pydantic_dump(schemas.Movie),
+            lambda db: crud.get_movie_rows(db, limit=items), fast_json.movies,
+        ),
+        "ratings": (
+            lambda db: load_objects(db, "ratings", rated, limit=items), pydantic_dump(schemas.Rating),
+            lambda db: crud.get_rating_rows(db, rated, limit=items), fast_json.ratings,
+        ),
+        "comments": (
+            lambda db: load_objects(db, "comments", commented, limit=items), pydantic_dump(schemas.Comment),
+            lambda db: crud.get_comment_rows(db, commented, limit=items), fast_json.comments,
+        ),
+    }
+    routes = {}
+    for name, (load_objects, dump_objects, load_rows, dump_rows) in cases.items():
+        for path, load, dump in (("pydantic", load_objects, dump_objects), ("fast_json", load_rows, dump_rows)):
+            latencies, serializing = [], []
+            started = time.perf_counter()
+            for _ in range(rounds):
+                # A new session per response, as a request gets, so no ORM object is reused
+                with SessionLocal() as db:
+                    began = time.perf_counter()
+                    result = load(db)
+                    loaded = time.perf_counter()
+                    dump(result)
+                    done = time.perf_counter()
+                latencies.append(done - began)
+                serializing.append(done - loaded)
+            stats = summarize(latencies, 0, time.perf_counter() - started)
+            stats["items"] = len(result)
+            stats["serialize_ms"] = round(statistics.fmean(serializing) * 1000, 3)
+            routes[f"serialize {name} ({path})"] = stats
+        slow, fast = routes[f"serialize {name} (pydantic)"], routes[f"serialize {name} (fast_json)"]
+        print(
+            f"{name} x{fast['items']}: {slow['throughput_rps']} -> {fast['throughput_rps']} responses/s, "
+            f"serialization {slow['serialize_ms']}ms -> {fast['serialize_ms']}ms"
+        )
+    return routes
+
+
+# Run in a new process per cold start, prints the seconds of each phase as JSON
+STARTUP_PROBE = """
+import asyncio, json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def run():
+    import httpx
+    async with main.app.router.lifespan_context(main.app):
+        ready = time.perf_counter()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark") as client:
+            response = await client.get("/movies/")
+        return ready, time.perf_counter(), response.status_code
+
+ready, answered, status = asyncio.run(run())
+print(json.dumps({"import": imported - started, "startup": ready - imported, "first_request": answered - ready, "status": status}))
+"""
+
+
+def bench_startup(starts: int) -> Dict[str, dict]:
+    """
+    Cold starts of the app, each in a new process: the import of main, the
+    startup run by its lifespan and its first request
+    """
+    phases = {"process": [], "import": [], "startup": [], "first_request": []}
+    errors = 0
+    for _ in range(starts):
+        started = time.perf_counter()
+        probe = subprocess.run([sys.executable, "-c", STARTUP_PROBE], env=dict(os.environ), capture_output=True, text=True)
+        elapsed = time.perf_counter() - started
+        lines = probe.stdout.strip().splitlines()
+        if probe.returncode or not lines:
+            errors += 1
+            print(probe.stderr[-2000:], file=sys.stderr)
+            continue
+        timing = json.loads(lines[-1])
+        if timing["status"] != 200:
+            errors += 1
+        phases["process"].append(elapsed)
+        for phase in ("import", "startup", "first_request"):
+            phases[phase].append(timing[phase])
+    routes = {}
+    for phase, latencies in phases.items():
+        routes[f"startup {phase}"] = stats = summarize(latencies, errors, sum(latencies))
+        print(f"{phase:15} p50 {stats['latency_ms']['p50']:>9}ms  max {stats['latency_ms']['max']:>9}ms  errors {errors}")
+    return routes
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_in_process(scenarios, requests, concurrency, only):
+    import httpx
+    from main import app
+
+    # httpx doesn't run the lifespan of the app
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+            return await drive(client, scenarios, requests, concurrency, only)
+
+
+async def run_server(scenarios, requests, concurrency, only, workers):
+    import httpx
+
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py"), "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=dict(os.environ),
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    if (await client.get("/ready")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise SystemExit("serve.py did not start")
+                await asyncio.sleep(0.2)
+            return await drive(client, scenarios, requests, concurrency, only)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", default=BENCH_DB_URL)
+    parser.add_argument("--seed", action="store_true", help="recreate the dataset before running")
+    parser.add_argument("--seed-only", action="store_true")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--movies", type=int, default=10000)
+    parser.add_argument("--ratings", type=int, default=100000)
+    parser.add_argument("--comments", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--route", help="only run the routes whose name contains this text")
+    parser.add_argument("--server", action="store_true", help="drive serve.py instead of the in-process app")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--serialization", action="store_true", help="benchmark the serialization of long lists instead of the routes")
+    parser.add_argument("--items", type=int, default=1000, help="entries per list with --serialization")
+    parser.add_argument("--write-behind", action="store_true", help="queue the ratings and comments, see write_behind.py")
+    parser.add_argument("--startup", action="store_true", help="time cold starts of the app instead of the routes")
+    parser.add_argument("--starts", type=int, default=10, help="cold starts with --startup")
+    args = parser.parse_args(argv)
+
+    # The application modules read their configuration at import time
+    os.environ["DB_URL"] = args.db_url
+    # A few bench users send every request, measure the endpoints rather than their budgets
+    os.environ.setdefault("RATE_LIMITS", "")
+    if args.write_behind:
+        os.environ["WRITE_BEHIND"] = "true"
+    if args.seed or args.seed_only:
+        seed(args.users, args.movies, args.ratings, args.comments)
+    if args.seed_only:
+        return 0
+
+    if args.serialization:
+        routes = bench_serialization(args.items, args.requests)
+    elif args.startup:
+        routes = bench_startup(args.starts)
+    elif args.server:
+        scenarios = prepare_scenarios(args.requests)
+        routes = asyncio.run(run_server(scenarios, args.requests, args.concurrency, args.route, args.workers))
+    else:
+        scenarios = prepare_scenarios(args.requests)
+        routes = asyncio.run(run_in_process(scenarios, args.requests, args.concurrency, args.route))
+    results = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "mode": "serialization" if args.serialization else "startup" if args.startup else f"serve.py x{args.workers}" if args.server else "in-process",
+            "db_mode": os.environ.get("DB_MODE", "sync"),
+            "write_behind": args.write_behind,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+        "routes": routes,
+    }
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+# broadcast.py
+"""
+Messages between the worker processes started by serve.py. Every worker keeps
+its own caches; when it changes something, e.g. the response cache resources
+bumped by a write, it publishes a message and the other workers apply it to
+their copy. The channel is a directory of Unix datagram sockets, BROADCAST_DIR,
+one socket per worker named after its pid. serve.py sets it, without it (a
+single process) publish does nothing.
+
+A message waits in the receive buffer of a busy worker, and a send waits up to
+BROADCAST_SEND_TIMEOUT_SECONDS for room in a full one. A message to a worker
+that is stuck or exiting is dropped and counted; the response cache bounds
+what a missed bump costs with its max age. A worker that starts later builds
+its caches afresh, so it misses nothing. Messages are small, the largest
+being a comment event of comment_feed.py.
+"""
+import os
+import socket
+import threading
+from typing import Callable, Dict, Optional
+
+import orjson
+from loguru import logger
+
+
+BROADCAST_DIR = os.environ.get("BROADCAST_DIR")
+# Largest message received
+BROADCAST_MAX_BYTES = 64 * 1024
+# Receive buffer of a worker, the messages sent while it is busy wait there
+BROADCAST_BUFFER_BYTES = int(os.environ.get("BROADCAST_BUFFER_BYTES", 4 * 1024 * 1024))
+# How long a send waits for room in the buffer of a worker that is behind
+BROADCAST_SEND_TIMEOUT_SECONDS = float(os.environ.get("BROADCAST_SEND_TIMEOUT_SECONDS", 0.05))
+
+# The function each kind of message is applied with, set by the modules that keep the caches
+_handlers: Dict[str, Callable] = {}
+
+
+def subscribe(kind: str, handler: Callable):
+    _handlers[kind] = handler
+
+
+def dispatch(kind: str, payload):
+    handler = _handlers.get(kind)
+    if handler is None:
+        logger.warning("Broadcast message of unknown kind {}", kind)
+        return
+    handler(payload)
+
+
+class Channel:
+    def __init__(self, directory: str, name: Optional[str] = None):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{name or os.getpid()}.sock")
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BROADCAST_BUFFER_BYTES)
+        self._socket.bind(self.path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._waiting_sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._waiting_sender.settimeout(BROADCAST_SEND_TIMEOUT_SECONDS)
+        self._closed = False
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._receive, name="broadcast", daemon=True)
+        self._thread.start()
+
+    def peers(self) -> list:
+        return [
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.endswith(".sock") and os.path.join(self.directory, name) != self.path
+        ]
+
+    def publish(self, kind: str, payload):
+        message = orjson.dumps([kind, payload])
+        for peer in self.peers():
+            try:
+                try:
+                    self._sender.sendto(message, peer)
+                except BlockingIOError:
+                    # The buffer of a busy worker is full, give it a moment to catch up
+                    self._waiting_sender.sendto(message, peer)
+                self.sent += 1
+            except (socket.timeout, BlockingIOError, ConnectionRefusedError, FileNotFoundError):
+                # A stuck worker, or one that exited and whose socket is not removed yet
+                self.dropped += 1
+                logger.warning("Broadcast {} to {} dropped", kind, peer)
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._socket.recv(BROADCAST_MAX_BYTES)
+            except OSError:
+                return
+            if self._closed:
+                return
+            try:
+                kind, payload = orjson.loads(message)
+                self.received += 1
+                dispatch(kind, payload)
+            except Exception:
+                logger.exception("Applying a broadcast message failed")
+
+    def close(self):
+        self._closed = True
+        # Wakes the receiving thread up
+        try:
+            self._sender.sendto(b"", self.path)
+        except OSError:
+            pass
+        self._thread.join(5)
+        self._socket.close()
+        self._sender.close()
+        self._waiting_sender.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "received": self.received, "dropped": self.dropped, "peers": len(self.peers())}
+
+
+# The channel of this worker, None outside serve.py
+channel: Optional[Channel] = None
+
+
+def start():
+    global channel
+    if BROADCAST_DIR and channel is None:
+        channel = Channel(BROADCAST_DIR)
+
+
+def stop():
+    global channel
+    if channel is not None:
+        channel.close()
+        channel = None
+
+
+def enabled() -> bool:
+    return channel is not None
+
+
+def publish(kind: str, payload):
+    """Sends a message to the other workers, from any thread"""
+    if channel is not None:
+        channel.publish(kind, payload)
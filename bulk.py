@@ -0,0 +1,198 @@
+# bulk.py
+"""
+Streaming bulk import and export of the movie catalog.
+The import reads NDJSON or CSV from the request body as it arrives, checks each
+row against schemas.MovieCreate and inserts BULK_CHUNK_SIZE movies per
+statement and commit, so neither the body nor the catalog is ever held in
+memory as a whole. The rows of a chunk that fails to be written are reported
+as failed, the import goes on with the next chunk. The export streams the catalog from a server side cursor.
+"""
+import codecs
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import AsyncIterator, Iterator, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request, status
+from loguru import logger
+from pydantic import ValidationError
+from sqlalchemy import select
+
+import crud_async, database, models, schemas
+from database import DBSession
+
+
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 1000))
+# Rejected rows past this many are counted but not described in the report
+BULK_MAX_ERRORS = int(os.environ.get("BULK_MAX_ERRORS", 1000))
+
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+NDJSON_TYPES = (NDJSON, "application/jsonl", "application/json-lines", "application/x-jsonlines")
+MEDIA_TYPES = {"ndjson": NDJSON, "csv": CSV}
+
+EXPORT_COLUMNS = ["id", "owner_id", "time_created", *schemas.MovieCreate.model_fields]
+
+# A parsed row, or the reason it could not be parsed
+Record = Union[dict, str]
+
+
+async def _lines(request: Request) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    try:
+        async for chunk in request.stream():
+            pending += decoder.decode(chunk)
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                yield line
+        pending += decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The request body is not valid UTF-8")
+    if pending:
+        yield pending
+
+
+async def _ndjson_records(request: Request) -> AsyncIterator[Tuple[int, Record]]:
+    """Numbers the rows by line"""
+    row = 0
+    async for line in _lines(request):
+        row += 1
+        if not line.strip():
+            continue
+        try:
+            yield row, json.loads(line)
+        except ValueError as error:
+            yield row, f"Invalid JSON: {error}"
+
+
+async def _csv_records(request: Request) -> AsyncIterator[Tuple[int, Record]]:
+    """Numbers the rows after the header, empty cells are left out so the schema defaults apply"""
+    header = None
+    row = 0
+    parts = []
+    async for line in _lines(request):
+        parts.append(line)
+        text = "\n".join(parts)
+        if text.count('"') % 2:
+            # A quoted cell goes on on the next line
+            continue
+        parts = []
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        row += 1
+        if len(values) != len(header):
+            yield row, f"Expected {len(header)} cells, got {len(values)}"
+            continue
+        yield row, {name: value for name, value in zip(header, values) if value != ""}
+    if parts:
+        yield row + 1, "Unterminated quoted cell"
+
+
+def _validate(record: Record) -> Tuple[Optional[schemas.MovieCreate], Optional[list]]:
+    if isinstance(record, str):
+        return None, [{"msg": record}]
+    try:
+        return schemas.MovieCreate.model_validate(record), None
+    except ValidationError as error:
+        return None, json.loads(error.json(include_url=False))
+
+
+async def import_movies(request: Request, db: DBSession, user_id: int) -> dict:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in NDJSON_TYPES:
+        records = _ndjson_records(request)
+    elif content_type == CSV:
+        records = _csv_records(request)
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Send the movies as {NDJSON} (a JSON object per line) or as {CSV} with a header row",
+        )
+    report = {"created": 0, "failed": 0, "errors": []}
+    batch = []
+    async for row, record in records:
+        movie, errors = _validate(record)
+        if movie is None:
+            _fail(report, row, errors)
+            continue
+        batch.append((row, movie))
+        if len(batch) >= BULK_CHUNK_SIZE:
+            await _create(db, batch, user_id, report)
+            batch = []
+    if batch:
+        await _create(db, batch, user_id, report)
+    return report
+
+
+def _fail(report: dict, row: int, errors: list):
+    report["failed"] += 1
+    if len(report["errors"]) < BULK_MAX_ERRORS:
+        report["errors"].append({"row": row, "errors": errors})
+
+
+async def _create(db: DBSession, batch: list, user_id: int, report: dict):
+    try:
+        report["created"] += len(await crud_async.create_movies(db, movies=[movie for _, movie in batch], user_id=user_id))
+    except Exception:
+        logger.exception("Importing the movies of rows {} to {} failed", batch[0][0], batch[-1][0])
+        for row, _ in batch:
+            _fail(report, row, [{"msg": "The movies of this row's chunk could not be written, send them again"}])
+
+
+def _export_statement():
+    columns = [getattr(models.Movie, column) for column in EXPORT_COLUMNS]
+    # yield_per streams the rows from a server side cursor where the driver has one
+    return select(*columns).order_by(models.Movie.id).execution_options(yield_per=BULK_CHUNK_SIZE)
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _ndjson_line(row) -> str:
+    return json.dumps({column: _json_value(value) for column, value in zip(EXPORT_COLUMNS, row)}) + "\n"
+
+
+def _csv_line(row) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow([_json_value(value) for value in row])
+    return buffer.getvalue()
+
+
+def _export_sync(format_row, header: Optional[str]) -> Iterator[str]:
+    with database.read_session() as db:
+        if header:
+            yield header
+        for partition in db.execute(_export_statement()).partitions():
+            yield "".join(format_row(row) for row in partition)
+
+
+async def _export_async(format_row, header: Optional[str]) -> AsyncIterator[str]:
+    db = database.read_session()
+    try:
+        if header:
+            yield header
+        result = await db.stream(_export_statement())
+        async for partition in result.partitions():
+            yield "".join(format_row(row) for row in partition)
+    finally:
+        await db.close()
+
+
+def export_movies(format: str):
+    """
+    The body of the export, a chunk of BULK_CHUNK_SIZE rows at a time. It runs
+    on its own session, the request's session is closed before the body is sent
+    """
+    format_row = _csv_line if format == "csv" else _ndjson_line
+    header = _csv_line(EXPORT_COLUMNS) if format == "csv" else None
+    if database.AsyncSessionLocal is not None:
+        return _export_async(format_row, header)
+    return _export_sync(format_row, header)
@@ -0,0 +1,116 @@
+# catalog.py
+"""
+Normalized copies of the free-form movie fields, for filtering. The genres and
+cast strings are split into the movie_genres and movie_cast association tables,
+one row per name, lower cased, and the Runtime string is parsed into the
+runtime_minutes column. The crud write functions keep them in sync, backfill()
+fills them for the rows written before they existed.
+"""
+import re
+from typing import Iterable, List, Optional
+
+from loguru import logger
+from sqlalchemy import bindparam, delete, exists, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+import models
+
+
+BACKFILL_CHUNK_SIZE = 1000
+
+_SEPARATORS = re.compile(r"[,|/;]")
+_HOURS = re.compile(r"(\d+(?:\.\d+)?)\s*h(?:ou)?r?s?\b", re.IGNORECASE)
+_MINUTES = re.compile(r"(\d+)\s*m(?:in(?:ute)?s?)?\b", re.IGNORECASE)
+_CLOCK = re.compile(r"^\s*(\d+):(\d{1,2})\s*$")
+_NUMBER = re.compile(r"^\s*(\d+)\s*$")
+
+
+def parse_runtime(runtime: Optional[str]) -> Optional[int]:
+    """
+    Minutes of a runtime such as "2hr.15mins", "2h 15m", "135 min", "1:45" or "90",
+    None when it can't be read
+    """
+    if not runtime:
+        return None
+    match = _CLOCK.match(runtime)
+    if match:
+        return int(match.group(1)) * 60 + int(match.group(2))
+    match = _NUMBER.match(runtime)
+    if match:
+        return int(match.group(1))
+    hours, minutes = _HOURS.search(runtime), _MINUTES.search(runtime.replace(".", " "))
+    if not hours and not minutes:
+        return None
+    return round(float(hours.group(1)) * 60 if hours else 0) + (int(minutes.group(1)) if minutes else 0)
+
+
+def normalize_name(name: str) -> str:
+    return " ".join(name.split()).lower()
+
+
+def split_names(value: Optional[str]) -> List[str]:
+    """The distinct names of a comma (or | / ;) separated list"""
+    names = (normalize_name(name) for name in _SEPARATORS.split(value or ""))
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def _association_rows(movies: Iterable[tuple]):
+    """(movie_id, genres, cast) tuples to the rows of the two association tables"""
+    genres, cast = [], []
+    for movie_id, movie_genres, movie_cast in movies:
+        genres += [{"movie_id": movie_id, "genre": genre} for genre in split_names(movie_genres)]
+        cast += [{"movie_id": movie_id, "name": name} for name in split_names(movie_cast)]
+    return genres, cast
+
+
+def index_movies(db: Session, movies: Iterable[tuple], replace: bool = False):
+    """
+    Writes the genre and cast rows of (movie_id, genres, cast) tuples, one
+    statement per table. replace drops the previous rows of the movies first
+    """
+    movies = list(movies)
+    if replace:
+        movie_ids = [movie[0] for movie in movies]
+        for table in (models.MovieGenre, models.MovieCast):
+            db.execute(delete(table).where(table.movie_id.in_(movie_ids)).execution_options(synchronize_session=False))
+    genres, cast = _association_rows(movies)
+    if genres:
+        db.execute(insert(models.MovieGenre), genres)
+    if cast:
+        db.execute(insert(models.MovieCast), cast)
+
+
+def backfill(db: Session, chunk: int = BACKFILL_CHUNK_SIZE) -> int:
+    """
+    Fills runtime_minutes and the association tables of the movies written before
+    they existed, a chunk of movies per transaction. Returns the number of movies updated
+    """
+    movie = models.Movie
+    unindexed = or_(
+        (movie.genres != "") & ~exists().where(models.MovieGenre.movie_id == movie.id),
+        (movie.cast != "") & ~exists().where(models.MovieCast.movie_id == movie.id),
+        movie.runtime_minutes.is_(None) & movie.Runtime.is_not(None),
+    )
+    done, last_id = 0, 0
+    while True:
+        rows = db.execute(
+            select(movie.id, movie.genres, movie.cast, movie.Runtime)
+            .where(movie.id > last_id, unindexed)
+            .order_by(movie.id)
+            .limit(chunk)
+        ).all()
+        if not rows:
+            break
+        index_movies(db, [(row.id, row.genres, row.cast) for row in rows], replace=True)
+        runtimes = [{"movie_id": row.id, "minutes": parse_runtime(row.Runtime)} for row in rows if row.Runtime]
+        runtimes = [runtime for runtime in runtimes if runtime["minutes"] is not None]
+        if runtimes:
+            db.connection().execute(
+                update(movie.__table__).where(movie.__table__.c.id == bindparam("movie_id")).values(runtime_minutes=bindparam("minutes")),
+                runtimes,
+            )
+        db.commit()
+        done += len(rows)
+        last_id = rows[-1].id
+        logger.info("Backfilled the catalog columns of {} movies", done)
+    return done
@@ -0,0 +1,163 @@
+# comment_feed.py
+"""
+Live feed of the new comments of a movie, streamed as Server-Sent Events by
+GET /movies/{movie_id}/comments/stream. crud.create_comment publishes each
+comment it commits to the broker, which fans it out to the streams following
+that movie. An event is serialized once, whatever the number of followers.
+
+The id of an event is the pagination cursor of its comment. A client that
+reconnects with it in the Last-Event-ID header is first sent the comments it
+missed, read from the database, then the live ones. When it missed more than
+COMMENT_FEED_MAX_REPLAY, the stream ends after that many and the client
+reconnects from the last of them. A follower that falls
+COMMENT_FEED_QUEUE_SIZE events behind gets a reset event and is disconnected,
+and catches up the same way.
+
+Each worker of serve.py has its own broker, the comments written through the
+other workers come over broadcast.py.
+"""
+import asyncio
+import os
+import threading
+from collections import defaultdict
+from typing import AsyncIterator, Iterable, Optional, Set
+
+import orjson
+
+import broadcast, fast_json
+from pagination import encode_cursor
+
+
+COMMENT_FEED_QUEUE_SIZE = int(os.environ.get("COMMENT_FEED_QUEUE_SIZE", 100))
+# Seconds between the keepalive lines of an idle stream, they also detect the closed connections
+COMMENT_FEED_KEEPALIVE_SECONDS = float(os.environ.get("COMMENT_FEED_KEEPALIVE_SECONDS", 15))
+# Most missed comments replayed by one connection, the client reconnects for the rest
+COMMENT_FEED_MAX_REPLAY = int(os.environ.get("COMMENT_FEED_MAX_REPLAY", 1000))
+
+KEEPALIVE = b": keepalive\n\n"
+RESET = b"event: reset\ndata: {}\n\n"
+
+# Queue items are (comment id, event), these two end the stream
+_RESET = (None, RESET)
+_CLOSE = (None, None)
+
+
+def event(comment: dict) -> bytes:
+    """A comment shaped by fast_json.comment as an event"""
+    cursor = encode_cursor(comment["time_created"], comment["id"])
+    return f"id: {cursor}\nevent: comment\ndata: ".encode() + orjson.dumps(comment, option=fast_json.OPTIONS) + b"\n\n"
+
+
+class Follower:
+    """The queue of events of one stream, read in the event loop that created it"""
+
+    def __init__(self, movie_id: int, queue_size: int):
+        self.movie_id = movie_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.dropped = False
+
+    def offer(self, item: tuple):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Too slow, the events it would get now are stale anyway
+            self.dropped = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(_RESET)
+
+
+class Broker:
+    def __init__(self, queue_size: int = COMMENT_FEED_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._followers: "defaultdict[int, Set[Follower]]" = defaultdict(set)
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def follow(self, movie_id: int) -> Follower:
+        follower = Follower(movie_id, self.queue_size)
+        with self._lock:
+            self._followers[movie_id].add(follower)
+        return follower
+
+    def unfollow(self, follower: Follower):
+        with self._lock:
+            followers = self._followers.get(follower.movie_id)
+            if followers is not None:
+                followers.discard(follower)
+                if not followers:
+                    del self._followers[follower.movie_id]
+        if follower.dropped:
+            self.dropped += 1
+
+    def listening(self, movie_id: int) -> bool:
+        # The followers of the other workers are not known here
+        return movie_id in self._followers or broadcast.enabled()
+
+    def _send(self, followers: Iterable[Follower], item: tuple):
+        for follower in followers:
+            try:
+                follower.loop.call_soon_threadsafe(follower.offer, item)
+            except RuntimeError:
+                # Its event loop is closed
+                self.unfollow(follower)
+
+    def publish(self, movie_id: int, comment: dict):
+        """Sends a committed comment to the followers of its movie, here and in the other workers, from any thread"""
+        chunk = event(comment)
+        broadcast.publish("comment", [movie_id, comment["id"], chunk.decode()])
+        self.deliver(movie_id, comment["id"], chunk)
+
+    def deliver(self, movie_id: int, comment_id: int, chunk: bytes):
+        with self._lock:
+            followers = list(self._followers.get(movie_id, ()))
+        if followers:
+            self.published += 1
+            self._send(followers, (comment_id, chunk))
+
+    def close(self):
+        """Ends every stream, at shutdown"""
+        with self._lock:
+            followers = [follower for followers in self._followers.values() for follower in followers]
+        self._send(followers, _CLOSE)
+
+    async def stream(
+        self, follower: Follower, backlog: Iterable[bytes] = (), last_id: Optional[int] = None, keepalive: float = COMMENT_FEED_KEEPALIVE_SECONDS,
+    ) -> AsyncIterator[bytes]:
+        """
+        The events of a follower, after the replayed backlog. Live comments up to
+        last_id were in the backlog already and are skipped
+        """
+        try:
+            for chunk in backlog:
+                yield chunk
+            while True:
+                try:
+                    comment_id, chunk = await asyncio.wait_for(follower.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE
+                    continue
+                if chunk is None:
+                    return
+                if comment_id is not None and last_id is not None and comment_id <= last_id:
+                    continue
+                yield chunk
+                if comment_id is None:
+                    return
+        finally:
+            self.unfollow(follower)
+
+    def stats(self) -> dict:
+        with self._lock:
+            followers = sum(len(followers) for followers in self._followers.values())
+            movies = len(self._followers)
+        return {"followers": followers, "movies": movies, "published": self.published, "dropped": self.dropped}
+
+
+broker = Broker()
+
+broadcast.subscribe("comment", lambda message: broker.deliver(message[0], message[1], message[2].encode()))
@@ -1,104 +1,541 @@
 # crud.py
 from fastapi import HTTPException, status
-from sqlalchemy.orm import Session
-import models, schemas
-from typing import Optional
-from sqlalchemy.orm import Session
+from loguru import logger
+from sqlalchemy import Integer, and_, case, cast, delete, exists, func, insert, literal, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
+import catalog, comment_feed, fast_json, leaderboard, models, schemas, search, user_cache
+import response_cache
+from datetime import datetime, timezone
+from pagination import DEFAULT_PAGE_SIZE, keyset
+from typing import Dict, List, Optional, Tuple
 from models import Rating
 
 
+# Loading strategy of a movie returned as an ORM object: a movie has a single
+# owner and rating aggregate, they are joined in rather than lazy-loaded.
+MOVIE_RELATIONS = (joinedload(models.Movie.owner), joinedload(models.Movie.rating_stats))
+
+# Keyset orderings of the paginated lists, each one is backed by an index in models.py
+MOVIE_ORDER = (models.Movie.time_created, models.Movie.id)
+COMMENT_ORDER = (models.Comment.time_created, models.Comment.id)
+RATING_ORDER = (models.Rating.id,)
+
+
+# The write functions below take one or two statements on success. They rely on
+# the constraints and on conditions inside the write statements themselves
+# instead of looking rows up first, which also keeps them correct when requests
+# race. Only a failed write spends a query on finding out why it failed.
+
+USER_COLUMNS = (models.User.id, models.User.username, models.User.full_name, models.User.email)
+
 def create_user(db: Session, user: schemas.UserCreate, hashed_password: str):
-    db_user = models.User(
-        username=user.username, 
-        full_name=user.full_name, 
-        email=user.email,
-        hashed_password=hashed_password
-    )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    try:
+        db_user = db.execute(
+            insert(models.User)
+            .values(username=user.username, full_name=user.full_name, email=user.email, hashed_password=hashed_password)
+            .returning(*USER_COLUMNS)
+        ).one()
+        db.commit()
+    except IntegrityError:
+        # Registered by a concurrent request since the conflict check
+        db.rollback()
+        taken = find_registration_conflict(db, username=user.username, email=user.email) or "Username"
+        raise HTTPException(status_code=400, detail=f"{taken} already registered")
     return db_user
 
+# "Username" or "Email" when one of them is registered already, in one query
+def find_registration_conflict(db: Session, username: str, email: str) -> Optional[str]:
+    taken = db.execute(
+        select(models.User.username, models.User.email)
+        .where(or_(models.User.username == username, models.User.email == email))
+        .limit(2)
+    ).all()
+    if any(row.username == username for row in taken):
+        return "Username"
+    return "Email" if taken else None
+
+def update_user_password(db: Session, user_id: int, hashed_password: str):
+    db_user = db.get(models.User, user_id)
+    username = db_user.username
+    db_user.hashed_password = hashed_password
+    db.commit()
+    user_cache.invalidate(username)
+
+# Readiness check
+def ping(db: Session):
+    db.execute(select(literal(1)))
+
+def get_user_by_id(db: Session, user_id: int):
+    return db.get(models.User, user_id)
+
 def get_user_by_username(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
 def create_movie(db: Session, movie: schemas.MovieCreate, user_id: int):
-    db_movie = models.Movie(**movie.dict(), owner_id=user_id)
+    db_movie = models.Movie(**movie.dict(), runtime_minutes=catalog.parse_runtime(movie.Runtime), owner_id=user_id)
+    db_movie.rating_stats = models.MovieRatingStats(count=0, sum=0)
     db.add(db_movie)
+    db.flush()
+    search.get_backend().index_movie(db, db_movie)
+    catalog.index_movies(db, [(db_movie.id, movie.genres, movie.cast)])
     db.commit()
-    db.refresh(db_movie)
-    return db_movie
+    response_cache.bump(response_cache.MOVIES, response_cache.movie(db_movie.id))
+    search.movies_changed(db_movie.id)
+    # One query for the movie and what its response shows, instead of a refresh and two lazy loads
+    return get_movie_by_id(db, db_movie.id, with_relations=True)
+
+# Bulk import, one multi-row INSERT per table for the whole batch
+def create_movies(db: Session, movies: List[schemas.MovieCreate], user_id: int) -> List[int]:
+    rows = [dict(movie.dict(), runtime_minutes=catalog.parse_runtime(movie.Runtime), owner_id=user_id) for movie in movies]
+    try:
+        movie_ids = db.scalars(insert(models.Movie).returning(models.Movie.id, sort_by_parameter_order=True), rows).all()
+        db.execute(insert(models.MovieRatingStats), [{"movie_id": movie_id, "count": 0, "sum": 0} for movie_id in movie_ids])
+        search.get_backend().index_movies(db, [models.Movie(id=movie_id, **row) for movie_id, row in zip(movie_ids, rows)])
+        catalog.index_movies(db, [(movie_id, row["genres"], row["cast"]) for movie_id, row in zip(movie_ids, rows)])
+        db.commit()
+    except Exception:
+        # None of the movies is created, the session stays usable for the next ones
+        db.rollback()
+        raise
+    response_cache.bump(response_cache.MOVIES)
+    search.movies_changed(*movie_ids)
+    return movie_ids
     
-def get_movies(db: Session, skip: int = 0, limit: int = 10):
-    return db.query(models.Movie).offset(skip).limit(limit).all()
+def get_movie_by_id(db: Session, movie_id: int, with_relations: bool = False):
+    query = db.query(models.Movie)
+    if with_relations:
+        query = query.options(*MOVIE_RELATIONS)
+    return query.filter(models.Movie.id == movie_id).first()
 
-# Read User Movies
-def get_user_movies(db: Session, user_id: int):
-    return db.query(models.Movie).filter(models.Movie.owner_id == user_id).all()
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
 
-def get_movie_by_id(db: Session, movie_id: int):
-    return db.query(models.Movie).filter(models.Movie.id == movie_id).first()
+def _movie_not_found(movie_id: int, hint: str = "Please try another movie_id"):
+    logger.warning("Movie not found with id: {}", movie_id)
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, {hint}")
 
+def _movie_in_use(movie_id: int):
+    return or_(exists().where(models.Rating.movie_id == movie_id), exists().where(models.Comment.movie_id == movie_id))
 
-def update_movie(db: Session, movie_id: int, movie: schemas.MovieUpdate):
-    db_movie = db.query(models.Movie).filter(models.Movie.id == movie_id).first()
-    if db_movie:
-        for var, value in vars(movie).items():
-            setattr(db_movie, var, value)
-        db.commit()
-        db.refresh(db_movie)
-    return db_movie
+def update_movie(db: Session, movie_id: int, movie: schemas.MovieUpdate, user_id: int):
+    updated = db.execute(
+        update(models.Movie)
+        .where(models.Movie.id == movie_id, models.Movie.owner_id == user_id)
+        .values(**movie.dict(), runtime_minutes=catalog.parse_runtime(movie.Runtime))
+        .returning(models.Movie.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if updated is None:
+        db.rollback()
+        owner_id = db.scalar(select(models.Movie.owner_id).where(models.Movie.id == movie_id))
+        if owner_id is None:
+            raise _movie_not_found(movie_id)
+        logger.warning("User {} is not authorized to update movie_id: {}", user_id, movie_id)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="We are sorry, you are not authorized to update this movie")
+    search.get_backend().index_movie(db, models.Movie(id=movie_id, **movie.dict()))
+    catalog.index_movies(db, [(movie_id, movie.genres, movie.cast)], replace=True)
+    db.commit()
+    response_cache.bump(response_cache.MOVIES, response_cache.movie(movie_id))
+    search.movies_changed(movie_id)
+    return get_movie_by_id(db, movie_id, with_relations=True)
 
-def delete_movie(db: Session, movie_id: int):
-    db.query(models.Movie).filter(models.Movie.id == movie_id).delete()
+def delete_movie(db: Session, movie_id: int, user_id: int):
+    """
+    Deletes a movie of user_id that has no ratings or comments. The DELETE
+    statements check that themselves, so a rating or comment written at the
+    same time can't be left pointing to a deleted movie
+    """
+    deletable = and_(models.Movie.id == movie_id, models.Movie.owner_id == user_id, ~_movie_in_use(movie_id))
+    # The aggregate and catalog rows reference the movie, they go first. A movie whose
+    # comments were all deleted still has its leaderboard scores
+    for aggregate in (models.MovieRatingStats, models.MovieScore, models.MovieGenre, models.MovieCast):
+        db.execute(delete(aggregate).where(aggregate.movie_id == movie_id, exists().where(deletable)).execution_options(synchronize_session=False))
+    deleted = db.execute(delete(models.Movie).where(deletable).returning(models.Movie.id).execution_options(synchronize_session=False)).first()
+    if deleted is None:
+        db.rollback()
+        movie = db.execute(
+            select(models.Movie.owner_id, _movie_in_use(movie_id).label("in_use")).where(models.Movie.id == movie_id)
+        ).first()
+        if movie is None:
+            raise _movie_not_found(movie_id)
+        if movie.owner_id != user_id:
+            logger.warning("User {} is not authorized to delete movie_id: {}", user_id, movie_id)
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"You are not authorized to delete movie_id {movie_id}")
+        logger.warning("trying to delete Movie {} with rating or comments, but operation aborted", movie_id)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"You cannot delete movie_id {movie_id} with existing ratings or comments")
+    search.get_backend().remove_movie(db, movie_id)
     db.commit()
+    response_cache.bump(response_cache.MOVIES, response_cache.movie(movie_id), response_cache.ratings(movie_id), response_cache.comments(movie_id))
+    search.movies_changed(movie_id)
+
+# The row values a new rating or comment is returned with, the handler adds the author
+RATING_COLUMNS = (models.Rating.id, models.Rating.movie_id, models.Rating.user_id, models.Rating.rating)
+COMMENT_COLUMNS = (models.Comment.id, models.Comment.movie_id, models.Comment.user_id, models.Comment.comment, models.Comment.time_created)
 
-def create_comment(db: Session, comment: schemas.CommentCreate, movie_id: int, user_id: int):
-    db_comment = models.Comment(**comment.dict(), movie_id=movie_id, )
-    db.add(db_comment)
+def _insert_for_movie(model, movie_id: int, values: dict):
+    """INSERT ... SELECT that writes the row only when the movie exists"""
+    columns = ["movie_id", *values]
+    movie = select(models.Movie.id, *(literal(value, type_=getattr(model, column).type) for column, value in values.items()))
+    return insert(model).from_select(columns, movie.where(models.Movie.id == movie_id))
+
+def create_comment(db: Session, comment: schemas.CommentCreate, movie_id: int, user_id: int, author: Optional[schemas.CurrentUser] = None):
+    db_comment = db.execute(
+        _insert_for_movie(models.Comment, movie_id, {"user_id": user_id, "comment": comment.comment}).returning(*COMMENT_COLUMNS)
+    ).first()
+    if db_comment is None:
+        raise _movie_not_found(movie_id, "Please try again")
+    leaderboard.record(db, movie_id, leaderboard.TRENDING_COMMENT_WEIGHT)
     db.commit()
-    db.refresh(db_comment)
+    response_cache.bump(response_cache.comments(movie_id))
+    _publish_comment(db, db_comment, author)
     return db_comment
 
-def get_comments_for_movie(db: Session, movie_id: int):
-    return db.query(models.Comment).filter(models.Comment.movie_id == movie_id).all()
+def _publish_comment(db: Session, db_comment, author: Optional[schemas.CurrentUser] = None):
+    if comment_feed.broker.listening(db_comment.movie_id):
+        author = author or db.get(models.User, db_comment.user_id)
+        row = (db_comment.comment, db_comment.id, db_comment.movie_id, db_comment.time_created, author.id, author.username, author.full_name)
+        comment_feed.broker.publish(db_comment.movie_id, fast_json.comment(row))
 
 def get_comment_by_id(db: Session, comment_id: int):
     return db.query(models.Comment).filter(models.Comment.id == comment_id).first()
 
-def delete_comment(db: Session, comment_id: int):
-    db_comment = db.query(models.Comment).filter(models.Comment.id == comment_id).first()
-    if db_comment:
-        db.delete(db_comment)
-        db.commit()
+def delete_comment(db: Session, comment_id: int, user_id: int):
+    deleted = db.execute(
+        delete(models.Comment)
+        .where(models.Comment.id == comment_id, models.Comment.user_id == user_id)
+        .returning(models.Comment.movie_id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if deleted is None:
+        db.rollback()
+        if get_comment_by_id(db, comment_id) is None:
+            logger.warning("Comment not found with id: {}", comment_id)
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Comment_id {comment_id} does not exist, Please try another comment_id")
+        logger.warning("User {} is not authorized to delete comment_id: {}", user_id, comment_id)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not authorized to delete this comment")
+    db.commit()
+    response_cache.bump(response_cache.comments(deleted.movie_id))
 
 
-def create_rating(db: Session, rating: schemas.RatingCreate, movie_id: int, user_id: int):
-    # Check if the user has already rated this movie
-    existing_rating = db.query(models.Rating).filter(models.Rating.movie_id == movie_id, models.Rating.user_id == user_id).first()
-    
-    if existing_rating:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"You have already rated movie_id {movie_id}")
-    
+def validate_rating(rating: schemas.RatingCreate):
      # Check if the rating is within the acceptable range
     if rating.rating < 0 or rating.rating > 5:
         raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=f"{rating} is invalid, Rating range should be from 0 to 5")
-       
-    new_rating = Rating(movie_id=movie_id, user_id=user_id, rating=rating.rating)
-    db.add(new_rating)
-    db.commit()
-    db.refresh(new_rating)
+
+def create_rating(db: Session, rating: schemas.RatingCreate, movie_id: int, user_id: int):
+    validate_rating(rating)
+
+    try:
+        new_rating = db.execute(
+            _insert_for_movie(Rating, movie_id, {"user_id": user_id, "rating": rating.rating}).returning(*RATING_COLUMNS)
+        ).first()
+        if new_rating is None:
+            raise _movie_not_found(movie_id, "Please try again")
+        # The aggregates are updated in the same transaction as the rating itself
+        add_to_rating_stats(db, movie_id, rating.rating)
+        leaderboard.record(db, movie_id, leaderboard.TRENDING_RATING_WEIGHT)
+        db.commit()
+    except IntegrityError:
+        # unique_user_movie_rating, or the movie was deleted in the meantime
+        db.rollback()
+        if get_movie_by_id(db, movie_id) is None:
+            raise _movie_not_found(movie_id, "Please try again")
+        raise _already_rated(movie_id)
+    # The rating aggregate is part of the movie and of the movie lists
+    response_cache.bump(response_cache.ratings(movie_id), response_cache.movie(movie_id), response_cache.MOVIES)
     return new_rating
-    
 
+def _already_rated(movie_id: int):
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"You have already rated movie_id {movie_id}")
+
+def _insert_ignoring_conflicts(db: Session, model):
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(model).on_conflict_do_nothing()
 
-def get_ratings_for_movie(db: Session, movie_id: int):
-   return db.query(models.Rating).filter(models.Rating.movie_id == movie_id).all()
-   
+def write_batch(
+    db: Session, ratings: List[dict], comments: List[dict], authors: Optional[Dict[int, schemas.CurrentUser]] = None,
+) -> Tuple[list, list]:
+    """
+    Writes the ratings and comments of many users in one transaction, for the
+    write-behind queue. Each kind is a single multi-row INSERT, the rating
+    aggregates and leaderboard scores are updated once per movie and the caches
+    bumped once per batch. ratings are dicts of movie_id, user_id and rating,
+    comments of movie_id, user_id and comment. Returns the written rows in the
+    order of the inputs, with the HTTPException create_rating or create_comment
+    would have raised in place of the writes that failed. An IntegrityError
+    (a movie deleted meanwhile) fails the whole batch
+    """
+    existing = set(db.scalars(select(models.Movie.id).where(models.Movie.id.in_({write["movie_id"] for write in ratings + comments}))))
+    rating_results, comment_results = [None] * len(ratings), [None] * len(comments)
+    activity = {}
 
+    # The first rating of a user for a movie wins, in the batch as in the table
+    pending = {}
+    for index, write in enumerate(ratings):
+        key = (write["user_id"], write["movie_id"])
+        if write["movie_id"] not in existing:
+            rating_results[index] = _movie_not_found(write["movie_id"], "Please try again")
+        elif key in pending:
+            rating_results[index] = _already_rated(write["movie_id"])
+        else:
+            pending[key] = index
+    if pending:
+        written = db.execute(
+            _insert_ignoring_conflicts(db, Rating).returning(*RATING_COLUMNS), [ratings[index] for index in pending.values()]
+        ).all()
+        stars = {}
+        for row in written:
+            rating_results[pending.pop((row.user_id, row.movie_id))] = row
+            stars.setdefault(row.movie_id, []).append(row.rating)
+        for index in pending.values():
+            rating_results[index] = _already_rated(ratings[index]["movie_id"])
+        for movie_id, values in stars.items():
+            add_to_rating_stats(db, movie_id, *values)
+            activity[movie_id] = leaderboard.TRENDING_RATING_WEIGHT * len(values)
 
+    accepted = [index for index, write in enumerate(comments) if write["movie_id"] in existing]
+    for index in set(range(len(comments))) - set(accepted):
+        comment_results[index] = _movie_not_found(comments[index]["movie_id"], "Please try again")
+    if accepted:
+        written = db.execute(
+            insert(models.Comment).returning(*COMMENT_COLUMNS, sort_by_parameter_order=True), [comments[index] for index in accepted]
+        ).all()
+        for index, row in zip(accepted, written):
+            comment_results[index] = row
+            activity[row.movie_id] = activity.get(row.movie_id, 0) + leaderboard.TRENDING_COMMENT_WEIGHT
 
- 
\ No newline at end of file
+    for movie_id, weight in activity.items():
+        leaderboard.record(db, movie_id, weight)
+    db.commit()
+
+    rated = {row.movie_id for row in rating_results if not isinstance(row, HTTPException)}
+    commented = [row for row in comment_results if not isinstance(row, HTTPException)]
+    keys = [key for movie_id in rated for key in (response_cache.ratings(movie_id), response_cache.movie(movie_id))]
+    keys += list({response_cache.comments(row.movie_id) for row in commented})
+    if rated:
+        keys.append(response_cache.MOVIES)
+    if keys:
+        response_cache.bump(*keys)
+    for row in commented:
+        _publish_comment(db, row, (authors or {}).get(row.user_id))
+    return rating_results, comment_results
+
+
+
+
+# Column projections of the list endpoints. They return plain rows, with only
+# the columns the responses show, that fast_json serializes as they are: no ORM
+# objects are built and nothing read back from our own database is validated.
+# The labels keep the column keys of the orderings for the pagination cursors.
+MOVIE_ROW = (
+    *(getattr(models.Movie, field) for field in schemas.MovieBase.model_fields),
+    models.Movie.id, models.Movie.owner_id, models.Movie.time_created,
+    models.User.username.label("owner_username"), models.User.full_name.label("owner_full_name"), models.User.email.label("owner_email"),
+    models.MovieRatingStats.count.label("stats_count"), models.MovieRatingStats.sum.label("stats_sum"),
+    *(getattr(models.MovieRatingStats, f"stars_{stars}") for stars in range(6)),
+)
+fast_json.bind_movie_row(MOVIE_ROW)
+RATING_ROW = (
+    models.Rating.rating, models.Rating.id, models.Rating.movie_id,
+    models.User.id.label("user_id"), models.User.username, models.User.full_name,
+)
+COMMENT_ROW = (
+    models.Comment.comment, models.Comment.id, models.Comment.movie_id, models.Comment.time_created,
+    models.User.id.label("user_id"), models.User.username, models.User.full_name,
+)
+
+def _movie_rows():
+    return (
+        select(*MOVIE_ROW)
+        .join(models.User, models.Movie.owner_id == models.User.id)
+        .outerjoin(models.MovieRatingStats, models.MovieRatingStats.movie_id == models.Movie.id)
+    )
+
+# Ranks movies like the top rated leaderboard, those without scores at the prior
+RATING_SCORE = func.coalesce(models.MovieScore.top, leaderboard.TOP_PRIOR_RATING).label("rating_score")
+
+# Orders the movies of unknown year as the oldest ones, a cursor can't hold a NULL
+YEAR_KEY = func.coalesce(models.Movie.year_released, models.YEAR_UNKNOWN).label("year_key")
+
+# The keyset orderings of the sort parameter of the catalog: columns, descending
+MOVIE_SORTS = {
+    "created": (MOVIE_ORDER, False),
+    "-created": (MOVIE_ORDER, True),
+    "year": ((YEAR_KEY, models.Movie.id), False),
+    "-year": ((YEAR_KEY, models.Movie.id), True),
+    "rating": ((RATING_SCORE, models.Movie.id), False),
+    "-rating": ((RATING_SCORE, models.Movie.id), True),
+}
+
+def _has_genre(genre: str):
+    return models.Movie.id.in_(select(models.MovieGenre.movie_id).where(models.MovieGenre.genre == catalog.normalize_name(genre)))
+
+def filter_movies(query, filters: schemas.MovieFilter):
+    """Adds the conditions of the set filters, each one has an index to start from"""
+    movie = models.Movie
+    if filters.genre:
+        query = query.where(_has_genre(filters.genre))
+    if filters.cast:
+        query = query.where(movie.id.in_(select(models.MovieCast.movie_id).where(models.MovieCast.name == catalog.normalize_name(filters.cast))))
+    if filters.language:
+        query = query.where(func.lower(movie.language) == filters.language.strip().lower())
+    if filters.director:
+        query = query.where(func.lower(movie.director) == filters.director.strip().lower())
+    if filters.year_from is not None:
+        query = query.where(movie.year_released >= filters.year_from)
+    if filters.year_to is not None:
+        query = query.where(movie.year_released <= filters.year_to)
+    if filters.runtime_min is not None:
+        query = query.where(movie.runtime_minutes >= filters.runtime_min)
+    if filters.runtime_max is not None:
+        query = query.where(movie.runtime_minutes <= filters.runtime_max)
+    return query
+
+def get_movie_rows(
+    db: Session, skip: int = 0, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+    filters: Optional[schemas.MovieFilter] = None, sort: str = "created",
+):
+    query = _movie_rows()
+    if filters is not None:
+        query = filter_movies(query, filters)
+    columns, descending = MOVIE_SORTS[sort]
+    if sort.endswith("rating"):
+        query = query.add_columns(RATING_SCORE).outerjoin(models.MovieScore, models.MovieScore.movie_id == models.Movie.id)
+    elif sort.endswith("year"):
+        query = query.add_columns(YEAR_KEY)
+    return db.execute(keyset(query, cursor, limit, *columns, descending=descending).offset(skip)).all()
+
+def get_user_movie_rows(db: Session, user_id: int, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
+    query = _movie_rows().where(models.Movie.owner_id == user_id)
+    return db.execute(keyset(query, cursor, limit, *MOVIE_ORDER)).all()
+
+def search_movie_rows(db: Session, query: str, skip: int = 0, limit: int = 10):
+    if not search.tokenize(query):
+        return get_movie_rows(db, skip=skip, limit=limit)
+    return get_movie_rows_by_id(db, search.get_backend().search(db, query, skip=skip, limit=limit))
+
+def get_movie_rows_by_id(db: Session, movie_ids: List[int]):
+    """The rows of the movies in the order of the ids, missing movies are left out"""
+    if not movie_ids:
+        return []
+    movies = {row.id: row for row in db.execute(_movie_rows().where(models.Movie.id.in_(movie_ids)))}
+    return [movies[movie_id] for movie_id in movie_ids if movie_id in movies]
+
+def _leaderboard_rows(score, limit: int, genre: Optional[str], year: Optional[int]):
+    query = _movie_rows().add_columns(score.label("score")).join(models.MovieScore, models.MovieScore.movie_id == models.Movie.id)
+    if genre:
+        query = query.where(_has_genre(genre))
+    if year is not None:
+        query = query.where(models.Movie.year_released == year)
+    # Walks the score index and stops at limit matching movies
+    return query.order_by(score.desc(), models.Movie.id).limit(limit)
+
+def get_top_movie_rows(db: Session, limit: int = DEFAULT_PAGE_SIZE, genre: Optional[str] = None, year: Optional[int] = None):
+    query = _leaderboard_rows(models.MovieScore.top, limit, genre, year).where(models.MovieRatingStats.count > 0)
+    return db.execute(query).all()
+
+def get_trending_movie_rows(db: Session, limit: int = DEFAULT_PAGE_SIZE, genre: Optional[str] = None, year: Optional[int] = None):
+    query = _leaderboard_rows(models.MovieScore.trending, limit, genre, year).where(models.MovieScore.trending > 0)
+    # The epoch the scores are relative to, read in the same statement
+    epoch = select(models.LeaderboardClock.epoch).where(models.LeaderboardClock.id == leaderboard.CLOCK_ID).scalar_subquery()
+    return db.execute(query.add_columns(epoch.label("epoch"))).all()
+
+# Batch reads, one query per part of the response whatever the number of movies
+MOVIE_COLUMNS = (
+    *(getattr(models.Movie, field) for field in schemas.MovieBase.model_fields),
+    models.Movie.id, models.Movie.owner_id, models.Movie.time_created,
+)
+STATS_COLUMNS = (
+    models.MovieRatingStats.movie_id, models.MovieRatingStats.count, models.MovieRatingStats.sum,
+    *(getattr(models.MovieRatingStats, f"stars_{stars}") for stars in range(6)),
+)
+
+def get_movie_batch(db: Session, movie_ids: List[int], include: List[str] = (), comments_per_movie: int = 3) -> dict:
+    """
+    The rows of the movies, in the order of the ids, and of what is included:
+    the owners by user id, the rating aggregates and the latest comments by movie id
+    """
+    rows = {row.id: row for row in db.execute(select(*MOVIE_COLUMNS).where(models.Movie.id.in_(movie_ids)))}
+    batch = {"movies": [rows[movie_id] for movie_id in movie_ids if movie_id in rows], "missing": [movie_id for movie_id in movie_ids if movie_id not in rows]}
+    found = [row.id for row in batch["movies"]]
+    if "owner" in include:
+        owner_ids = {row.owner_id for row in batch["movies"]}
+        batch["owners"] = {row.id: row for row in db.execute(select(*USER_COLUMNS).where(models.User.id.in_(owner_ids)))} if owner_ids else {}
+    if "rating_stats" in include:
+        batch["rating_stats"] = {row.movie_id: row for row in db.execute(select(*STATS_COLUMNS).where(models.MovieRatingStats.movie_id.in_(found)))} if found else {}
+    if "latest_comments" in include:
+        batch["latest_comments"] = {}
+        if found:
+            # The first comments_per_movie of each movie in one query, newest first
+            position = func.row_number().over(partition_by=models.Comment.movie_id, order_by=(models.Comment.time_created.desc(), models.Comment.id.desc()))
+            ranked = (
+                select(*COMMENT_ROW, position.label("position"))
+                .join(models.User, models.Comment.user_id == models.User.id)
+                .where(models.Comment.movie_id.in_(found))
+                .subquery()
+            )
+            latest = select(*list(ranked.c)[:-1]).where(ranked.c.position <= comments_per_movie).order_by(ranked.c.movie_id, ranked.c.position)
+            for row in db.execute(latest):
+                batch["latest_comments"].setdefault(row.movie_id, []).append(row)
+    return batch
+
+def get_rating_rows(db: Session, movie_id: int, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
+    query = select(*RATING_ROW).join(models.User, models.Rating.user_id == models.User.id).where(models.Rating.movie_id == movie_id)
+    return db.execute(keyset(query, cursor, limit, *RATING_ORDER)).all()
+
+def get_comment_rows(db: Session, movie_id: int, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, since: Optional[datetime] = None):
+    query = select(*COMMENT_ROW).join(models.User, models.Comment.user_id == models.User.id).where(models.Comment.movie_id == movie_id)
+    if since is not None:
+        # Timestamps are stored in UTC, a naive since is taken as UTC too
+        since = since.astimezone(timezone.utc) if since.tzinfo else since.replace(tzinfo=timezone.utc)
+        query = query.where(models.Comment.time_created > since)
+    return db.execute(keyset(query, cursor, limit, *COMMENT_ORDER)).all()
+
+
+def add_to_rating_stats(db: Session, movie_id: int, *ratings: float):
+    stats = models.MovieRatingStats
+    values = {stats.count: stats.count + len(ratings), stats.sum: stats.sum + sum(ratings)}
+    for value in {int(rating) for rating in ratings}:
+        stars = getattr(stats, f"stars_{value}")
+        values[stars] = stars + sum(1 for rating in ratings if int(rating) == value)
+    updated = db.query(stats).filter(stats.movie_id == movie_id).update(values, synchronize_session=False)
+    if not updated:
+        # Movie created before the aggregates existed
+        _rebuild_rating_stats(db, movie_id=movie_id)
+
+def _rebuild_rating_stats(db: Session, movie_id: Optional[int] = None):
+    stats = models.MovieRatingStats
+    stars = cast(models.Rating.rating, Integer)
+    aggregate = (
+        select(
+            models.Movie.id,
+            func.count(models.Rating.id),
+            func.coalesce(func.sum(models.Rating.rating), 0),
+            *(func.sum(case((stars == value, 1), else_=0)) for value in range(6)),
+        )
+        .outerjoin(models.Rating, models.Rating.movie_id == models.Movie.id)
+        .group_by(models.Movie.id)
+    )
+    existing = db.query(stats)
+    if movie_id is not None:
+        aggregate = aggregate.where(models.Movie.id == movie_id)
+        existing = existing.filter(stats.movie_id == movie_id)
+    existing.delete(synchronize_session=False)
+    columns = [stats.movie_id, stats.count, stats.sum] + [getattr(stats, f"stars_{value}") for value in range(6)]
+    db.execute(insert(stats).from_select(columns, aggregate))
+
+# Repair job: recompute the rating aggregates of one or all movies from the ratings table,
+# and the top rated scores that derive from them
+def rebuild_rating_stats(db: Session, movie_id: Optional[int] = None):
+    _rebuild_rating_stats(db, movie_id=movie_id)
+    if movie_id is not None:
+        leaderboard.record(db, movie_id, 0.0)
+    # Usually run from another process than the API's
+    response_cache.bump_stored_generation(db)
+    db.commit()
+    if movie_id is None:
+        leaderboard.compact(db)
+        response_cache.invalidate_all()
+    else:
+        response_cache.bump(response_cache.movie(movie_id), response_cache.MOVIES)
@@ -0,0 +1,99 @@
+# crud_async.py
+"""
+Awaitable versions of the functions in crud.py, used by the request handlers.
+With an AsyncSession (DB_MODE=async) the crud function runs on the asyncio
+connection through AsyncSession.run_sync, with a blocking Session (DB_MODE=sync)
+it runs in the threadpool so the event loop is never blocked.
+"""
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud, profiling, schemas
+from database import DBSession
+from pagination import DEFAULT_PAGE_SIZE
+
+
+async def run(db: DBSession, fn, *args, **kwargs):
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(profiling.traced(fn), db, *args, **kwargs)
+
+
+async def ping(db: DBSession):
+    return await run(db, crud.ping)
+
+async def create_user(db: DBSession, user: schemas.UserCreate, hashed_password: str):
+    return await run(db, crud.create_user, user=user, hashed_password=hashed_password)
+
+async def find_registration_conflict(db: DBSession, username: str, email: str) -> Optional[str]:
+    return await run(db, crud.find_registration_conflict, username=username, email=email)
+
+async def update_user_password(db: DBSession, user_id: int, hashed_password: str):
+    return await run(db, crud.update_user_password, user_id=user_id, hashed_password=hashed_password)
+
+async def get_user_by_id(db: DBSession, user_id: int):
+    return await run(db, crud.get_user_by_id, user_id=user_id)
+
+async def get_user_by_username(db: DBSession, username: str):
+    return await run(db, crud.get_user_by_username, username=username)
+
+async def create_movie(db: DBSession, movie: schemas.MovieCreate, user_id: int):
+    return await run(db, crud.create_movie, movie=movie, user_id=user_id)
+
+async def create_movies(db: DBSession, movies: List[schemas.MovieCreate], user_id: int) -> List[int]:
+    return await run(db, crud.create_movies, movies=movies, user_id=user_id)
+
+async def get_movie_by_id(db: DBSession, movie_id: int, with_relations: bool = False):
+    return await run(db, crud.get_movie_by_id, movie_id=movie_id, with_relations=with_relations)
+
+async def update_movie(db: DBSession, movie_id: int, movie: schemas.MovieUpdate, user_id: int):
+    return await run(db, crud.update_movie, movie_id=movie_id, movie=movie, user_id=user_id)
+
+async def delete_movie(db: DBSession, movie_id: int, user_id: int):
+    return await run(db, crud.delete_movie, movie_id=movie_id, user_id=user_id)
+
+async def create_comment(db: DBSession, comment: schemas.CommentCreate, movie_id: int, user_id: int, author: Optional[schemas.CurrentUser] = None):
+    return await run(db, crud.create_comment, comment=comment, movie_id=movie_id, user_id=user_id, author=author)
+
+async def get_comment_by_id(db: DBSession, comment_id: int):
+    return await run(db, crud.get_comment_by_id, comment_id=comment_id)
+
+async def delete_comment(db: DBSession, comment_id: int, user_id: int):
+    return await run(db, crud.delete_comment, comment_id=comment_id, user_id=user_id)
+
+async def create_rating(db: DBSession, rating: schemas.RatingCreate, movie_id: int, user_id: int):
+    return await run(db, crud.create_rating, rating=rating, movie_id=movie_id, user_id=user_id)
+
+async def get_movie_rows(
+    db: DBSession, skip: int = 0, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+    filters: Optional[schemas.MovieFilter] = None, sort: str = "created",
+):
+    return await run(db, crud.get_movie_rows, skip=skip, limit=limit, cursor=cursor, filters=filters, sort=sort)
+
+async def get_user_movie_rows(db: DBSession, user_id: int, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
+    return await run(db, crud.get_user_movie_rows, user_id=user_id, limit=limit, cursor=cursor)
+
+async def search_movie_rows(db: DBSession, query: str, skip: int = 0, limit: int = 10):
+    return await run(db, crud.search_movie_rows, query=query, skip=skip, limit=limit)
+
+async def get_movie_rows_by_id(db: DBSession, movie_ids: List[int]):
+    return await run(db, crud.get_movie_rows_by_id, movie_ids=movie_ids)
+
+async def get_top_movie_rows(db: DBSession, limit: int = DEFAULT_PAGE_SIZE, genre: Optional[str] = None, year: Optional[int] = None):
+    return await run(db, crud.get_top_movie_rows, limit=limit, genre=genre, year=year)
+
+async def get_trending_movie_rows(db: DBSession, limit: int = DEFAULT_PAGE_SIZE, genre: Optional[str] = None, year: Optional[int] = None):
+    return await run(db, crud.get_trending_movie_rows, limit=limit, genre=genre, year=year)
+
+async def get_movie_batch(db: DBSession, movie_ids: List[int], include: List[str] = (), comments_per_movie: int = 3) -> dict:
+    return await run(db, crud.get_movie_batch, movie_ids=movie_ids, include=include, comments_per_movie=comments_per_movie)
+
+async def get_rating_rows(db: DBSession, movie_id: int, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None):
+    return await run(db, crud.get_rating_rows, movie_id=movie_id, limit=limit, cursor=cursor)
+
+async def get_comment_rows(db: DBSession, movie_id: int, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, since: Optional[datetime] = None):
+    return await run(db, crud.get_comment_rows, movie_id=movie_id, limit=limit, cursor=cursor, since=since)
+
@@ -1,26 +1,208 @@
 #database.py
 import os
+import threading
+import time
+from itertools import cycle
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from typing import Union
+import metrics
 
 load_dotenv()
 
-#SQLALCHEMY_DATABASE_URL = os.environ.get('DB_URL')
-SQLALCHEMY_DATABASE_URL = "sqlite:///./moviestore_db1"
+SQLALCHEMY_DATABASE_URL = os.environ.get('DB_URL', "sqlite:///./moviestore_db1")
+# Comma separated URLs of read replicas, the GET endpoints are served from them
+DB_REPLICA_URLS = [url.strip() for url in os.environ.get('DB_REPLICA_URLS', '').split(',') if url.strip()]
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# Server side limit of a single statement (PostgreSQL), 0 means no limit
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+# How long SQLite waits for the write lock before giving up
+DB_SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('DB_SQLITE_BUSY_TIMEOUT_MS', 5000))
+# How long the readiness check waits for the database
+DB_READY_TIMEOUT_SECONDS = float(os.environ.get('DB_READY_TIMEOUT_SECONDS', 2))
+
+
+def _is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run while a write is in progress instead of queueing behind it
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={DB_SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.close()
+
+def _timed_pool_class(url: str, name: str):
+    """The dialect's default pool class, reporting how long each checkout waited for a connection"""
+    sa_url = make_url(url)
+    pool_class = sa_url.get_dialect().get_pool_class(sa_url)
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return pool_class.connect(self)
+        finally:
+            metrics.POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started, pool=name)
+
+    return type(f"Timed{pool_class.__name__}", (pool_class,), {"connect": connect})
+
+def engine_options(url: str, name: str = "primary") -> dict:
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "poolclass": _timed_pool_class(url, name)}
+    if _is_sqlite(url):
+        # SQLite picks its own pool class, not all of them take a size
+        return options
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+    if DB_STATEMENT_TIMEOUT_MS:
+        if "+asyncpg" in url:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+def create_db_engine(url: str, name: str = "primary"):
+    db_engine = create_engine(url, **engine_options(url, name))
+    if _is_sqlite(url):
+        event.listen(db_engine, "connect", _set_sqlite_pragmas)
+    metrics.watch_pool(name, db_engine)
+    return db_engine
+
+
+# The engines are built on first use, importing the app doesn't touch the database
+_engines = {}
+_engines_lock = threading.RLock()
+
+def _cached(key: str, build):
+    if key not in _engines:
+        with _engines_lock:
+            if key not in _engines:
+                _engines[key] = build()
+    return _engines[key]
+
+def get_engine():
+    return _cached("primary", lambda: create_db_engine(SQLALCHEMY_DATABASE_URL))
+
+def get_replica_engines() -> list:
+    return _cached("replicas", lambda: [create_db_engine(url, f"replica{index}") for index, url in enumerate(DB_REPLICA_URLS)])
+
+class LazySession(Session):
+    """Bound to the primary engine unless given another bind"""
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(bind=bind if bind is not None else get_engine(), **kwargs)
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, class_=LazySession)
+
+def dispose_engines():
+    """Closes the pooled connections and forgets the engines, e.g. before forking workers"""
+    with _engines_lock:
+        built = [_engines.get("primary"), *_engines.get("replicas", [])]
+        _engines.clear()
+    for db_engine in built:
+        if db_engine is not None:
+            db_engine.dispose()
+
+def _read_sessions():
+    # Reads rotate over the replicas, or use the primary when there are none
+    return _cached("read_sessions", lambda: cycle(
+        [sessionmaker(autocommit=False, autoflush=False, bind=replica) for replica in get_replica_engines()] or [SessionLocal]
+    ))
+
+# DB_MODE=async serves the requests from an asyncio engine and AsyncSession,
+# DB_MODE=sync (default) from the blocking engine above
+DB_MODE = os.environ.get("DB_MODE", "sync")
+if DB_MODE not in ("sync", "async"):
+    raise ValueError(f"DB_MODE must be 'sync' or 'async', not {DB_MODE!r}")
+
+# asyncio drivers of the dialects we run on
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def get_async_url(url: str) -> str:
+    dialect, rest = url.split("://", 1)
+    return f"{ASYNC_DRIVERS.get(dialect.split('+')[0], dialect)}://{rest}"
+
+def create_async_db_engine(url: str, name: str = "primary-async"):
+    async_url = get_async_url(url)
+    db_engine = create_async_engine(async_url, **engine_options(async_url, name))
+    if _is_sqlite(url):
+        event.listen(db_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    metrics.watch_pool(name, db_engine.sync_engine)
+    return db_engine
+
+def _async_sessionmaker(db_engine=None, **kwargs):
+    # Objects stay loaded after a commit, an expired attribute can't be lazy-loaded outside the session's greenlet
+    return async_sessionmaker(db_engine, autoflush=False, expire_on_commit=False, **kwargs)
+
+def get_async_engine():
+    return _cached("primary-async", lambda: create_async_db_engine(SQLALCHEMY_DATABASE_URL))
+
+def get_async_replica_engines() -> list:
+    return _cached("replicas-async", lambda: [create_async_db_engine(url, f"replica{index}-async") for index, url in enumerate(DB_REPLICA_URLS)])
+
+class LazyAsyncSession(AsyncSession):
+    """Bound to the primary asyncio engine unless given another bind"""
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(bind=bind if bind is not None else get_async_engine(), **kwargs)
+
+AsyncSessionLocal = _async_sessionmaker(class_=LazyAsyncSession) if DB_MODE == "async" else None
+
+def _async_read_sessions():
+    return _cached("read_sessions-async", lambda: cycle(
+        [_async_sessionmaker(replica) for replica in get_async_replica_engines()] or [AsyncSessionLocal]
+    ))
+
+# engine, replica_engines and async_engine were module attributes before the engines were lazy
+def __getattr__(name: str):
+    if name == "engine":
+        return get_engine()
+    if name == "replica_engines":
+        return get_replica_engines()
+    if name == "async_engine":
+        return get_async_engine() if DB_MODE == "async" else None
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 Base = declarative_base()
 
-# Dependency
-def get_db():
-    db = SessionLocal()
+# What the get_db dependency yields
+DBSession = Union[Session, AsyncSession]
+
+async def _close(db: DBSession):
+    if isinstance(db, AsyncSession):
+        await db.close()
+    else:
+        db.close()
+
+# Dependency, a Session or an AsyncSession depending on DB_MODE
+async def get_db():
+    db = AsyncSessionLocal() if AsyncSessionLocal is not None else SessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await _close(db)
+
+# A new session on a read replica when there are some, for work that outlives
+# the request dependencies, such as a streamed response
+def read_session() -> DBSession:
+    return next(_async_read_sessions())() if AsyncSessionLocal is not None else next(_read_sessions())()
+
+# Dependency of the read only endpoints, bound to a read replica when there are some
+async def get_read_db():
+    db = read_session()
+    try:
+        yield db
+    finally:
+        await _close(db)
@@ -0,0 +1,119 @@
+# fast_json.py
+"""
+Serialization of the list responses straight from the projected rows of
+crud.get_*_rows. The rows come from our own database, so they are not validated
+again: each one is shaped into the dict of its schema, fields in the same order,
+and the whole list is encoded by orjson in one call. The rows are unpacked by
+position, in the column order of crud.MOVIE_ROW, RATING_ROW and COMMENT_ROW,
+which is several times faster than reading them by name. The positions of the
+movie columns are looked up by name once, when crud binds MOVIE_ROW. The output is the
+same JSON the pydantic TypeAdapters produce, schemas.Movie, schemas.Rating and
+schemas.Comment stay the documented response models.
+"""
+from operator import itemgetter
+from typing import Dict, Iterable, List
+
+import orjson
+
+import schemas
+
+
+# Datetimes with a UTC offset end with "Z", as pydantic writes them
+OPTIONS = orjson.OPT_UTC_Z
+
+_MOVIE_FIELDS = tuple(schemas.MovieBase.model_fields)
+_MOVIE_FIELD_COUNT = len(_MOVIE_FIELDS)
+# The keys of the columns of MOVIE_ROW read after the MovieBase fields
+_MOVIE_TAIL = (
+    "id", "owner_id", "time_created", "owner_username", "owner_full_name", "owner_email",
+    "stats_count", "stats_sum", *(f"stars_{stars}" for stars in range(6)),
+)
+_movie_values = None
+
+
+def bind_movie_row(columns):
+    """Finds the columns movie() reads among those of crud.MOVIE_ROW, a missing one raises ValueError"""
+    global _movie_values
+    keys = [column.key for column in columns]
+    _movie_values = itemgetter(*(keys.index(key) for key in (*_MOVIE_FIELDS, *_MOVIE_TAIL)))
+
+
+def movie(row) -> dict:
+    values = _movie_values(row)
+    data = dict(zip(_MOVIE_FIELDS, values))
+    movie_id, owner_id, time_created, username, full_name, email, count, total, *histogram = values[_MOVIE_FIELD_COUNT:]
+    data["id"] = movie_id
+    data["owner_id"] = owner_id
+    data["time_created"] = time_created
+    data["owner"] = {"id": owner_id, "username": username, "full_name": full_name, "email": email}
+    # Movies created before the stats table existed may have no stats row yet
+    data["rating_stats"] = None if count is None else rating_stats(count, total, histogram)
+    return data
+
+
+def rating_stats(count: int, total: float, histogram: list) -> dict:
+    total = float(total)
+    return {"count": count, "sum": total, "average": total / count if count else None, "histogram": list(histogram)}
+
+
+def rating(row) -> dict:
+    value, rating_id, movie_id, user_id, username, full_name = row
+    return {
+        "rating": float(value),
+        "id": rating_id,
+        "movie_id": movie_id,
+        "created_by": {"id": user_id, "username": username, "full_name": full_name},
+    }
+
+
+def comment(row) -> dict:
+    text, comment_id, movie_id, time_created, user_id, username, full_name = row
+    return {
+        "comment": text,
+        "id": comment_id,
+        "movie_id": movie_id,
+        "time_created": time_created,
+        "posted_by": {"id": user_id, "username": username, "full_name": full_name},
+    }
+
+
+def scored_movies(rows: Iterable, scores: Dict[int, float]) -> bytes:
+    return dumps([dict(movie(row), score=scores[row.id]) for row in rows])
+
+
+def movie_batch(batch: dict) -> bytes:
+    """The rows of crud.get_movie_batch as a schemas.MovieBatch, without the parts that were not included"""
+    owners, stats, comments = batch.get("owners"), batch.get("rating_stats"), batch.get("latest_comments")
+    movies = []
+    for row in batch["movies"]:
+        data = dict(zip(_MOVIE_FIELDS, row))
+        movie_id, owner_id, time_created = row[_MOVIE_FIELD_COUNT:]
+        data["id"] = movie_id
+        data["owner_id"] = owner_id
+        data["time_created"] = time_created
+        if owners is not None:
+            owner = owners.get(owner_id)
+            data["owner"] = owner and {"id": owner.id, "username": owner.username, "full_name": owner.full_name, "email": owner.email}
+        if stats is not None:
+            aggregate = stats.get(movie_id)
+            data["rating_stats"] = aggregate and rating_stats(aggregate[1], aggregate[2], aggregate[3:])
+        if comments is not None:
+            data["latest_comments"] = [comment(row) for row in comments.get(movie_id, ())]
+        movies.append(data)
+    return orjson.dumps({"movies": movies, "missing": batch["missing"]}, option=OPTIONS)
+
+
+def dumps(items: List[dict]) -> bytes:
+    return orjson.dumps(items, option=OPTIONS)
+
+
+def movies(rows: Iterable) -> bytes:
+    return dumps([movie(row) for row in rows])
+
+
+def ratings(rows: Iterable) -> bytes:
+    return dumps([rating(row) for row in rows])
+
+
+def comments(rows: Iterable) -> bytes:
+    return dumps([comment(row) for row in rows])
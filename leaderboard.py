@@ -0,0 +1,179 @@
+# leaderboard.py
+"""
+Scores of the top rated and trending leaderboards, kept in the indexed
+movie_scores table and updated by every new rating and comment, so reading a
+leaderboard is an index scan instead of an aggregate over all the ratings.
+
+The top score is the Bayesian average of the ratings: the average pulled
+towards TOP_PRIOR_RATING as if every movie had TOP_PRIOR_COUNT more ratings.
+
+The trending score is the activity of the movie decayed exponentially, halved
+every TRENDING_HALF_LIFE_HOURS. Decaying every row all the time is not needed:
+an event at time t adds exp((t - epoch) / tau), so newer events weigh more, and
+since every score shares the same decay the stored values sort like the decayed
+ones. compact(), run every LEADERBOARD_COMPACT_SECONDS, moves the epoch to now
+and rescales the scores before they grow too large for floats, in a new
+generation. A write made with the epoch of an older generation matches no row
+and is retried with the current one. The compaction also adds the rated movies
+that have no scores yet, such as the ones rated before this table existed.
+"""
+import math
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import case, exists, func, insert, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+
+
+TOP_PRIOR_RATING = float(os.environ.get("TOP_PRIOR_RATING", 2.5))
+TOP_PRIOR_COUNT = float(os.environ.get("TOP_PRIOR_COUNT", 5))
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", 24))
+TRENDING_RATING_WEIGHT = float(os.environ.get("TRENDING_RATING_WEIGHT", 1.0))
+TRENDING_COMMENT_WEIGHT = float(os.environ.get("TRENDING_COMMENT_WEIGHT", 0.5))
+LEADERBOARD_COMPACT_SECONDS = float(os.environ.get("LEADERBOARD_COMPACT_SECONDS", 600))
+# Decayed scores below this are reset to 0 by the compaction, and leave the trending list
+TRENDING_FLOOR = float(os.environ.get("TRENDING_FLOOR", 0.01))
+
+_TAU = TRENDING_HALF_LIFE_HOURS * 3600 / math.log(2)
+CLOCK_ID = 1
+
+# The (generation, epoch) last read from leaderboard_clock
+_clock: Optional[Tuple[int, float]] = None
+_lock = threading.Lock()
+
+
+def init(engine):
+    """Creates the clock row of a new database"""
+    with Session(engine) as db:
+        if db.get(models.LeaderboardClock, CLOCK_ID) is None:
+            db.add(models.LeaderboardClock(id=CLOCK_ID, generation=0, epoch=time.time()))
+            try:
+                db.commit()
+            except IntegrityError:
+                # Created by another worker in the meantime
+                db.rollback()
+
+
+def clock(db: Session, reload: bool = False) -> Tuple[int, float]:
+    global _clock
+    if _clock is not None and not reload:
+        return _clock
+    row = db.execute(select(models.LeaderboardClock.generation, models.LeaderboardClock.epoch).where(models.LeaderboardClock.id == CLOCK_ID)).one()
+    with _lock:
+        _clock = (row.generation, row.epoch)
+    return _clock
+
+
+def _current(generation: int):
+    return exists().where(models.LeaderboardClock.id == CLOCK_ID, models.LeaderboardClock.generation == generation)
+
+
+def decayed(score: float, epoch: float, now: Optional[float] = None) -> float:
+    """A stored trending score as of now, in events"""
+    return score * math.exp(-((now or time.time()) - epoch) / _TAU)
+
+
+def _top_score():
+    stats = models.MovieRatingStats
+    return (stats.sum + TOP_PRIOR_RATING * TOP_PRIOR_COUNT) / (stats.count + TOP_PRIOR_COUNT)
+
+
+def _upsert(db: Session):
+    return (postgresql if db.get_bind().dialect.name == "postgresql" else sqlite).insert(models.MovieScore)
+
+
+def record(db: Session, movie_id: int, activity: float):
+    """
+    Adds a rating or comment of the movie to its scores, in the caller's
+    transaction. One INSERT ... ON CONFLICT DO UPDATE that also creates the row
+    on the first activity of the movie
+    """
+    scores, stats = models.MovieScore, models.MovieRatingStats
+    for attempt in range(2):
+        generation, epoch = clock(db, reload=attempt > 0)
+        weight = activity * math.exp((time.time() - epoch) / _TAU)
+        values = (
+            select(models.Movie.id, func.coalesce(_top_score(), TOP_PRIOR_RATING), literal(weight), literal(generation))
+            .select_from(models.Movie)
+            .outerjoin(stats, stats.movie_id == models.Movie.id)
+            .where(models.Movie.id == movie_id, _current(generation))
+        )
+        statement = _upsert(db).from_select(["movie_id", "top", "trending", "generation"], values)
+        # A row left behind in an older generation is still updated, one of a newer generation means our clock is stale
+        statement = statement.on_conflict_do_update(
+            index_elements=[scores.movie_id],
+            set_={"top": statement.excluded.top, "trending": scores.trending + statement.excluded.trending},
+            where=scores.generation <= generation,
+        )
+        if db.execute(statement).rowcount:
+            return
+    logger.warning("Scores of movie {} not updated, the leaderboard clock moved twice", movie_id)
+
+
+def compact(db: Session) -> bool:
+    """
+    Starts a new generation: rescales the trending scores to an epoch of now,
+    drops the faded ones and recomputes the top scores from the rating
+    aggregates. Returns False when another worker compacted first
+    """
+    global _clock
+    generation, epoch = clock(db, reload=True)
+    now = time.time()
+    moved = db.execute(
+        update(models.LeaderboardClock)
+        .where(models.LeaderboardClock.id == CLOCK_ID, models.LeaderboardClock.generation == generation)
+        .values(generation=generation + 1, epoch=now)
+    ).rowcount
+    if not moved:
+        db.rollback()
+        clock(db, reload=True)
+        return False
+    scores, stats = models.MovieScore, models.MovieRatingStats
+    rescaled = scores.trending * math.exp(-(now - epoch) / _TAU)
+    top = select(_top_score()).where(stats.movie_id == scores.movie_id).scalar_subquery()
+    db.execute(
+        update(scores).values(
+            trending=case((rescaled < TRENDING_FLOOR, 0.0), else_=rescaled),
+            top=func.coalesce(top, TOP_PRIOR_RATING),
+            generation=generation + 1,
+        )
+    )
+    missing = (
+        select(stats.movie_id, _top_score(), literal(0.0), literal(generation + 1))
+        .where(stats.count > 0, ~exists().where(scores.movie_id == stats.movie_id))
+    )
+    db.execute(insert(scores).from_select(["movie_id", "top", "trending", "generation"], missing))
+    db.commit()
+    with _lock:
+        _clock = (generation + 1, now)
+    return True
+
+
+def _compact_forever(stop: threading.Event):
+    while not stop.wait(LEADERBOARD_COMPACT_SECONDS):
+        try:
+            with SessionLocal() as db:
+                compact(db)
+        except Exception:
+            logger.exception("Compacting the leaderboard scores failed")
+
+
+_stop = threading.Event()
+
+
+def start():
+    _stop.clear()
+    if LEADERBOARD_COMPACT_SECONDS > 0:
+        threading.Thread(target=_compact_forever, args=(_stop,), name="leaderboard-compact", daemon=True).start()
+
+
+def stop():
+    _stop.set()
@@ -0,0 +1,89 @@
+# logs.py
+"""
+Logging setup of the API. Every sink is enqueued: the request thread only puts
+the record on a queue and a background thread does the writing, so slow disk
+I/O never shows up in the response times. app.log gets a JSON object per line.
+Info and debug lines are sampled per route, LOG_SAMPLE_RATE keeps that share
+of the requests (all of their lines) and LOG_ROUTE_SAMPLE_RATES overrides it
+per route, e.g. "GET /movies/{movie_id}=0.01,GET /movies/=0.1". Warnings and
+errors are always kept.
+Log calls pass their arguments separately, logger.info("... {}", value), so no
+string is built for a level that no sink takes.
+"""
+import os
+import random
+import sys
+from typing import Dict, Optional
+
+from loguru import logger
+from starlette.routing import Match
+
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+LOG_ROTATION = os.environ.get("LOG_ROTATION", "500 MB")
+LOG_STDERR = os.environ.get("LOG_STDERR", "true").lower() in ("1", "true", "yes")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    rates = {}
+    for item in value.split(","):
+        if item.strip():
+            route, _, rate = item.rpartition("=")
+            rates[route.strip()] = float(rate)
+    return rates
+
+
+LOG_ROUTE_SAMPLE_RATES = parse_sample_rates(os.environ.get("LOG_ROUTE_SAMPLE_RATES", ""))
+
+# Levels below this one are subject to sampling
+SAMPLED_BELOW = logger.level("WARNING").no
+
+
+def sample_rate(route: str) -> float:
+    return LOG_ROUTE_SAMPLE_RATES.get(route, LOG_SAMPLE_RATE)
+
+
+def sample_filter(record) -> bool:
+    return record["level"].no >= SAMPLED_BELOW or record["extra"].get("sampled", True)
+
+
+def setup(log_file: Optional[str] = LOG_FILE, level: str = LOG_LEVEL):
+    """Replaces loguru's default synchronous stderr sink with the enqueued ones"""
+    logger.remove()
+    if LOG_STDERR:
+        logger.add(sys.stderr, level=level, filter=sample_filter, enqueue=True)
+    if log_file:
+        logger.add(log_file, level=level, filter=sample_filter, rotation=LOG_ROTATION, serialize=True, enqueue=True)
+
+
+def route_name(app, scope) -> str:
+    """The route template of a request, as in "GET /movies/{movie_id}", looked up once per request"""
+    if "route_name" not in scope:
+        scope["route_name"] = f"{scope['method']} unmatched"
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                scope["route_name"] = f"{scope['method']} {route.path}"
+                break
+    return scope["route_name"]
+
+
+class LogContextMiddleware:
+    """Tags the log lines of a request with its route and whether it is sampled"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = route_name(scope["app"], scope)
+        with logger.contextualize(route=route, sampled=random.random() < sample_rate(route)):
+            await self.app(scope, receive, send)
+
+
+def flush():
+    """Waits for the queued lines to be written"""
+    logger.complete()
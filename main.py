@@ -1,238 +1,451 @@
 # main.py
-from fastapi import FastAPI, Depends, HTTPException, Response, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
-from auth import pwd_context, authenticate_user, create_access_token, get_current_user
+from auth import authenticate_user, create_access_token, get_current_user
+from datetime import datetime
 from typing import List, Optional
-from database import engine, Base, get_db
-import crud, models, schemas, auth
+from database import DB_READY_TIMEOUT_SECONDS, DBSession, get_db, get_read_db
+import broadcast, bulk, comment_feed, crud, crud_async, fast_json, leaderboard, logs, metrics, models, profiling, recommend, schemas, auth, passwords, ratelimit, response_cache, startup, user_cache, write_behind
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, cursor_headers, next_cursor, tail_headers
 from loguru import logger
 from pathlib import Path
+from pydantic import TypeAdapter
+import asyncio
+import orjson
+import os
 
 
-logger.add("app.log", rotation="500 MB", level="DEBUG")
+# Initialize FastAPI app, the schema, the workers and the log sinks are set up by its lifespan, see startup.py
+# GET requests wait for the queued writes of their author, see write_behind.py
+app = FastAPI(lifespan=startup.lifespan, dependencies=[Depends(write_behind.read_your_writes)])
+# Innermost, so its 429 and 503 answers are logged and measured like the others
+app.add_middleware(ratelimit.RateLimitMiddleware)
+app.add_middleware(logs.LogContextMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware)
 
+metrics.Stats("password_pool", "bcrypt operations", passwords.stats, counters=("completed", "rejected"))
+metrics.Stats("user_cache", "Cache of the authenticated users", user_cache.stats, counters=("hits", "misses", "invalidations"))
+metrics.Stats("response_cache", "Cache of the GET responses", response_cache.cache.stats, counters=("hits", "misses", "not_modified", "evictions"))
+metrics.Stats("recommend", "Item similarity model", recommend.model.stats, counters=("builds", "refreshes"))
+metrics.Stats("write_behind", "Write-behind queue", lambda: write_behind.writer.stats() if write_behind.writer is not None else {}, counters=("batches", "committed", "failed", "rejected"))
+metrics.Stats("rate_limit", "Rate limiting and admission control", ratelimit.stats, counters=("limited", "shed"))
+metrics.Stats("comment_feed", "Live comment streams", comment_feed.broker.stats, counters=("published", "dropped"))
+metrics.Stats("broadcast", "Messages between the workers", lambda: broadcast.channel.stats() if broadcast.channel is not None else {}, counters=("sent", "received", "dropped"))
 
-Base.metadata.create_all(bind=engine)
+# Serializer of a single movie, the lists are serialized from rows by fast_json
+MOVIE = TypeAdapter(schemas.Movie)
 
-# Initialize FastAPI app
-app = FastAPI() 
+def dump_movie(movie) -> bytes:
+    return MOVIE.dump_json(MOVIE.validate_python(movie, from_attributes=True))
+
+def json_response(body: bytes, headers: Optional[dict] = None) -> Response:
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message":"WELCOME TO MY APP OF MOVIES"}
 
 
+# Health checks of the load balancer and the orchestrator
+@app.get("/health", include_in_schema=False)
+async def health():
+    """The worker is up"""
+    return {"status": "ok", "pid": os.getpid()}
+
+@app.get("/ready", include_in_schema=False)
+async def ready(db: DBSession = Depends(get_db)):
+    """The worker can serve requests: its database answers"""
+    try:
+        await asyncio.wait_for(crud_async.ping(db), DB_READY_TIMEOUT_SECONDS)
+    except Exception:
+        logger.opt(exception=True).error("Readiness check failed, the database does not answer")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="The database does not answer")
+    return {"status": "ready", "pid": os.getpid()}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    """Metrics of the requests, the database and the caches, in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# Profiling, see profiling.py. Every endpoint takes the X-Profile-Token header
+@app.post("/profiling", dependencies=[Depends(profiling.require_token)], tags=["Profiling"])
+async def arm_profiling(profile: schemas.ProfileRequest):
+    """
+    Profiles the next requests of a route, named as in "GET /movies/{movie_id}/comments/"
+    """
+    profiling.arm(profile.route, profile.count)
+    logger.warning("Profiling the next {} requests of {}", profile.count, profile.route)
+    return {"route": profile.route, "count": profile.count}
+
+@app.get("/profiling", dependencies=[Depends(profiling.require_token)], tags=["Profiling"])
+async def list_profiles():
+    return profiling.list_reports()
+
+@app.get("/profiling/{profile_id}", dependencies=[Depends(profiling.require_token)], tags=["Profiling"])
+async def get_profile(profile_id: str):
+    """
+    The report of a profiled request: its SQL statements with their durations and
+    the code that issued them, and its hottest stacks
+    """
+    profile = profiling.get_report(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Profile {profile_id} does not exist")
+    return profile.report()
+
+@app.get("/profiling/{profile_id}/collapsed", dependencies=[Depends(profiling.require_token)], tags=["Profiling"])
+async def get_profile_stacks(profile_id: str):
+    """
+    The sampled stacks of a profiled request in the collapsed format, for flamegraph.pl or speedscope
+    """
+    profile = profiling.get_report(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Profile {profile_id} does not exist")
+    return PlainTextResponse(profile.collapsed())
+
+
 @app.post("/Registration", response_model=schemas.User, status_code =status.HTTP_201_CREATED, tags= ["User"])
 
-def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def signup(user: schemas.UserCreate, db: DBSession = Depends(get_db)):
     """
     This Session is for user Registration, fill your details below to signup
     """
-    db_user = crud.get_user_by_username(db, username=user.username)
-    db_user_by_email = crud.get_user_by_email(db, email=user.email)
-    hashed_password = pwd_context.hash(user.password)
-    if db_user:
-        logger.error(f"user trying to register but username entered already exist: {user.username}")
+    # Refuse the duplicates before paying for the hash, the unique constraints catch the ones registered meanwhile
+    taken = await crud_async.find_registration_conflict(db, username=user.username, email=user.email)
+    if taken == "Username":
+        logger.error("user trying to register but username entered already exist: {}", user.username)
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    if db_user_by_email:
-        logger.error(f"User trying to register but email entered already exists: {user.email}")
+    if taken == "Email":
+        logger.error("User trying to register but email entered already exists: {}", user.email)
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user, hashed_password=hashed_password)
+    hashed_password = await passwords.hash_password(user.password)
+    return await crud_async.create_user(db=db, user=user, hashed_password=hashed_password)
     
 
 @app.post("/login", status_code =status.HTTP_201_CREATED, tags=["User"])
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: DBSession = Depends(get_db)):
     """
     This Session is for user to login and generate a token that expires in 30mins time
     """
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
-        logger.error(f"Failed login attempt for username: {form_data.username}")
+        logger.error("Failed login attempt for username: {}", form_data.username)
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Invalid Credential ",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = create_access_token(data={"sub": user.username})
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 # Movie endpoints
 @app.post("/movies/", response_model=schemas.Movie, status_code =status.HTTP_201_CREATED, tags= ["Movie"])
-def create_new_movie(movie: schemas.MovieCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+async def create_new_movie(movie: schemas.MovieCreate, db: DBSession = Depends(get_db), current_user: schemas.CurrentUser = Depends(auth.get_current_user)):
     """
     This is the Movie creation plaform, enter the movie information below
     """
-    logger.info(f"User {current_user.username} creating a movie: {movie.title}")
-    return crud.create_movie(db=db, movie=movie, user_id=current_user.id)
+    logger.info("User {} creating a movie: {}", current_user.username, movie.title)
+    return await crud_async.create_movie(db=db, movie=movie, user_id=current_user.id)
+
+
+@app.post("/movies/bulk", response_model=schemas.BulkImportReport, status_code =status.HTTP_201_CREATED, tags= ["Movie"])
+async def import_movies(request: Request, db: DBSession = Depends(get_db), current_user: schemas.CurrentUser = Depends(auth.get_current_user)):
+    """
+    This endpoint imports many movies at once, send them as NDJSON (Content-Type: application/x-ndjson, a movie per line)
+    or as CSV (Content-Type: text/csv) with a header row naming the movie fields.
+    The valid rows are created, the response lists the rows that were rejected and why
+    """
+    report = await bulk.import_movies(request, db, user_id=current_user.id)
+    logger.info("User {} imported {} movies, {} rows rejected", current_user.username, report['created'], report['failed'])
+    return report
+
+
+@app.post("/movies/batch-get", response_model=schemas.MovieBatch, tags= ["Movie"])
+async def batch_get_movies(batch: schemas.MovieBatchRequest, db: DBSession = Depends(get_read_db)):
+    """
+    This endpoint fetches many movies in one request, in the order of the given ids, with the ids
+    that are not movies listed as missing. The owner, the rating aggregate and the latest comments
+    are only returned when asked for in include
+    """
+    movies = await crud_async.get_movie_batch(db, movie_ids=batch.ids, include=batch.include, comments_per_movie=batch.comments_per_movie)
+    logger.info("Fetched a batch of {} movies, {} missing", len(movies["movies"]), len(movies["missing"]))
+    return json_response(fast_json.movie_batch(movies))
 
 
 @app.get("/movies/", response_model=List[schemas.Movie], tags= ["Movie"])
-def list_all_movies(db: Session = Depends(get_db), skip: int = 0, limit: int = 10):
+async def list_all_movies(
+    request: Request, db: DBSession = Depends(get_read_db), skip: int = Query(0, ge=0, deprecated=True), limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+    genre: Optional[str] = None, cast: Optional[str] = None, language: Optional[str] = None, director: Optional[str] = None,
+    year_from: Optional[int] = None, year_to: Optional[int] = None, runtime_min: Optional[int] = Query(None, ge=0), runtime_max: Optional[int] = Query(None, ge=0),
+    sort: schemas.MovieSort = "created",
+):
     
     """
-    This endpoint lists all available Movies created by all user
+    This endpoint lists all available Movies created by all user, oldest first unless sorted
+    by -created (newest first), year or rating. genre, cast, language and director keep
+    the movies with that exact name, the year and runtime (in minutes) ranges include their bounds.
+    To get the next page, pass the cursor returned in the X-Next-Cursor header, with the same filters and sort
     """
     
-    logger.info("Fetching list of movies")
-    return crud.get_movies(db=db, skip=skip, limit=limit)
+    filters = schemas.MovieFilter(
+        genre=genre, cast=cast, language=language, director=director,
+        year_from=year_from, year_to=year_to, runtime_min=runtime_min, runtime_max=runtime_max,
+    )
+
+    async def load():
+        logger.info("Fetching list of movies")
+        movies = await crud_async.get_movie_rows(db=db, skip=skip, limit=limit, cursor=cursor, filters=filters, sort=sort)
+        return movies, cursor_headers(movies, limit, *crud.MOVIE_SORTS[sort][0])
+
+    return await response_cache.serve(request, [response_cache.MOVIES], load, fast_json.movies)
 
 # Read User Movies
 @app.get("/movies/List", response_model=list[schemas.Movie], tags= ["Movie"])
-def my_movies(skip: int = 0, limit: int = 10, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(get_db)):
+async def my_movies(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, current_user: schemas.CurrentUser = Depends(auth.get_current_user), db: DBSession = Depends(get_read_db)):
     """
-    This endpoint lists all Movies created by the current user
+    This endpoint lists all Movies created by the current user, a page at a time.
+    To get the next page, pass the cursor returned in the X-Next-Cursor header
     """
-    movies = crud.get_user_movies(db, user_id=current_user.id)
-    logger.info(f"Fetching only the list of movie(s) created by the user_id:{current_user.id}")
-    return movies
+    movies = await crud_async.get_user_movie_rows(db, user_id=current_user.id, limit=limit, cursor=cursor)
+    logger.info("Fetching only the list of movie(s) created by the user_id:{}", current_user.id)
+    return json_response(fast_json.movies(movies), cursor_headers(movies, limit, *crud.MOVIE_ORDER))
 
 @app.get("/movies/Search", response_model=List[schemas.Movie], tags= ["Movie"])
-def by_title(search: Optional[str] = "", skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+async def by_title(search: Optional[str] = "", skip: int = Query(0, ge=0), limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), db: DBSession = Depends(get_read_db)):
+    """
+    You can use this endpoint to search for any movie by title, cast, director, genres or description,
+    even if only the beginning of a word is provided. The best matches are listed first.
+    The Searching entry is not case sensitive
+    """
+    movies = await crud_async.search_movie_rows(db=db, query=search, skip=skip, limit=limit)
+    return json_response(fast_json.movies(movies))
+
+
+# Leaderboards, read in the order of the indexed scores of leaderboard.py
+@app.get("/movies/top", response_model=List[schemas.ScoredMovie], tags= ["Movie"])
+async def top_movies(genre: Optional[str] = None, year: Optional[int] = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), db: DBSession = Depends(get_read_db)):
+    """
+    This endpoint lists the best rated movies, optionally of a genre or a release year.
+    The score is the average rating, weighted down for movies with few ratings
+    """
+    movies = await crud_async.get_top_movie_rows(db, limit=limit, genre=genre, year=year)
+    return json_response(fast_json.scored_movies(movies, {movie.id: movie.score for movie in movies}))
+
+@app.get("/movies/trending", response_model=List[schemas.ScoredMovie], tags= ["Movie"])
+async def trending_movies(genre: Optional[str] = None, year: Optional[int] = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), db: DBSession = Depends(get_read_db)):
+    """
+    This endpoint lists the movies with the most ratings and comments lately, optionally of a genre
+    or a release year. The score counts the recent ratings and comments, older ones count less
+    """
+    movies = await crud_async.get_trending_movie_rows(db, limit=limit, genre=genre, year=year)
+    return json_response(fast_json.scored_movies(movies, {movie.id: leaderboard.decayed(movie.score, movie.epoch) for movie in movies}))
+
+
+@app.get("/movies/export", tags= ["Movie"])
+async def export_movies(format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
     """
-    You can use this endpoint to search for any movie title even if the title name provided doesn't match correctly.
-    The Searching entry is case sensitive 
+    This endpoint downloads the whole catalog, as NDJSON (a movie per line) or CSV
     """
-    return db.query(models.Movie).filter( models.Movie.title.contains(search)).offset(skip).limit(limit).all()
+    logger.info("Exporting the movies as {}", format)
+    return StreamingResponse(
+        bulk.export_movies(format),
+        media_type=bulk.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="movies.{format}"'},
+    )
     
 
 @app.get("/movies/{movie_id}", response_model=schemas.Movie, tags= ["Movie"])
-def get_movie_by_id(movie_id: int, db: Session = Depends(get_db)):
+async def get_movie_by_id(movie_id: int, request: Request, db: DBSession = Depends(get_read_db)):
     
     """
     This endpoint views one Movie at a time using the movie_id
     """
-    movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, Please try another movie_id")
-    logger.info(f"Fetching details for movie id: {movie_id}, {movie.title}")   
-    return movie
+    async def load():
+        movie = await crud_async.get_movie_by_id(db=db, movie_id=movie_id, with_relations=True)
+        if movie is None:
+            logger.warning("Movie not found with id: {}", movie_id)
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, Please try another movie_id")
+        logger.info("Fetching details for movie id: {}, {}", movie_id, movie.title)   
+        return movie, {}
+
+    return await response_cache.serve(request, [response_cache.movie(movie_id)], load, dump_movie)
 
 
 @app.put("/movies/{movie_id}", response_model=schemas.Movie, status_code =status.HTTP_201_CREATED, tags= ["Movie"])
-def update_movie(movie_id: int, movie: schemas.MovieUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+async def update_movie(movie_id: int, movie: schemas.MovieUpdate, db: DBSession = Depends(get_db), current_user: schemas.CurrentUser = Depends(get_current_user)):
     """
     This platform updates Movies created by the user using the Movie_id
     """
-    
-    existing_movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if existing_movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, Please try another movie_id")
-    if existing_movie.owner_id != current_user.id:
-        logger.warning(f"User {current_user.username} is not authorized to update movie: {movie.title}")
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="We are sorry, you are not authorized to update this movie")
-    logger.info(f"Updating movie details: {movie.title}")
-    return crud.update_movie(db=db, movie_id=movie_id, movie=movie)
+    logger.info("Updating movie details: {}", movie.title)
+    return await crud_async.update_movie(db=db, movie_id=movie_id, movie=movie, user_id=current_user.id)
     
 @app.delete("/movies/{movie_id}", tags= ["Movie"])
-def delete_movie(movie_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+async def delete_movie(movie_id: int, db: DBSession = Depends(get_db), current_user: schemas.CurrentUser = Depends(get_current_user)):
     """
     This endpoint allows the user to Delete its own created movie
     """
-    
-    existing_movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if existing_movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, Please try another movie_id")
-    if existing_movie.owner_id != current_user.id:
-        logger.warning(f"User {current_user.username} is not authorized to delete movie_id: {movie_id}")
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"You are not authorized to delete movie_id {movie_id}")
-    
-     # Check if there are related ratings or comments
-    if crud.get_ratings_for_movie(db=db, movie_id=movie_id):
-        logger.warning(f"trying to delete Movie {movie_id} with rating or comments, but operation aborted")
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"You cannot delete movie_id {movie_id} with existing ratings or comments")
-    if crud.get_comments_for_movie(db=db, movie_id=movie_id):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"You cannot delete movie_id {movie_id} with existing ratings or comments")
-    
-    crud.delete_movie(db=db, movie_id=movie_id)
-    logger.info(f"Movie_id {movie_id} deleted successfully")
+    # Only the owner can delete a movie, and only while it has no ratings or comments
+    await crud_async.delete_movie(db=db, movie_id=movie_id, user_id=current_user.id)
+    logger.info("Movie_id {} deleted successfully", movie_id)
     #return {"message": "Movie deleted successfully"}
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 # Rating endpoints
-@app.post("/movies/{movie_id}/rate/", response_model=schemas.Rating, status_code=status.HTTP_201_CREATED, tags=["Rating"])
-def create_rating(movie_id: int, rating: schemas.RatingCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):   
+@app.post("/movies/{movie_id}/rate/", response_model=schemas.Rating, status_code=status.HTTP_201_CREATED, responses={202: {"model": schemas.QueuedWrite}}, tags=["Rating"])
+async def create_rating(movie_id: int, rating: schemas.RatingCreate, db: DBSession = Depends(get_db), current_user: schemas.CurrentUser = Depends(auth.get_current_user)):   
     """
     This endpoint allows authenticated users to rate any movie using the movie_id,
-    but a user can only rate a movie once. Ratings is between (0-5)
+    but a user can only rate a movie once. Ratings is between (0-5).
+    In write-behind mode the rating is queued and answered with 202, see GET /writes/{write_id}
     """
-    movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
-    
-    db_rating = crud.create_rating(db=db, rating=rating, movie_id=movie_id, user_id=current_user.id)
-    logger.info(f"User {current_user.username} rated movie: {movie.title}, rating: {rating.rating}")
-    return db_rating
+    if write_behind.writer is not None:
+        crud.validate_rating(rating)
+        return queued(write_behind.writer.submit(write_behind.RATING, movie_id, current_user, {"rating": rating.rating}))
+    db_rating = await crud_async.create_rating(db=db, rating=rating, movie_id=movie_id, user_id=current_user.id)
+    logger.info("User {} rated movie_id: {}, rating: {}", current_user.username, movie_id, rating.rating)
+    return {**db_rating._mapping, "created_by": current_user}
 
 
 @app.get("/movies/{movie_id}/ratings/", response_model=List[schemas.Rating], tags= ["Rating"])
-def get_ratings_for_movie(movie_id: int, db: Session = Depends(get_db)):
+async def get_ratings_for_movie(movie_id: int, request: Request, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, db: DBSession = Depends(get_read_db)):
     
     """
-    This endpoint allows the public to view the rated movie using the movie_id
+    This endpoint allows the public to view the rated movie using the movie_id.
+    To get the next page, pass the cursor returned in the X-Next-Cursor header
     """
-    movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
-    logger.info(f"Fetching ratings for movie:{movie.id}, {movie.title}")
-    return crud.get_ratings_for_movie(db=db, movie_id=movie_id, )
+    async def load():
+        movie = await crud_async.get_movie_by_id(db=db, movie_id=movie_id)
+        if movie is None:
+            logger.warning("Movie not found with id: {}", movie_id)
+            raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
+        logger.info("Fetching ratings for movie:{}, {}", movie.id, movie.title)
+        ratings = await crud_async.get_rating_rows(db=db, movie_id=movie_id, limit=limit, cursor=cursor)
+        return ratings, cursor_headers(ratings, limit, *crud.RATING_ORDER)
+
+    return await response_cache.serve(request, [response_cache.movie(movie_id), response_cache.ratings(movie_id)], load, fast_json.ratings)
 
 # Comment endpoints
-@app.post("/movies/{movie_id}/comments/", response_model=schemas.Comment, status_code =status.HTTP_201_CREATED, tags= ["Comment"])
-def create_comment(movie_id: int, comment: schemas.CommentCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+@app.post("/movies/{movie_id}/comments/", response_model=schemas.Comment, status_code =status.HTTP_201_CREATED, responses={202: {"model": schemas.QueuedWrite}}, tags= ["Comment"])
+async def create_comment(movie_id: int, comment: schemas.CommentCreate, db: DBSession = Depends(get_db), current_user: schemas.CurrentUser = Depends(get_current_user)):
     
     """
-    This endpoint allows the public to comment on any movie using the movie_id
+    This endpoint allows the public to comment on any movie using the movie_id.
+    In write-behind mode the comment is queued and answered with 202, see GET /writes/{write_id}
     """
-    movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
-        raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
-    db_comment = crud.create_comment(db=db, comment=comment, movie_id=movie_id, user_id=current_user.id)
-    logger.info(f"Commenting on movie: {movie.id}, {movie.title}")
-    return db_comment
+    if write_behind.writer is not None:
+        return queued(write_behind.writer.submit(write_behind.COMMENT, movie_id, current_user, {"comment": comment.comment}))
+    db_comment = await crud_async.create_comment(db=db, comment=comment, movie_id=movie_id, user_id=current_user.id, author=current_user)
+    logger.info("Commenting on movie_id: {}", movie_id)
+    return {**db_comment._mapping, "posted_by": current_user}
+
+def queued(write_id: str) -> Response:
+    body = orjson.dumps({"id": write_id, "status": "queued"})
+    return Response(content=body, status_code=status.HTTP_202_ACCEPTED, media_type="application/json", headers={"Location": f"/writes/{write_id}"})
+
+@app.get("/writes/{write_id}", response_model=schemas.WriteStatus, tags=["Rating", "Comment"])
+async def get_write(write_id: str, current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """
+    This endpoint tells whether a rating or comment queued in write-behind mode was committed, with
+    the rating or comment, or failed, with the error it failed with. Only the author can see a write
+    """
+    write = write_behind.writer.status(write_id, current_user.username) if write_behind.writer is not None else None
+    if write is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Write {write_id} does not exist")
+    return write
+
+# Recommendations, served from the in-memory model of recommend.py
+@app.get("/movies/{movie_id}/similar", response_model=List[schemas.ScoredMovie], tags=["Recommendation"])
+async def similar_movies(movie_id: int, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=recommend.RECOMMEND_NEIGHBOURS), db: DBSession = Depends(get_read_db)):
+    """
+    This endpoint lists the movies rated most like this one by the same users, most similar first
+    """
+    similar = recommend.model.similar(movie_id, limit)
+    if similar is None:
+        # Not rated yet, or not a movie at all
+        if await crud_async.get_movie_by_id(db=db, movie_id=movie_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Movie_id {movie_id} does not exist, Please try again")
+        similar = []
+    scores = dict(similar)
+    movies = await crud_async.get_movie_rows_by_id(db, movie_ids=list(scores))
+    return json_response(fast_json.scored_movies(movies, scores))
+
+@app.get("/users/me/recommendations", response_model=List[schemas.ScoredMovie], tags=["Recommendation"])
+async def my_recommendations(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), current_user: schemas.CurrentUser = Depends(auth.get_current_user), db: DBSession = Depends(get_read_db)):
+    """
+    This endpoint suggests movies the current user has not rated yet, from the movies similar
+    to the ones they rated. The score is the predicted rating
+    """
+    scores = dict(recommend.model.recommend(current_user.id, limit))
+    movies = await crud_async.get_movie_rows_by_id(db, movie_ids=list(scores))
+    logger.info("Recommending {} movies to user_id:{}", len(movies), current_user.id)
+    return json_response(fast_json.scored_movies(movies, scores))
+
 
 @app.get("/movies/{movie_id}/comments/", response_model=List[schemas.Comment], tags= ["Comment"])
-def get_comments_for_movie(movie_id: int, db: Session = Depends(get_db)):
+async def get_comments_for_movie(movie_id: int, request: Request, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, since: Optional[datetime] = None, db: DBSession = Depends(get_read_db)):
     
     """
-    This endpoint allows the public to view comments attached to any movie using the movie_id
+    This endpoint allows the public to view comments attached to any movie using the movie_id, oldest first,
+    optionally only the ones posted after since. To get the next page, pass the cursor returned in the
+    X-Next-Cursor header. To get only the comments posted after a page, poll with the cursor of its
+    X-Last-Cursor header, or follow GET /movies/{movie_id}/comments/stream
+    """
+    async def load():
+        movie = await crud_async.get_movie_by_id(db=db, movie_id=movie_id)
+        if movie is None:
+            logger.warning("Movie not found with id: {}", movie_id)
+            raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
+        logger.info("Fetching comments for movie:{}, {}", movie.id, movie.title)
+        comments = await crud_async.get_comment_rows(db=db, movie_id=movie_id, limit=limit, cursor=cursor, since=since)
+        return comments, tail_headers(comments, limit, *crud.COMMENT_ORDER)
+
+    return await response_cache.serve(request, [response_cache.movie(movie_id), response_cache.comments(movie_id)], load, fast_json.comments)
+
+@app.get("/movies/{movie_id}/comments/stream", response_class=StreamingResponse, tags=["Comment"])
+async def stream_comments(movie_id: int, cursor: Optional[str] = None, last_event_id: Optional[str] = Header(None), db: DBSession = Depends(get_read_db)):
+    """
+    This endpoint pushes the new comments of a movie as Server-Sent Events, for as long as the connection
+    stays open. Reconnecting with the id of the last event received, in the Last-Event-ID header or as
+    the cursor, first sends the comments posted in the meantime, up to COMMENT_FEED_MAX_REPLAY per connection
     """
-    movie = crud.get_movie_by_id(db=db, movie_id=movie_id)
-    if movie is None:
-        logger.warning(f"Movie not found with id: {movie_id}")
+    if await crud_async.get_movie_by_id(db=db, movie_id=movie_id) is None:
         raise HTTPException(status_code=404, detail=f"Movie_id {movie_id} does not exist, Please try again")
-    logger.info(f"Fetching comments for movie:{movie.id}, {movie.title}")
-    return crud.get_comments_for_movie(db=db, movie_id=movie_id)
+    # Following before reading the missed comments, so none is posted in between unseen
+    follower = comment_feed.broker.follow(movie_id)
+    try:
+        backlog, last_id, resume = [], None, last_event_id or cursor
+        while resume and len(backlog) < comment_feed.COMMENT_FEED_MAX_REPLAY:
+            limit = min(MAX_PAGE_SIZE, comment_feed.COMMENT_FEED_MAX_REPLAY - len(backlog))
+            comments = await crud_async.get_comment_rows(db=db, movie_id=movie_id, limit=limit, cursor=resume)
+            backlog += [comment_feed.event(fast_json.comment(comment)) for comment in comments]
+            last_id = comments[-1].id if comments else last_id
+            resume = next_cursor(comments, limit, *crud.COMMENT_ORDER)
+    except BaseException:
+        comment_feed.broker.unfollow(follower)
+        raise
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if resume:
+        # Too far behind for one connection, the client reconnects from the last event sent
+        comment_feed.broker.unfollow(follower)
+        logger.info("Replaying {} missed comments of movie:{}, more to come", len(backlog), movie_id)
+        return StreamingResponse(iter(backlog), media_type="text/event-stream", headers=headers)
+    logger.info("Streaming the comments of movie:{}, {} missed", movie_id, len(backlog))
+    return StreamingResponse(comment_feed.broker.stream(follower, backlog, last_id), media_type="text/event-stream", headers=headers)
 
 @app.delete("/comments/{comment_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Comment"])
-def delete_comment(comment_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+async def delete_comment(comment_id: int, db: DBSession = Depends(get_db), current_user: schemas.CurrentUser = Depends(get_current_user)):
     """
     This endpoint allows the user to delete their own comment using the comment_id.
     """
-    # Fetch the comment by its ID
-    existing_comment = crud.get_comment_by_id(db=db, comment_id=comment_id)
-    
-    # Check if the comment exists
-    if existing_comment is None:
-        logger.warning(f"Comment not found with id: {comment_id}")
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Comment_id {comment_id} does not exist, Please try another comment_id")
-    
-    # Check if the current user is the owner of the comment
-    if existing_comment.user_id != current_user.id:
-        logger.warning(f"User {current_user.username} is not authorized to delete comment_id: {comment_id}")
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not authorized to delete this comment")
-    
-    # Delete the comment
-    crud.delete_comment(db=db, comment_id=comment_id)
-    logger.info(f"Comment_id {comment_id} deleted successfully")
+    # Only the author of the comment can delete it
+    await crud_async.delete_comment(db=db, comment_id=comment_id, user_id=current_user.id)
+    logger.info("Comment_id {} deleted successfully", comment_id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -0,0 +1,241 @@
+# metrics.py
+"""
+Request, database and cache metrics, exposed at /metrics in the Prometheus
+text format. MetricsMiddleware counts the requests per route and status and
+times them. SQL statements are timed through the engine events and charged to
+the request they run in, so a slow route can be told apart as slow in the
+database (many queries, lazy loads, lock waits) or outside it (bcrypt,
+serialization). The stats of the password pool and the caches are collected
+when /metrics is scraped.
+"""
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import logs
+
+
+# Prometheus' default latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            return [(self.name, _labels(self.label_names, key), value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # A count per bucket, then the sum and the count of the observations
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        samples = []
+        for key, counts in values:
+            for bound, count in zip((*self.buckets, "+Inf"), (*counts[:-2], counts[-1])):
+                le = bound if bound == "+Inf" else _number(bound)
+                samples.append((f"{self.name}_bucket", _labels((*self.label_names, "le"), (*key, le)), count))
+            samples.append((f"{self.name}_sum", _labels(self.label_names, key), counts[-2]))
+            samples.append((f"{self.name}_count", _labels(self.label_names, key), counts[-1]))
+        return samples
+
+
+class Stats(Metric):
+    """
+    The numbers of a stats() function, read when scraped. Each one is exposed
+    as <name>_<key>, the keys listed in counters as counters, the others as gauges
+    """
+
+    def __init__(self, name: str, help: str, collect: Callable[[], dict], counters: Iterable[str] = ()):
+        super().__init__(name, help)
+        self.collect = collect
+        self.counters = set(counters)
+
+    def render(self) -> str:
+        lines = []
+        for key, value in self.collect().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            kind = "counter" if key in self.counters else "gauge"
+            name = f"{self.name}_{key}_total" if kind == "counter" else f"{self.name}_{key}"
+            lines += [f"# HELP {name} {self.help}, {key}", f"# TYPE {name} {kind}", f"{name} {_number(value)}"]
+        return "\n".join(lines)
+
+
+REGISTRY: List[Metric] = []
+
+REQUESTS = Counter("http_requests_total", "Requests handled", ("method", "route", "status"))
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time to answer a request", ("method", "route"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled", ("method", "route"))
+REQUEST_QUERIES = Histogram("http_request_db_queries", "SQL statements run by a request", ("method", "route"), QUERY_COUNT_BUCKETS)
+REQUEST_DB_TIME = Histogram("http_request_db_duration_seconds", "Time a request spent in SQL statements", ("method", "route"))
+QUERIES = Counter("db_queries_total", "SQL statements run", ("outcome",))
+QUERY_DURATION = Histogram("db_query_duration_seconds", "Time to run a SQL statement")
+POOL_CHECKOUT_WAIT = Histogram("db_pool_checkout_wait_seconds", "Time waited for a connection from the pool", ("pool",))
+POOL_CONNECTIONS = Gauge("db_pool_connections", "Connections of the pool, by state", ("pool", "state"))
+
+# Pools reported by POOL_CONNECTIONS, by name
+_pools: Dict[str, Callable] = {}
+
+
+def watch_pool(name: str, engine):
+    _pools[name] = lambda: engine.pool
+
+
+def _collect_pools():
+    for name, get_pool in _pools.items():
+        pool = get_pool()
+        # Only the queue pools have a size, SQLite's NullPool opens a connection per checkout
+        if hasattr(pool, "checkedout"):
+            POOL_CONNECTIONS.set(pool.checkedout(), pool=name, state="checked_out")
+            POOL_CONNECTIONS.set(pool.checkedin(), pool=name, state="idle")
+            POOL_CONNECTIONS.set(max(pool.overflow(), 0), pool=name, state="overflow")
+
+
+def render() -> str:
+    _collect_pools()
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# Queries and time in the database of the current request
+_request_db: ContextVar[Optional[list]] = ContextVar("request_db", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _query_done(conn, outcome: str):
+    started = conn.info.get("query_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    QUERIES.inc(outcome=outcome)
+    QUERY_DURATION.observe(elapsed)
+    request_db = _request_db.get()
+    if request_db is not None:
+        request_db[0] += 1
+        request_db[1] += elapsed
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _query_done(conn, "ok")
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None:
+        _query_done(context.connection, "error")
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        labels = {"method": scope["method"], "route": logs.route_name(scope["app"], scope).split(" ", 1)[1]}
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        request_db = [0, 0.0]
+        token = _request_db.set(request_db)
+        IN_FLIGHT.inc(**labels)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_DURATION.observe(time.perf_counter() - started, **labels)
+            IN_FLIGHT.dec(**labels)
+            REQUESTS.inc(status=status_code, **labels)
+            REQUEST_QUERIES.observe(request_db[0], **labels)
+            REQUEST_DB_TIME.observe(request_db[1], **labels)
+            _request_db.reset(token)
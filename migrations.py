@@ -0,0 +1,64 @@
+# migrations.py
+"""
+Brings the schema of a database up to date: upgrade() creates the missing
+tables, then makes the changes create_all does not make on an existing
+database, adding the new columns and indexes to the tables that are already
+there, and backfills the new columns when it added them. Every step checks
+the current schema first, so upgrade() can run any number of times.
+
+It runs at startup unless DB_MIGRATE_ON_STARTUP=false. With many workers,
+turn that off and run
+
+    python migrations.py
+
+once before starting them, it also backfills again, e.g. after importing rows
+with another tool.
+"""
+import os
+
+from loguru import logger
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+import catalog
+from database import Base, SessionLocal, get_engine
+
+
+DB_MIGRATE_ON_STARTUP = os.environ.get("DB_MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+
+# (table, column, DDL type) added after the first release
+ADDED_COLUMNS = [
+    ("movies", "runtime_minutes", "INTEGER"),
+]
+
+
+def upgrade(bind=None) -> bool:
+    """Returns True when columns were added"""
+    bind = bind if bind is not None else get_engine()
+    Base.metadata.create_all(bind=bind)
+    inspector = inspect(bind)
+    added = []
+    with bind.begin() as connection:
+        for table, column, ddl_type in ADDED_COLUMNS:
+            if inspector.has_table(table) and column not in {existing["name"] for existing in inspector.get_columns(table)}:
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+                added.append(f"{table}.{column}")
+        # Reflection skips the expression indexes, so checkfirst can't be used
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+    if added:
+        logger.info("Added the columns {}, backfilling them", ", ".join(added))
+        backfill(bind)
+    return bool(added)
+
+
+def backfill(bind=None) -> int:
+    with SessionLocal(bind=bind) as db:
+        return catalog.backfill(db)
+
+
+if __name__ == "__main__":
+    upgrade()
+    print(f"backfilled {backfill()} movies")
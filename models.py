@@ -1,10 +1,30 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, UniqueConstraint, Index, func
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql.expression import text
+from sqlalchemy.sql.expression import text, literal_column, FunctionElement
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from database import Base
 
+
+class utcnow(FunctionElement):
+    """
+    Server side creation timestamp. On SQLite it is written with microseconds in
+    the same format SQLAlchemy binds datetimes with, so timestamps compare and
+    order correctly against query parameters (see pagination.py)
+    """
+    type = TIMESTAMP(timezone=True)
+    inherit_cache = True
+
+@compiles(utcnow)
+def _default_now(element, compiler, **kw):
+    return "now()"
+
+@compiles(utcnow, "sqlite")
+def _sqlite_now(element, compiler, **kw):
+    return "(STRFTIME('%Y-%m-%d %H:%M:%f000', 'now'))"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -12,7 +32,7 @@ class User(Base):
     username = Column(String, unique=True, nullable=False, index=True)
     full_name = Column(String)
     email = Column(String, nullable=False, unique=True)
-    time_created = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    time_created = Column(TIMESTAMP(timezone=True), nullable=False, server_default=utcnow())
     hashed_password = Column(String, nullable=False)
     
     
@@ -20,6 +40,9 @@ class User(Base):
     ratings = relationship("Rating", back_populates="created_by")
     comments = relationship("Comment", back_populates="posted_by")
 
+# The sort key of a movie without year_released, written as is in the index and the queries so they match
+YEAR_UNKNOWN = literal_column("0", Integer)
+
 class Movie(Base):
     __tablename__ = "movies"
 
@@ -32,13 +55,44 @@ class Movie(Base):
     cast= Column(String)
     language=  Column(String)
     Runtime=  Column(String)
+    # Runtime parsed by catalog.parse_runtime, for filtering
+    runtime_minutes = Column(Integer)
     year_released = Column(Integer)
-    time_created = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    time_created = Column(TIMESTAMP(timezone=True), nullable=False, server_default=utcnow())
     owner_id = Column(Integer, ForeignKey("users.id"))
 
     owner = relationship("User", back_populates="movies")
     comments = relationship("Comment", back_populates="movie")
     ratings = relationship("Rating", back_populates="movie")
+    rating_stats = relationship("MovieRatingStats", uselist=False, back_populates="movie")
+
+    # Keyset pagination of the catalog and of a user's movies, then the filters and
+    # sort orders of the catalog. Language and director are matched case insensitively
+    __table_args__ = (
+        Index("ix_movies_time_created_id", "time_created", "id"),
+        Index("ix_movies_owner_id_time_created_id", "owner_id", "time_created", "id"),
+        Index("ix_movies_year_released_id", "year_released", "id"),
+        Index("ix_movies_year_key_id", func.coalesce(year_released, YEAR_UNKNOWN), "id"),
+        Index("ix_movies_runtime_minutes_id", "runtime_minutes", "id"),
+        Index("ix_movies_language_year_released", func.lower(language), "year_released"),
+        Index("ix_movies_director_year_released", func.lower(director), "year_released"),
+    )
+
+class MovieGenre(Base):
+    """One row per genre of a movie, split from Movie.genres by catalog.py"""
+    __tablename__ = "movie_genres"
+
+    genre = Column(String, primary_key=True)
+    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True, index=True)
+
+
+class MovieCast(Base):
+    """One row per cast member of a movie, split from Movie.cast by catalog.py"""
+    __tablename__ = "movie_cast"
+
+    name = Column(String, primary_key=True)
+    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True, index=True)
+
 
 class Rating(Base):
     __tablename__ = "ratings"
@@ -52,19 +106,94 @@ class Rating(Base):
     movie = relationship("Movie", back_populates="ratings")
     created_by = relationship("User", back_populates="ratings")
     
-    __table_args__ = (UniqueConstraint('user_id', 'movie_id', name='unique_user_movie_rating'),)
+    __table_args__ = (
+        UniqueConstraint('user_id', 'movie_id', name='unique_user_movie_rating'),
+        Index("ix_ratings_movie_id_id", "movie_id", "id"),
+    )
     
     
+class MovieRatingStats(Base):
+    """
+    Aggregate of the ratings of one movie, kept up to date by crud.create_rating
+    and rebuilt from the ratings table by crud.rebuild_rating_stats
+    """
+    __tablename__ = "movie_rating_stats"
+
+    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    sum = Column(Float, nullable=False, default=0)
+    # Histogram of the ratings, a rating of 3.5 counts as 3 stars
+    stars_0 = Column(Integer, nullable=False, default=0)
+    stars_1 = Column(Integer, nullable=False, default=0)
+    stars_2 = Column(Integer, nullable=False, default=0)
+    stars_3 = Column(Integer, nullable=False, default=0)
+    stars_4 = Column(Integer, nullable=False, default=0)
+    stars_5 = Column(Integer, nullable=False, default=0)
+
+    movie = relationship("Movie", back_populates="rating_stats")
+
+    @property
+    def average(self):
+        return self.sum / self.count if self.count else None
+
+    @property
+    def histogram(self):
+        return [getattr(self, f"stars_{stars}") for stars in range(6)]
+
+
+class MovieScore(Base):
+    """
+    Leaderboard scores of a movie with ratings or comments, see leaderboard.py.
+    Both are indexed so the leaderboards are read in score order
+    """
+    __tablename__ = "movie_scores"
+
+    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True)
+    # Average rating pulled towards a prior, so a single 5 star rating does not top the list
+    top = Column(Float, nullable=False, default=0)
+    # Decayed activity, scaled to the epoch of the generation
+    trending = Column(Float, nullable=False, default=0)
+    generation = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_movie_scores_top", "top"),
+        Index("ix_movie_scores_trending", "trending"),
+    )
+
+
+class LeaderboardClock(Base):
+    """The single row holding the current generation of the trending scores and its epoch"""
+    __tablename__ = "leaderboard_clock"
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+    # Unix time the trending scores of the generation are relative to
+    epoch = Column(Float, nullable=False)
+
+
+class ResponseCacheGeneration(Base):
+    """
+    The single row a process bumps to drop the cached responses of every API
+    process, e.g. a repair job, see response_cache.py
+    """
+    __tablename__ = "response_cache_generation"
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+
+
 class Comment(Base):
     __tablename__ = "comments"
 
     id = Column(Integer, primary_key=True, index=True)
     comment = Column(String)
     movie_id = Column(Integer, ForeignKey("movies.id"))
-    time_created = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    time_created = Column(TIMESTAMP(timezone=True), nullable=False, server_default=utcnow())
     
     movie_id = Column(Integer, ForeignKey("movies.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
 
     movie = relationship("Movie", back_populates="comments")
     posted_by = relationship("User", back_populates="comments")
+
+    __table_args__ = (Index("ix_comments_movie_id_time_created_id", "movie_id", "time_created", "id"),)
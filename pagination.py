@@ -0,0 +1,73 @@
+# pagination.py
+import base64
+import json
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_
+
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+# Response header carrying the cursor of the next page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Response header carrying the cursor of the last item of any non empty page, to
+# poll for the items added after it
+LAST_CURSOR_HEADER = "X-Last-Cursor"
+
+
+def encode_cursor(*values) -> str:
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *columns) -> list:
+    """
+    Turns a cursor back into the key values of the last row of the previous page,
+    typed like the given ordering columns
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("cursor does not match the ordering of this list")
+        return [
+            datetime.fromisoformat(value) if column.type.python_type is datetime else column.type.python_type(value)
+            for value, column in zip(values, columns)
+        ]
+    except (ValueError, TypeError, UnicodeDecodeError, json.JSONDecodeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+
+
+def keyset(query, cursor: Optional[str], limit: int, *columns, descending: bool = False):
+    """
+    Orders the query by the given columns and keeps only the rows that come
+    after the cursor, so every page is an index range scan instead of an OFFSET.
+    descending orders by all the columns, largest first
+    """
+    if cursor:
+        values = decode_cursor(cursor, *columns)
+        after = tuple_(*columns) < tuple_(*values) if descending else tuple_(*columns) > tuple_(*values)
+        query = query.filter(after)
+    return query.order_by(*(column.desc() for column in columns) if descending else columns).limit(limit)
+
+
+def next_cursor(items: list, limit: int, *columns) -> Optional[str]:
+    # A short page is the last one
+    if not items or len(items) < limit:
+        return None
+    return encode_cursor(*(getattr(items[-1], column.key) for column in columns))
+
+
+def cursor_headers(items: list, limit: int, *columns) -> dict:
+    cursor = next_cursor(items, limit, *columns)
+    return {NEXT_CURSOR_HEADER: cursor} if cursor else {}
+
+
+def tail_headers(items: list, limit: int, *columns) -> dict:
+    """cursor_headers, plus the cursor of the last item"""
+    headers = cursor_headers(items, limit, *columns)
+    if items:
+        headers[LAST_CURSOR_HEADER] = encode_cursor(*(getattr(items[-1], column.key) for column in columns))
+    return headers
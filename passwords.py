@@ -0,0 +1,100 @@
+# passwords.py
+"""
+Password hashing and verification on a dedicated, size-limited process pool.
+bcrypt is slow on purpose, running it in the request workers lets a burst of
+logins starve every other endpoint. When more than PASSWORD_MAX_PENDING
+operations are waiting the request is refused with a 503 and a Retry-After.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+# 0 runs the hashing on threads of the API process instead of a process pool
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_MAX_PENDING = int(os.environ.get("PASSWORD_MAX_PENDING", max(PASSWORD_WORKERS, 1) * 8))
+PASSWORD_RETRY_AFTER = int(os.environ.get("PASSWORD_RETRY_AFTER", 1))
+
+# Hashes made with any other number of rounds are reported as needing an update
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor: Optional[Executor] = None
+_lock = threading.Lock()
+_stats = {"pending": 0, "peak_pending": 0, "completed": 0, "rejected": 0}
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def get_executor() -> Executor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            if PASSWORD_WORKERS > 0:
+                # spawn behaves the same on every platform and is safe with the server's threads
+                _executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="passwords")
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, workers=PASSWORD_WORKERS, max_pending=PASSWORD_MAX_PENDING)
+
+
+async def _submit(fn, *args):
+    with _lock:
+        if _stats["pending"] >= PASSWORD_MAX_PENDING:
+            _stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="The server is busy, please try again shortly",
+                headers={"Retry-After": str(PASSWORD_RETRY_AFTER)},
+            )
+        _stats["pending"] += 1
+        _stats["peak_pending"] = max(_stats["peak_pending"], _stats["pending"])
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), fn, *args)
+    finally:
+        with _lock:
+            _stats["pending"] -= 1
+            _stats["completed"] += 1
+
+
+async def hash_password(password: str) -> str:
+    return await _submit(_hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Returns whether the password matches, and a new hash of it when the stored
+    one was made with other cost parameters than the current ones
+    """
+    return await _submit(_verify_and_update, password, hashed_password)
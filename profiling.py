@@ -0,0 +1,278 @@
+# profiling.py
+"""
+On demand profiling of single requests, for production-like runs.
+Profiling is off unless PROFILE_TOKEN is set. A request is profiled when it
+carries the header "X-Profile: <PROFILE_TOKEN>", or when the next requests of
+a route were armed with POST /profiling. While it runs, a thread samples the
+Python stacks of the request every PROFILE_INTERVAL seconds: its task on the
+event loop, and the threadpool workers running its crud functions. Samples
+taken while the request is waiting on neither (a password hash in the process
+pool, the network) are counted as "(waiting)". Every SQL statement is recorded
+with its duration and the application frames that issued it.
+The report is kept in memory, its id is returned in the X-Profile-Id header,
+and GET /profiling/{id}/collapsed returns the stacks in the collapsed format
+read by flamegraph.pl and speedscope.
+"""
+import asyncio
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from fastapi import Header, HTTPException, status
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import logs
+
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.001))
+# Number of reports kept, the oldest ones are dropped
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))
+
+PROFILE_HEADER = "x-profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+_THIS_FILE = os.path.abspath(__file__)
+APP_DIR = os.path.dirname(_THIS_FILE)
+# Frames of the machinery that runs a request, left out of the root of the stacks
+_RUNNER_PATHS = (f"{os.sep}asyncio{os.sep}", f"{os.sep}threading.py", f"{os.sep}concurrent{os.sep}", f"{os.sep}anyio{os.sep}")
+WAITING = "(waiting)"
+
+
+class Profile:
+    def __init__(self, route: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.route = route
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.status_code: Optional[int] = None
+        self.stacks: Counter = Counter()
+        self.statements: List[dict] = []
+        # Threadpool workers running the request's code right now
+        self.threads: Dict[int, int] = {}
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._loop_thread = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name=f"profile-{self.id}", daemon=True)
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self._started
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_INTERVAL):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self.threads)
+            if asyncio.current_task(self._loop) is self._task:
+                threads.append(self._loop_thread)
+            sampled = False
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[_collapse(frame)] += 1
+                    sampled = True
+            if not sampled:
+                self.stacks[WAITING] += 1
+
+    def enter_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self.threads[ident] = self.threads.get(ident, 0) + 1
+
+    def leave_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self.threads[ident] -= 1
+            if not self.threads[ident]:
+                del self.threads[ident]
+
+    def collapsed(self) -> str:
+        """One "root;...;leaf count" line per distinct stack"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def report(self) -> dict:
+        return {
+            "id": self.id,
+            "route": self.route,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "status_code": self.status_code,
+            "samples": sum(self.stacks.values()),
+            "interval": PROFILE_INTERVAL,
+            "db_time": sum(statement["duration"] for statement in self.statements),
+            "statements": self.statements,
+            "hottest_stacks": [{"stack": stack.split(";"), "samples": count} for stack, count in self.stacks.most_common(10)],
+        }
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        stack.append(frame)
+        frame = frame.f_back
+    stack.reverse()
+    # Start the stack at the first frame that is not the event loop or a worker thread
+    while len(stack) > 1 and any(path in stack[0].f_code.co_filename for path in _RUNNER_PATHS):
+        stack.pop(0)
+    return ";".join(_label(frame) for frame in stack)
+
+
+def _app_stack() -> List[str]:
+    """The frames of this application that led to a statement, outermost first"""
+    stack = []
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and "site-packages" not in filename and filename != _THIS_FILE:
+            stack.append(f"{os.path.basename(filename)}:{frame.f_lineno} {frame.f_code.co_name}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+_current: ContextVar[Optional[Profile]] = ContextVar("profile", default=None)
+_reports: "OrderedDict[str, Profile]" = OrderedDict()
+# Routes armed through POST /profiling, with the number of requests left to profile
+_armed: Dict[str, int] = {}
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(PROFILE_TOKEN)
+
+
+def _valid_token(token: bytes) -> bool:
+    # In constant time, the token must not be guessed from the response times
+    return enabled() and hmac.compare_digest(token, PROFILE_TOKEN.encode())
+
+
+def require_token(x_profile_token: str = Header("")):
+    """Dependency of the profiling endpoints"""
+    if not enabled():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiling is disabled")
+    if not _valid_token(x_profile_token.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid profiling token")
+
+
+def arm(route: str, count: int):
+    with _lock:
+        _armed[route] = count
+
+
+def get_report(profile_id: str) -> Optional[Profile]:
+    with _lock:
+        return _reports.get(profile_id)
+
+
+def list_reports() -> List[dict]:
+    with _lock:
+        profiles = list(_reports.values())
+    return [{"id": profile.id, "route": profile.route, "started_at": profile.started_at, "duration": profile.duration} for profile in reversed(profiles)]
+
+
+def _store(profile: Profile):
+    with _lock:
+        _reports[profile.id] = profile
+        while len(_reports) > PROFILE_KEEP:
+            _reports.popitem(last=False)
+
+
+def _take_armed(route: str) -> bool:
+    with _lock:
+        remaining = _armed.get(route)
+        if not remaining:
+            return False
+        if remaining == 1:
+            del _armed[route]
+        else:
+            _armed[route] = remaining - 1
+        return True
+
+
+def traced(fn):
+    """
+    Wraps a function about to run in the threadpool, so the sampler follows the
+    worker thread while it runs the function for a profiled request
+    """
+    profile = _current.get()
+    if profile is None:
+        return fn
+
+    def wrapper(*args, **kwargs):
+        profile.enter_thread()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.leave_thread()
+
+    return wrapper
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    started = conn.info.get("profile_started")
+    if profile is None or not started:
+        return
+    profile.statements.append({
+        "statement": statement,
+        "executemany": executemany,
+        "duration": time.perf_counter() - started.pop(),
+        "stack": _app_stack(),
+    })
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not enabled() or scope["path"].startswith("/profiling"):
+            return await self.app(scope, receive, send)
+        requested = _valid_token(dict(scope["headers"]).get(PROFILE_HEADER.encode(), b""))
+        route = logs.route_name(scope["app"], scope)
+        if not requested and not (_armed and _take_armed(route)):
+            return await self.app(scope, receive, send)
+
+        profile = Profile(route)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+                message = dict(message, headers=[*message.get("headers", []), (PROFILE_ID_HEADER.lower().encode(), profile.id.encode())])
+            await send(message)
+
+        token = _current.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profile.stop()
+            _current.reset(token)
+            _store(profile)
@@ -0,0 +1,281 @@
+# ratelimit.py
+"""
+Rate limiting and admission control, in front of every endpoint.
+
+Each client gets a token bucket per route: a route budget of "10/60" allows
+bursts of 10 requests, refilled at 10 per 60 seconds. Clients are told apart
+by the user id of their access token, or their IP address without one (behind
+a proxy, run uvicorn with --proxy-headers). A request over budget is answered
+429 with a Retry-After. RATE_LIMITS sets the budgets, e.g.
+"POST /login=10/60, GET /movies/Search=20/10, *=600/60", * is the budget of
+the other routes and an empty value turns rate limiting off.
+RATE_LIMIT_BACKEND=memory (default) keeps the buckets in the process,
+RATE_LIMIT_BACKEND=redis shares them between processes through REDIS_URL.
+
+Admission control caps the requests being processed at once at
+ADMISSION_MAX_CONCURRENT. The requests above it wait up to
+ADMISSION_QUEUE_TIMEOUT_MS for a slot, then are answered 503, instead of
+piling up on the database pool. Long lived responses such as the comment
+stream don't take a slot.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import orjson
+from loguru import logger
+
+import auth, logs
+from database import DB_MAX_OVERFLOW, DB_POOL_SIZE
+
+
+def parse_budgets(value: str) -> Dict[str, Tuple[int, float]]:
+    """ "route=requests/seconds, ..." to the capacity and the refill per second of each route"""
+    budgets = {}
+    for item in value.split(","):
+        if item.strip():
+            route, _, budget = item.rpartition("=")
+            requests, _, seconds = budget.partition("/")
+            budgets[route.strip()] = (int(requests), int(requests) / float(seconds or 1))
+    return budgets
+
+
+RATE_LIMITS = parse_budgets(os.environ.get(
+    "RATE_LIMITS", "POST /login=10/60, POST /Registration=5/60, GET /movies/Search=20/10, *=600/60",
+))
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+# Buckets kept by the memory backend, the least recently used ones go first
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# As many as the database pool has connections by default, 0 turns admission control off
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", DB_POOL_SIZE + DB_MAX_OVERFLOW))
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS", 2000))
+ADMISSION_EXEMPT_ROUTES = {
+    route.strip()
+    for route in os.environ.get("ADMISSION_EXEMPT_ROUTES", "GET /metrics, GET /health, GET /ready, GET /movies/{movie_id}/comments/stream, GET /movies/export").split(",")
+    if route.strip()
+}
+
+
+class MemoryBackend:
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def take(self, key: str, capacity: int, rate: float) -> Tuple[bool, float]:
+        """Takes a token of the bucket, returns whether there was one and the tokens left"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(capacity), now]
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            allowed = bucket[0] >= 1
+            if allowed:
+                bucket[0] -= 1
+            return allowed, bucket[0]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBackend:
+    prefix = "movieapp:ratelimit:"
+    # Refill and take in one step on the server, with the server's clock
+    script = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+    local tokens = math.min(capacity, (tonumber(bucket[1]) or capacity) + (now - (tonumber(bucket[2]) or now)) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, client=None):
+        if client is None:
+            import redis.asyncio
+
+            client = redis.asyncio.Redis.from_url(REDIS_URL)
+        self.client = client
+        self._take = client.register_script(self.script)
+
+    async def take(self, key: str, capacity: int, rate: float) -> Tuple[bool, float]:
+        try:
+            allowed, tokens = await self._take(keys=[self.prefix + key], args=[capacity, rate])
+        except Exception:
+            # An unreachable store doesn't take the API down with it
+            logger.opt(exception=True).warning("Rate limit store unavailable, letting the request through")
+            return True, capacity
+        return bool(allowed), float(tokens)
+
+    def clear(self):
+        pass
+
+
+BACKENDS = {"memory": MemoryBackend, "redis": RedisBackend}
+
+if RATE_LIMIT_BACKEND not in BACKENDS:
+    raise ValueError(f"RATE_LIMIT_BACKEND must be one of {sorted(BACKENDS)}, not {RATE_LIMIT_BACKEND!r}")
+
+_backend = None
+_lock = threading.Lock()
+_stats = {"limited": 0, "shed": 0, "active": 0, "waiting": 0}
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[RATE_LIMIT_BACKEND]()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def _count(counter: str, delta: int = 1):
+    with _lock:
+        _stats[counter] += delta
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, max_concurrent=admission.limit if admission is not None else 0)
+
+
+# Keys of the recently seen tokens with their expiry, the least recently used ones go first
+TOKEN_KEYS_MAX = 10000
+_token_keys: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+
+
+def _token_key(authorization: str) -> Optional[str]:
+    """The user of a valid token, decoded once per token until it expires"""
+    now = time.time()
+    with _lock:
+        cached = _token_keys.get(authorization)
+        if cached is not None and cached[1] > now:
+            _token_keys.move_to_end(authorization)
+            return cached[0]
+    payload = auth.token_payload(authorization)
+    # An expired or invalid token is rate limited by its client's address
+    key = f"user:{payload.get('uid') or payload.get('sub')}" if payload is not None else None
+    expires = float(payload.get("exp", math.inf)) if payload is not None else math.inf
+    with _lock:
+        _token_keys[authorization] = (key, expires)
+        _token_keys.move_to_end(authorization)
+        while len(_token_keys) > TOKEN_KEYS_MAX:
+            _token_keys.popitem(last=False)
+    return key
+
+
+def client_key(scope) -> str:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            key = _token_key(value.decode("latin-1"))
+            if key is not None:
+                return key
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class Admission:
+    """At most limit requests at once, the others wait in line up to timeout seconds"""
+
+    def __init__(self, limit: int = ADMISSION_MAX_CONCURRENT, timeout: float = ADMISSION_QUEUE_TIMEOUT_MS / 1000):
+        self.limit = limit
+        self.timeout = timeout
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def acquire(self) -> bool:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            _count("active")
+            return True
+        _count("waiting")
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            _count("waiting", -1)
+        _count("active")
+        return True
+
+    def release(self):
+        _count("active", -1)
+        self._semaphore.release()
+
+
+admission: Optional[Admission] = Admission() if ADMISSION_MAX_CONCURRENT > 0 else None
+
+
+def _response(status_code: int, detail: str, headers: Dict[str, str]):
+    body = orjson.dumps({"detail": detail})
+    raw_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    raw_headers += [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    return {"type": "http.response.start", "status": status_code, "headers": raw_headers}, {"type": "http.response.body", "body": body}
+
+
+class RateLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = logs.route_name(scope["app"], scope)
+        budget = RATE_LIMITS.get(route) or RATE_LIMITS.get("*")
+        headers = {}
+        if budget is not None:
+            capacity, rate = budget
+            client = client_key(scope)
+            allowed, tokens = await get_backend().take(f"{route}|{client}", capacity, rate)
+            headers = {"X-RateLimit-Limit": str(capacity), "X-RateLimit-Remaining": str(max(int(tokens), 0))}
+            if not allowed:
+                _count("limited")
+                logger.warning("Rate limited {} on {}", client, route)
+                headers["Retry-After"] = str(max(math.ceil((1 - tokens) / rate), 1))
+                for message in _response(429, "Too many requests, please try again later", headers):
+                    await send(message)
+                return
+
+        gate = admission if route not in ADMISSION_EXEMPT_ROUTES else None
+        if gate is not None and not await gate.acquire():
+            _count("shed")
+            logger.warning("Shed {}, {} requests in progress", route, gate.limit)
+            for message in _response(503, "The server is busy, please try again", {"Retry-After": "1"}):
+                await send(message)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start" and headers:
+                message["headers"] = list(message.get("headers", [])) + [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            if gate is not None:
+                gate.release()
@@ -0,0 +1,304 @@
+# recommend.py
+"""
+Item-item recommendations from the ratings table.
+Two movies are similar when the same users rate them alike: the similarity is
+the cosine of their rating columns, each centered on the movie's average, in
+the sparse user x movie matrix. Only the RECOMMEND_NEIGHBOURS most similar
+movies of every movie are kept, in two (movies x K) arrays, so a lookup is an
+array slice and a user's recommendations a weighted sum over the neighbours of
+the movies they rated, both served from memory.
+
+The ratings are read as plain columns in partitions, never as ORM objects.
+Ratings are never updated, so refresh() only reads the ones added since the
+last build, recomputes the neighbours of the movies they rated and merges the
+new similarities into the other lists. A full rebuild runs every
+RECOMMEND_FULL_REBUILD seconds, it also picks up ratings that committed out of
+id order on PostgreSQL.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from scipy import sparse
+from sqlalchemy import func, select
+
+import models
+from database import SessionLocal
+
+
+RECOMMEND_NEIGHBOURS = int(os.environ.get("RECOMMEND_NEIGHBOURS", 20))
+# Seconds between two incremental refreshes, 0 disables the background refresh
+RECOMMEND_REFRESH_SECONDS = float(os.environ.get("RECOMMEND_REFRESH_SECONDS", 60))
+RECOMMEND_FULL_REBUILD = float(os.environ.get("RECOMMEND_FULL_REBUILD", 6 * 3600))
+# Movies whose similarities are computed in one sparse product
+RECOMMEND_BLOCK_SIZE = int(os.environ.get("RECOMMEND_BLOCK_SIZE", 1024))
+READ_CHUNK_SIZE = 100_000
+
+
+def _top(columns: np.ndarray, values: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The k largest positive values and their columns, largest first"""
+    positive = values > 0
+    columns, values = columns[positive], values[positive]
+    if len(values) > k:
+        keep = np.argpartition(values, -k)[-k:]
+        columns, values = columns[keep], values[keep]
+    order = np.argsort(-values, kind="stable")
+    return columns[order], values[order]
+
+
+class Index:
+    """An immutable build of the model, replaced as a whole by each refresh"""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.built_at = 0.0
+        self.last_rating_id = 0
+        self.movie_ids = np.zeros(0, dtype=np.int64)
+        self.movie_index: Dict[int, int] = {}
+        self.user_index: Dict[int, int] = {}
+        # The ratings, as parallel arrays of matrix coordinates
+        self.rows = np.zeros(0, dtype=np.int32)
+        self.columns = np.zeros(0, dtype=np.int32)
+        self.ratings = np.zeros(0, dtype=np.float32)
+        self.means = np.zeros(0, dtype=np.float32)
+        # The users' ratings centered on the movie averages, a row per user
+        self.by_user = sparse.csr_matrix((0, 0), dtype=np.float32)
+        # Neighbours of each movie, as movie indexes padded with -1
+        self.neighbours = np.full((0, k), -1, dtype=np.int32)
+        self.scores = np.zeros((0, k), dtype=np.float32)
+
+    @property
+    def size(self) -> int:
+        return len(self.ratings)
+
+
+class ItemSimilarity:
+    def __init__(self, k: int = RECOMMEND_NEIGHBOURS):
+        self.k = k
+        self.index = Index(k)
+        self._lock = threading.Lock()
+        self._stats = {"builds": 0, "refreshes": 0, "build_seconds": 0.0}
+
+    # Serving
+
+    def similar(self, movie_id: int, limit: int = 10) -> Optional[List[Tuple[int, float]]]:
+        """The neighbours of a movie with their similarity, None when the model does not know the movie"""
+        index = self.index
+        position = index.movie_index.get(movie_id)
+        if position is None:
+            return None
+        neighbours = index.neighbours[position, :limit]
+        valid = neighbours >= 0
+        return list(zip(index.movie_ids[neighbours[valid]].tolist(), index.scores[position, :limit][valid].tolist()))
+
+    def recommend(self, user_id: int, limit: int = 10) -> List[Tuple[int, float]]:
+        """
+        Movies the user has not rated, with their predicted rating: the movie's
+        average moved by the user's centered ratings of its neighbours
+        """
+        index = self.index
+        row = index.user_index.get(user_id)
+        if row is None:
+            return []
+        start, end = index.by_user.indptr[row], index.by_user.indptr[row + 1]
+        rated, centered = index.by_user.indices[start:end], index.by_user.data[start:end]
+        neighbours, scores = index.neighbours[rated], index.scores[rated]
+        valid = neighbours >= 0
+        candidates = neighbours[valid]
+        if not len(candidates):
+            return []
+        weights = scores[valid]
+        movies, positions = np.unique(candidates, return_inverse=True)
+        total = np.bincount(positions, weights=weights * np.broadcast_to(centered[:, None], scores.shape)[valid])
+        # Shrunk towards the movie average when few neighbours back the prediction
+        predicted = index.means[movies] + total / (np.bincount(positions, weights=weights) + 1)
+        predicted[np.isin(movies, rated)] = -np.inf
+        count = min(limit, int(np.isfinite(predicted).sum()))
+        best = np.argsort(-predicted, kind="stable")[:count]
+        return list(zip(index.movie_ids[movies[best]].tolist(), predicted[best].astype(float).tolist()))
+
+    def stats(self) -> dict:
+        index = self.index
+        return dict(self._stats, movies=len(index.movie_ids), users=len(index.user_index), ratings=index.size)
+
+    # Building
+
+    def refresh(self, full: bool = False) -> int:
+        """Adds the ratings created since the last build, returns how many"""
+        with self._lock:
+            started = time.perf_counter()
+            current = self.index
+            if full or not current.built_at:
+                current = Index(self.k)
+            ids, users, movies, ratings = _read_ratings(current.last_rating_id)
+            if current.built_at and not len(ids):
+                return 0
+            index = _extend(current, users, movies, ratings)
+            index.last_rating_id = int(ids.max()) if len(ids) else current.last_rating_id
+            normalized = _normalize(index)
+            if current.built_at:
+                _update(index, normalized, np.unique(index.columns[current.size:]))
+                self._stats["refreshes"] += 1
+            else:
+                _recompute(index, normalized, np.arange(len(index.movie_ids)))
+                self._stats["builds"] += 1
+            index.built_at = time.time()
+            self.index = index
+            self._stats["build_seconds"] = time.perf_counter() - started
+        logger.info("Recommendation model {} with {} ratings in {:.3f}s", "refreshed" if current.built_at else "built", len(ids), self._stats["build_seconds"])
+        return len(ids)
+
+
+def _read_ratings(after_id: int):
+    """The ratings with a larger id, streamed as column arrays"""
+    statement = (
+        select(models.Rating.id, models.Rating.user_id, models.Rating.movie_id, models.Rating.rating)
+        .where(models.Rating.id > after_id)
+        .execution_options(yield_per=READ_CHUNK_SIZE)
+    )
+    chunks = []
+    with SessionLocal() as db:
+        for partition in db.execute(statement).partitions():
+            chunks.append(np.array(partition, dtype=np.float64).reshape(-1, 4))
+    data = np.concatenate(chunks) if chunks else np.zeros((0, 4))
+    return data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2].astype(np.int64), data[:, 3].astype(np.float32)
+
+
+def _positions(mapping: Dict[int, int], ids: np.ndarray) -> np.ndarray:
+    """Matrix positions of the ids, new ids are appended to the mapping"""
+    unique, inverse = np.unique(ids, return_inverse=True)
+    for value in unique.tolist():
+        mapping.setdefault(value, len(mapping))
+    return np.fromiter((mapping[value] for value in unique.tolist()), dtype=np.int32, count=len(unique))[inverse]
+
+
+def _extend(current: Index, users: np.ndarray, movies: np.ndarray, ratings: np.ndarray) -> Index:
+    index = Index(current.k)
+    index.user_index = dict(current.user_index)
+    index.movie_index = dict(current.movie_index)
+    index.rows = np.concatenate([current.rows, _positions(index.user_index, users)])
+    index.columns = np.concatenate([current.columns, _positions(index.movie_index, movies)])
+    index.ratings = np.concatenate([current.ratings, ratings])
+    index.movie_ids = np.array(list(index.movie_index), dtype=np.int64)
+    added = len(index.movie_ids) - len(current.movie_ids)
+    index.neighbours = np.vstack([current.neighbours, np.full((added, index.k), -1, dtype=np.int32)])
+    index.scores = np.vstack([current.scores, np.zeros((added, index.k), dtype=np.float32)])
+    return index
+
+
+def _normalize(index: Index) -> sparse.csc_matrix:
+    """The centered rating columns scaled to unit length, a column per movie"""
+    shape = (len(index.user_index), len(index.movie_ids))
+    counts = np.bincount(index.columns, minlength=shape[1])
+    index.means = (np.bincount(index.columns, weights=index.ratings, minlength=shape[1]) / np.maximum(counts, 1)).astype(np.float32)
+    centered = index.ratings - index.means[index.columns]
+    index.by_user = sparse.csr_matrix((centered, (index.rows, index.columns)), shape=shape, dtype=np.float32)
+    norms = np.sqrt(np.bincount(index.columns, weights=centered.astype(np.float64) ** 2, minlength=shape[1]))
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.csc_matrix((centered * scale[index.columns], (index.rows, index.columns)), shape=shape, dtype=np.float32)
+
+
+def _similarities(normalized: sparse.csc_matrix, movies: np.ndarray):
+    """Yields each movie with the columns and values of its similarities to all movies"""
+    transposed = normalized.T.tocsr()
+    for start in range(0, len(movies), RECOMMEND_BLOCK_SIZE):
+        block = movies[start:start + RECOMMEND_BLOCK_SIZE]
+        products = (transposed @ normalized[:, block]).tocsc()
+        for offset, movie in enumerate(block):
+            begin, end = products.indptr[offset], products.indptr[offset + 1]
+            columns, values = products.indices[begin:end], products.data[begin:end]
+            other = columns != movie
+            yield movie, columns[other], values[other]
+
+
+def _store(index: Index, movie: int, columns: np.ndarray, values: np.ndarray):
+    columns, values = _top(columns, values, index.k)
+    index.neighbours[movie] = -1
+    index.scores[movie] = 0
+    index.neighbours[movie, :len(columns)] = columns
+    index.scores[movie, :len(values)] = values
+
+
+def _recompute(index: Index, normalized: sparse.csc_matrix, movies: np.ndarray):
+    for movie, columns, values in _similarities(normalized, movies):
+        _store(index, movie, columns, values)
+
+
+def _update(index: Index, normalized: sparse.csc_matrix, dirty: np.ndarray):
+    """
+    Only the columns of the newly rated movies changed, so only their similarities
+    did. Their lists are recomputed and the new values merged into the others. A
+    full list that lost or lowered a changed neighbour may be missing the next
+    best movie, it is recomputed.
+    """
+    changed: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+    for movie, columns, values in _similarities(normalized, dirty):
+        changed[movie] = (columns, values)
+    # Symmetry gives the new similarity of every movie to each changed one
+    incoming: Dict[int, List[Tuple[int, float]]] = {}
+    for movie, (columns, values) in changed.items():
+        for other, value in zip(columns.tolist(), values.tolist()):
+            if other not in changed and value > 0:
+                incoming.setdefault(other, []).append((movie, value))
+        _store(index, movie, columns, values)
+
+    is_dirty = np.zeros(len(index.movie_ids), dtype=bool)
+    is_dirty[dirty] = True
+    affected = set(incoming) | set(np.nonzero((is_dirty[np.maximum(index.neighbours, 0)] & (index.neighbours >= 0)).any(axis=1))[0].tolist())
+    recompute = []
+    for movie in affected:
+        if is_dirty[movie]:
+            continue
+        neighbours, scores = index.neighbours[movie], index.scores[movie]
+        listed = neighbours >= 0
+        new = dict(incoming.get(movie, ()))
+        stale = listed & is_dirty[np.maximum(neighbours, 0)]
+        if listed.all() and any(new.get(neighbour, 0.0) < score for neighbour, score in zip(neighbours[stale].tolist(), scores[stale].tolist())):
+            recompute.append(movie)
+            continue
+        kept = listed & ~stale
+        columns = np.concatenate([neighbours[kept], np.fromiter(new, dtype=np.int32, count=len(new))])
+        values = np.concatenate([scores[kept], np.fromiter(new.values(), dtype=np.float32, count=len(new))])
+        _store(index, movie, columns, values)
+    if recompute:
+        _recompute(index, normalized, np.array(recompute, dtype=np.int32))
+
+
+model = ItemSimilarity()
+
+
+def _refresh_forever(stop: threading.Event, build: bool = True):
+    if build:
+        try:
+            model.refresh(full=True)
+        except Exception:
+            logger.exception("Building the recommendation model failed")
+    last_full = time.monotonic()
+    while RECOMMEND_REFRESH_SECONDS > 0 and not stop.wait(RECOMMEND_REFRESH_SECONDS):
+        full = time.monotonic() - last_full > RECOMMEND_FULL_REBUILD
+        try:
+            model.refresh(full=full)
+            if full:
+                last_full = time.monotonic()
+        except Exception:
+            logger.exception("Refreshing the recommendation model failed")
+
+
+_stop = threading.Event()
+
+
+def start(build: bool = True):
+    """
+    Builds the model and keeps it refreshed from a background thread, the
+    endpoints answer with empty lists until the first build is done. build=False
+    when the model was built already, e.g. by the startup pre-warm
+    """
+    _stop.clear()
+    threading.Thread(target=_refresh_forever, args=(_stop, build), name="recommend-refresh", daemon=True).start()
+
+
+def stop():
+    _stop.set()
@@ -0,0 +1,33 @@
+# repair_rating_stats.py
+"""
+Rebuilds the per movie rating aggregates (count, sum, histogram) from the ratings table.
+
+    python repair_rating_stats.py              # every movie
+    python repair_rating_stats.py 12 40        # only movies 12 and 40
+"""
+import sys
+
+from loguru import logger
+
+import crud, leaderboard, migrations
+from database import SessionLocal, get_engine
+
+
+def main(movie_ids):
+    # The schema the API runs on, see migrations.py
+    migrations.upgrade()
+    leaderboard.init(get_engine())
+    db = SessionLocal()
+    try:
+        if not movie_ids:
+            crud.rebuild_rating_stats(db)
+            logger.info("Rebuilt the rating aggregates of every movie")
+        for movie_id in movie_ids:
+            crud.rebuild_rating_stats(db, movie_id=movie_id)
+            logger.info("Rebuilt the rating aggregate of movie_id {}", movie_id)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main([int(movie_id) for movie_id in sys.argv[1:]])
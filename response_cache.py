@@ -0,0 +1,244 @@
+# response_cache.py
+"""
+Conditional GETs and a server side cache of serialized response bodies.
+Every cached response depends on a few resources ("movies", "movie:3",
+"ratings:3", ...) whose version is bumped by the crud write functions after
+they commit. The ETag of a response is derived from those versions and the
+request URL, so a matching If-None-Match is answered with a 304 before any
+query runs, and a known ETag is answered from the body cache. Bodies and
+ETags live at most RESPONSE_CACHE_MAX_AGE_SECONDS, which bounds how long a
+worker of serve.py that missed a bump can serve a stale response.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from fastapi import Request, Response, status
+from loguru import logger
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+import broadcast, models
+from database import DB_REPLICA_URLS, SessionLocal
+
+
+# Total size of the cached bodies, the least recently used ones are evicted past it
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Longest life of a cached body and of an ETag, in case a bump from another worker was lost. 0 keeps them
+RESPONSE_CACHE_MAX_AGE_SECONDS = float(os.environ.get("RESPONSE_CACHE_MAX_AGE_SECONDS", 300))
+# How long after a bump a read replica may still return the old rows: the
+# responses of those resources are neither cached nor given an ETag meanwhile
+RESPONSE_CACHE_REPLICA_LAG_SECONDS = float(os.environ.get("RESPONSE_CACHE_REPLICA_LAG_SECONDS", 2 if DB_REPLICA_URLS else 0))
+# Seconds between the reads of the stored generation, 0 never reads it
+RESPONSE_CACHE_SYNC_SECONDS = float(os.environ.get("RESPONSE_CACHE_SYNC_SECONDS", 5))
+GENERATION_ID = 1
+
+MOVIES = "movies"
+
+def movie(movie_id: int) -> str:
+    return f"movie:{movie_id}"
+
+def ratings(movie_id: int) -> str:
+    return f"ratings:{movie_id}"
+
+def comments(movie_id: int) -> str:
+    return f"comments:{movie_id}"
+
+
+class ResponseCache:
+    def __init__(
+        self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, max_age: float = RESPONSE_CACHE_MAX_AGE_SECONDS,
+        replica_lag: float = RESPONSE_CACHE_REPLICA_LAG_SECONDS,
+    ):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.replica_lag = replica_lag
+        # Versions restart from 0 with the process, the epoch keeps old ETags from matching
+        self.epoch = uuid.uuid4().hex[:8]
+        self._epoch_started = time.monotonic()
+        self._versions: Dict[str, int] = {}
+        self._bumped_at: Dict[str, float] = {}
+        self._bodies: "OrderedDict[str, Tuple[bytes, dict]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0, "uncached": 0}
+
+    def bump(self, *resources: str):
+        now = time.monotonic()
+        with self._lock:
+            for resource in resources:
+                self._versions[resource] = self._versions.get(resource, 0) + 1
+                self._bumped_at[resource] = now
+
+    def settling(self, resources: Iterable[str]) -> bool:
+        """Whether one of the resources was bumped too recently for the replicas to have caught up"""
+        if not self.replica_lag:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            settling = any(now - self._bumped_at.get(resource, float("-inf")) < self.replica_lag for resource in resources)
+            if settling:
+                self._stats["uncached"] += 1
+            return settling
+
+    def etag(self, resources: Iterable[str], variant: str) -> str:
+        with self._lock:
+            if self.max_age and time.monotonic() - self._epoch_started > self.max_age:
+                self._new_epoch()
+            versions = ",".join(f"{resource}={self._versions.get(resource, 0)}" for resource in resources)
+            epoch = self.epoch
+        digest = hashlib.sha1(f"{epoch}|{versions}|{variant}".encode()).hexdigest()[:20]
+        return f'W/"{digest}"'
+
+    def get(self, etag: str) -> Optional[Tuple[bytes, dict]]:
+        with self._lock:
+            entry = self._bodies.get(etag)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._bodies.move_to_end(etag)
+            self._stats["hits"] += 1
+            return entry
+
+    def put(self, etag: str, body: bytes, headers: dict):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._bodies.pop(etag, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._bodies[etag] = (body, headers)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._bodies.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats["evictions"] += 1
+
+    def not_modified(self):
+        with self._lock:
+            self._stats["not_modified"] += 1
+
+    def _new_epoch(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._epoch_started = time.monotonic()
+        self._bodies.clear()
+        self._size = 0
+
+    def invalidate_all(self):
+        with self._lock:
+            self._new_epoch()
+
+    def reset(self):
+        """Starts over with a new epoch and no versions, in a process just forked"""
+        self._lock = threading.Lock()
+        self._versions.clear()
+        self._bumped_at.clear()
+        self._new_epoch()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, entries=len(self._bodies), bytes=self._size, max_bytes=self.max_bytes)
+
+
+cache = ResponseCache()
+# The workers of serve.py are forked from a master that imported the app: each
+# one counts its versions from 0 again, under an epoch of its own
+os.register_at_fork(after_in_child=cache.reset)
+
+# The other workers of serve.py bump their own versions, see broadcast.py
+def bump(*resources: str):
+    cache.bump(*resources)
+    broadcast.publish("bump", resources)
+
+def invalidate_all():
+    cache.invalidate_all()
+    broadcast.publish("invalidate_all", None)
+
+broadcast.subscribe("bump", lambda resources: cache.bump(*resources))
+broadcast.subscribe("invalidate_all", lambda _: cache.invalidate_all())
+
+
+# The stored generation reaches the processes broadcast.py doesn't, such as
+# those of a single uvicorn run, when another process (a repair job) bumps it
+def bump_stored_generation(db: Session):
+    """In the caller's transaction: every API process drops its cached responses within RESPONSE_CACHE_SYNC_SECONDS"""
+    generation = models.ResponseCacheGeneration
+    updated = db.execute(
+        update(generation).where(generation.id == GENERATION_ID).values(generation=generation.generation + 1)
+    ).rowcount
+    if not updated:
+        db.add(generation(id=GENERATION_ID, generation=1))
+
+_seen_generation: Optional[int] = None
+
+def sync(db: Session) -> bool:
+    """Drops the cached responses when the stored generation moved since the last call"""
+    global _seen_generation
+    stored = db.scalar(select(models.ResponseCacheGeneration.generation).where(models.ResponseCacheGeneration.id == GENERATION_ID)) or 0
+    moved = _seen_generation is not None and stored != _seen_generation
+    _seen_generation = stored
+    if moved:
+        cache.invalidate_all()
+        logger.info("Cached responses dropped, the stored generation moved to {}", stored)
+    return moved
+
+def _sync_forever(stop: threading.Event):
+    while True:
+        try:
+            with SessionLocal() as db:
+                sync(db)
+        except Exception:
+            logger.exception("Reading the stored response cache generation failed")
+        if stop.wait(RESPONSE_CACHE_SYNC_SECONDS):
+            return
+
+_stop = threading.Event()
+
+def start():
+    _stop.clear()
+    if RESPONSE_CACHE_SYNC_SECONDS > 0:
+        threading.Thread(target=_sync_forever, args=(_stop,), name="response-cache-sync", daemon=True).start()
+
+def stop():
+    _stop.set()
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return etag in candidates or etag[2:] in candidates
+
+
+async def serve(
+    request: Request,
+    resources: Iterable[str],
+    load: Callable[[], Awaitable[Tuple[object, dict]]],
+    dump: Callable[[object], bytes],
+) -> Response:
+    """
+    Answers a GET from the cache when possible. load() runs only on a miss and
+    returns the result to serialize with dump(), and extra response headers.
+    """
+    if cache.settling(resources):
+        # Possibly read from a replica without the write yet, it must not be kept under the new versions
+        result, extra_headers = await load()
+        return Response(content=dump(result), media_type="application/json", headers={**extra_headers, "Cache-Control": "no-cache"})
+    variant = f"{request.url.path}?{'&'.join(sorted(str(request.query_params).split('&')))}"
+    etag = cache.etag(resources, variant)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _matches(request.headers.get("if-none-match"), etag):
+        cache.not_modified()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    entry = cache.get(etag)
+    if entry is None:
+        result, extra_headers = await load()
+        body = dump(result)
+        entry = (body, extra_headers)
+        cache.put(etag, body, extra_headers)
+    body, extra_headers = entry
+    return Response(content=body, media_type="application/json", headers={**extra_headers, **headers})
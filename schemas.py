@@ -1,6 +1,6 @@
 # schemas.py
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, EmailStr, Field, field_validator
+from typing import List, Literal, Optional
 from datetime import datetime
 
 
@@ -31,6 +31,16 @@ class UserCreate(UserBase):
     email: EmailStr
     password: str
 
+# The authenticated user handed to the endpoints, cached per access token
+class CurrentUser(BaseModel):
+    id: int
+    username: str
+    full_name: Optional[str] = None
+    email: str
+
+    class Config:
+        orm_mode = True
+
 class User(UserBase): 
     email: EmailStr
     id: int
@@ -50,22 +60,66 @@ class MovieBase(BaseModel):
     year_released: int
     
 
+class RatingSummary(BaseModel):
+    count: int
+    sum: float
+    average: Optional[float] = None
+    # Number of ratings per star, from 0 to 5
+    histogram: List[int]
+
+    class Config:
+        orm_mode = True
+
 class Movie(MovieBase):
     id: int
     owner_id: int
     time_created: datetime
     owner: UserResponse
+    rating_stats: Optional[RatingSummary] = None
     
 
     class Config:
         orm_mode = True
 
+# A recommended movie, with its similarity or its predicted rating
+class ScoredMovie(Movie):
+    score: float
+
 class MovieCreate(MovieBase):
     pass
 
 class MovieUpdate(MovieBase):
     pass
 
+# Orders of GET /movies/, a leading "-" sorts largest first. rating is the top rated leaderboard score
+MovieSort = Literal["created", "-created", "year", "-year", "rating", "-rating"]
+
+# Filters of GET /movies/, names are matched whole and case insensitively
+class MovieFilter(BaseModel):
+    genre: Optional[str] = None
+    cast: Optional[str] = None
+    language: Optional[str] = None
+    director: Optional[str] = None
+    year_from: Optional[int] = None
+    year_to: Optional[int] = None
+    runtime_min: Optional[int] = Field(None, ge=0)
+    runtime_max: Optional[int] = Field(None, ge=0)
+
+# Report of POST /movies/bulk, rows are numbered from 1
+class BulkRowError(BaseModel):
+    row: int
+    errors: List[dict]
+
+class BulkImportReport(BaseModel):
+    created: int
+    failed: int
+    errors: List[BulkRowError]
+
+# Profiles the next count requests of a route
+class ProfileRequest(BaseModel):
+    route: str
+    count: int = Field(1, ge=1, le=100)
+
 
 
 class RatingBase(BaseModel):
@@ -113,6 +167,48 @@ class Comment(CommentBase):
 class CommentCreate(CommentBase):
     pass
 
+# A rating or comment taken by the write-behind queue, GET /writes/{write_id} tells how it ended
+class QueuedWrite(BaseModel):
+    id: str
+    status: Literal["queued", "committed", "failed"]
+
+class WriteStatus(QueuedWrite):
+    kind: Literal["rating", "comment"]
+    rating: Optional[Rating] = None
+    comment: Optional[Comment] = None
+    # Of a failed write, the error the endpoint would have answered with
+    status_code: Optional[int] = None
+    detail: Optional[str] = None
+
+
+# POST /movies/batch-get, each include costs one more query for the whole batch
+BATCH_MAX_IDS = 500
+
+class MovieBatchRequest(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=BATCH_MAX_IDS)
+    include: List[Literal["owner", "rating_stats", "latest_comments"]] = []
+    comments_per_movie: int = Field(3, ge=1, le=20)
+
+    @field_validator("ids")
+    @classmethod
+    def drop_duplicates(cls, ids: List[int]) -> List[int]:
+        return list(dict.fromkeys(ids))
+
+class BatchMovie(MovieBase):
+    id: int
+    owner_id: int
+    time_created: datetime
+    # Only present when included
+    owner: Optional[UserResponse] = None
+    rating_stats: Optional[RatingSummary] = None
+    latest_comments: Optional[List[Comment]] = None
+
+class MovieBatch(BaseModel):
+    # In the order of the requested ids
+    movies: List[BatchMovie]
+    # The requested ids that are not movies
+    missing: List[int]
+
 
 
     
@@ -0,0 +1,325 @@
+# search.py
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+from loguru import logger
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import broadcast, models
+
+
+# Columns of models.Movie covered by the search index, with the weight each one
+# contributes to the ranking of a result (a title hit counts more than a cast hit)
+SEARCH_FIELDS = {
+    "title": 10.0,
+    "cast": 4.0,
+    "director": 4.0,
+    "genres": 2.0,
+    "description": 1.0,
+}
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(value: Optional[str]) -> List[str]:
+    if not value:
+        return []
+    return [token.lower() for token in _TOKEN_RE.findall(value)]
+
+
+class SearchBackend:
+    """
+    Base class of the pluggable movie search index.
+    A backend is told about every movie written through crud.py and answers
+    searches with the ranked list of matching movie ids.
+    """
+    name = "base"
+
+    def setup(self, engine: Engine):
+        pass
+
+    def index_movie(self, db: Session, movie: models.Movie):
+        raise NotImplementedError
+
+    def index_movies(self, db: Session, movies: List[models.Movie]):
+        for movie in movies:
+            self.index_movie(db, movie)
+
+    def remove_movie(self, db: Session, movie_id: int):
+        raise NotImplementedError
+
+    def search(self, db: Session, query: str, skip: int = 0, limit: int = 10) -> List[int]:
+        raise NotImplementedError
+
+    def rebuild(self, db: Session):
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """
+    SQLite FTS5 virtual table kept next to the movies table, the rowid of an
+    entry is the id of the movie. The unicode61 tokenizer makes the matching
+    case insensitive and every query term is matched as a prefix.
+    """
+    name = "fts5"
+    table = "movies_fts"
+
+    def setup(self, engine: Engine):
+        # Create and drop the index together with the movies table
+        for identifier, listener in (("after_create", self._create_listener), ("before_drop", self._drop_listener)):
+            if not event.contains(models.Movie.__table__, identifier, listener):
+                event.listen(models.Movie.__table__, identifier, listener)
+        with engine.begin() as conn:
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": self.table},
+            ).first()
+            movies_exist = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": models.Movie.__tablename__},
+            ).first()
+            if movies_exist and not exists:
+                self._create(conn)
+                self._populate(conn)
+                logger.info("Search index {} built from the movies table", self.table)
+
+    @classmethod
+    def _create_listener(cls, target, connection, **kw):
+        cls._create(connection)
+
+    @classmethod
+    def _drop_listener(cls, target, connection, **kw):
+        connection.execute(text(f"DROP TABLE IF EXISTS {cls.table}"))
+
+    @classmethod
+    def _create(cls, conn):
+        columns = ", ".join(f'"{field}"' for field in SEARCH_FIELDS)
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {cls.table} "
+            f"USING fts5({columns}, tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+
+    def _populate(self, conn):
+        columns = ", ".join(f'"{field}"' for field in SEARCH_FIELDS)
+        conn.execute(text(
+            f"INSERT INTO {self.table}(rowid, {columns}) SELECT id, {columns} FROM movies"
+        ))
+
+    def index_movie(self, db: Session, movie: models.Movie):
+        columns = ", ".join(f'"{field}"' for field in SEARCH_FIELDS)
+        params = ", ".join(f":{field}" for field in SEARCH_FIELDS)
+        values = {field: getattr(movie, field) for field in SEARCH_FIELDS}
+        self.remove_movie(db, movie.id)
+        db.execute(
+            text(f"INSERT INTO {self.table}(rowid, {columns}) VALUES (:id, {params})"),
+            {"id": movie.id, **values},
+        )
+
+    def index_movies(self, db: Session, movies: List[models.Movie]):
+        # New movies only, there is nothing to remove first
+        columns = ", ".join(f'"{field}"' for field in SEARCH_FIELDS)
+        params = ", ".join(f":{field}" for field in SEARCH_FIELDS)
+        db.execute(
+            text(f"INSERT INTO {self.table}(rowid, {columns}) VALUES (:id, {params})"),
+            [{"id": movie.id, **{field: getattr(movie, field) for field in SEARCH_FIELDS}} for movie in movies],
+        )
+
+    def remove_movie(self, db: Session, movie_id: int):
+        db.execute(text(f"DELETE FROM {self.table} WHERE rowid = :id"), {"id": movie_id})
+
+    def search(self, db: Session, query: str, skip: int = 0, limit: int = 10) -> List[int]:
+        terms = tokenize(query)
+        if not terms:
+            return []
+        match = " ".join(f'"{term}"*' for term in terms)
+        weights = ", ".join(str(weight) for weight in SEARCH_FIELDS.values())
+        rows = db.execute(
+            text(
+                f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH :match "
+                f"ORDER BY bm25({self.table}, {weights}), rowid LIMIT :limit OFFSET :skip"
+            ),
+            {"match": match, "limit": limit, "skip": skip},
+        )
+        return [row[0] for row in rows]
+
+    def rebuild(self, db: Session):
+        conn = db.connection()
+        conn.execute(text(f"DROP TABLE IF EXISTS {self.table}"))
+        self._create(conn)
+        self._populate(conn)
+        db.commit()
+
+
+class InvertedIndexBackend(SearchBackend):
+    """
+    In-process inverted index, used with databases that have no FTS5.
+    Terms are kept sorted so that a query term is matched as a prefix of
+    the indexed terms with a binary search. The changes made in a session are
+    applied when it commits and dropped when it rolls back, those made without
+    a session at once. A lock guards the index from the threads writing and
+    searching at once.
+    """
+    name = "memory"
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, float]] = defaultdict(dict)
+        self._documents: Dict[int, Set[str]] = {}
+        self._terms: List[str] = []
+        self._lock = threading.RLock()
+
+    def setup(self, engine: Engine):
+        with Session(bind=engine) as db:
+            if engine.dialect.has_table(db.connection(), models.Movie.__tablename__):
+                self.rebuild(db)
+
+    @staticmethod
+    def _scores(movie: models.Movie) -> Dict[str, float]:
+        scores: Dict[str, float] = defaultdict(float)
+        for field, weight in SEARCH_FIELDS.items():
+            for term in tokenize(getattr(movie, field)):
+                scores[term] += weight
+        return scores
+
+    def _change(self, db: Optional[Session], change: tuple):
+        if db is None:
+            self.apply([change])
+            return
+        if "search_pending" not in db.info:
+            db.info["search_pending"] = []
+            event.listen(db, "after_commit", self._committed)
+            event.listen(db, "after_rollback", self._rolled_back)
+        # Part of the session's transaction, begun if it wasn't
+        db.connection()
+        db.info["search_pending"].append(change)
+
+    def _committed(self, db: Session):
+        changes, db.info["search_pending"] = db.info["search_pending"], []
+        self.apply(changes)
+
+    def _rolled_back(self, db: Session):
+        db.info["search_pending"] = []
+
+    def index_movie(self, db: Session, movie: models.Movie):
+        # Tokenized now, the movie is expired by the commit
+        self._change(db, (movie.id, self._scores(movie)))
+
+    def remove_movie(self, db: Session, movie_id: int):
+        self._change(db, (movie_id, None))
+
+    def apply(self, changes: List[tuple]):
+        """(movie_id, term scores or None to remove it) changes, in order"""
+        with self._lock:
+            for movie_id, scores in changes:
+                self._remove(movie_id)
+                if scores is not None:
+                    self._add(movie_id, scores)
+
+    def _add(self, movie_id: int, scores: Dict[str, float]):
+        for term, score in scores.items():
+            if term not in self._postings:
+                self._terms.insert(bisect_left(self._terms, term), term)
+            self._postings[term][movie_id] = score
+        self._documents[movie_id] = set(scores)
+
+    def _remove(self, movie_id: int):
+        for term in self._documents.pop(movie_id, ()):
+            postings = self._postings[term]
+            postings.pop(movie_id, None)
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect_left(self._terms, term)]
+
+    def _prefix_scores(self, prefix: str) -> Dict[int, float]:
+        scores: Dict[int, float] = defaultdict(float)
+        position = bisect_left(self._terms, prefix)
+        while position < len(self._terms) and self._terms[position].startswith(prefix):
+            for movie_id, score in self._postings[self._terms[position]].items():
+                scores[movie_id] += score
+            position += 1
+        return scores
+
+    def search(self, db: Session, query: str, skip: int = 0, limit: int = 10) -> List[int]:
+        terms = tokenize(query)
+        if not terms:
+            return []
+        ranking: Optional[Dict[int, float]] = None
+        with self._lock:
+            for term in terms:
+                scores = self._prefix_scores(term)
+                if ranking is None:
+                    ranking = scores
+                else:
+                    # Every term of the query has to match
+                    ranking = {movie_id: ranking[movie_id] + score for movie_id, score in scores.items() if movie_id in ranking}
+                if not ranking:
+                    return []
+        ordered = sorted(ranking.items(), key=lambda item: (-item[1], item[0]))
+        return [movie_id for movie_id, _ in ordered[skip:skip + limit]]
+
+    def rebuild(self, db: Session):
+        # Read before taking the lock, the searches go on meanwhile
+        changes = [(movie.id, self._scores(movie)) for movie in db.query(models.Movie).yield_per(1000)]
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._terms.clear()
+            self.apply(changes)
+
+
+BACKENDS = {
+    SQLiteFTSBackend.name: SQLiteFTSBackend,
+    InvertedIndexBackend.name: InvertedIndexBackend,
+}
+
+_backend: Optional[SearchBackend] = None
+
+
+def init_search(engine: Engine, backend_name: Optional[str] = None) -> SearchBackend:
+    """
+    Select the search backend (SEARCH_BACKEND=fts5|memory, SQLite defaults to fts5)
+    and make sure its index exists for the given engine.
+    """
+    global _backend
+    backend_name = backend_name or os.environ.get("SEARCH_BACKEND")
+    if not backend_name:
+        backend_name = SQLiteFTSBackend.name if engine.dialect.name == "sqlite" else InvertedIndexBackend.name
+    if backend_name not in BACKENDS:
+        raise ValueError(f"Unknown search backend {backend_name!r}, expected one of {sorted(BACKENDS)}")
+    _backend = BACKENDS[backend_name]()
+    _backend.setup(engine)
+    logger.info("Movie search is using the {} backend", backend_name)
+    return _backend
+
+
+def get_backend() -> SearchBackend:
+    if _backend is None:
+        from database import get_engine
+        return init_search(get_engine())
+    return _backend
+
+
+def movies_changed(*movie_ids: int):
+    """
+    After the commit of movies indexed in this process: the other workers of
+    serve.py read them again into their own in-process index
+    """
+    if isinstance(_backend, InvertedIndexBackend):
+        broadcast.publish("movies", movie_ids)
+
+
+def _reindex(movie_ids: List[int]):
+    from database import SessionLocal
+
+    backend = get_backend()
+    with SessionLocal() as db:
+        found = {movie.id: movie for movie in db.query(models.Movie).filter(models.Movie.id.in_(movie_ids))}
+        backend.apply([(movie_id, backend._scores(found[movie_id]) if movie_id in found else None) for movie_id in movie_ids])
+
+
+broadcast.subscribe("movies", _reindex)
@@ -0,0 +1,154 @@
+# serve.py
+"""
+Runs the API with a worker process per core:
+
+    python serve.py --workers 8 --port 8000 --max-requests 10000 --max-requests-jitter 1000
+
+The master process imports the app, applies the migrations once and binds the
+listening socket, then forks the workers, which all accept on that socket.
+Forked workers share the imported code and start in a fraction of the time of
+a new interpreter. Each worker has its own pools and caches and tells the
+others what its writes changed over broadcast.py, so that they drop what they
+cached (the response cache, the users, the in-process search index) and
+stream the new comments.
+
+A worker exits gracefully after --max-requests requests, plus up to
+--max-requests-jitter so they don't all restart together, and the master
+forks a new one in its place, as it does for a worker that died. SIGTERM or
+SIGINT stops the workers gracefully, a second one kills them.
+
+The rate limits are per worker with RATE_LIMIT_BACKEND=memory, set it to redis
+to share them. The write-behind queue and its read-your-writes wait are per
+worker too.
+"""
+import argparse
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from typing import Dict
+
+from loguru import logger
+
+# A worker that exits sooner than this after its start is failing, not recycled
+CRASH_SECONDS = 1.0
+STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+
+def serve(args) -> int:
+    own_dir = "BROADCAST_DIR" not in os.environ
+    if own_dir:
+        # Read by broadcast.py when the app is imported
+        os.environ["BROADCAST_DIR"] = tempfile.mkdtemp(prefix="movieapp-")
+    broadcast_dir = os.environ["BROADCAST_DIR"]
+
+    import uvicorn
+
+    import database, migrations
+
+    if migrations.DB_MIGRATE_ON_STARTUP:
+        migrations.upgrade()
+        # Once here, not in every worker
+        migrations.DB_MIGRATE_ON_STARTUP = False
+    # The workers open their own connections
+    database.dispose_engines()
+
+    config = uvicorn.Config(
+        "main:app", host=args.host, port=args.port, log_level=args.log_level,
+        limit_max_requests=args.max_requests or None, limit_max_requests_jitter=args.max_requests_jitter,
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+    config.load()
+    sock = config.bind_socket()
+    workers: Dict[int, float] = {}
+    stopping = False
+
+    def spawn():
+        # A stop signal waits until the new worker is in workers, so that it reaches it too
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        if stopping:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+            return
+        pid = os.fork()
+        if pid == 0:
+            for signum in STOP_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+            code = 1
+            try:
+                server = uvicorn.Server(config)
+                server.run(sockets=[sock])
+                code = 0 if server.started else 3
+            except BaseException:
+                logger.exception("Worker {} failed", os.getpid())
+            finally:
+                os._exit(code)
+        workers[pid] = time.monotonic()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        # The second signal doesn't wait for the requests in progress
+        forwarded = signal.SIGKILL if stopping else signal.SIGTERM
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, forwarded)
+            except ProcessLookupError:
+                pass
+
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, stop)
+    logger.info("Serving on {}:{} with {} workers", args.host, args.port, args.workers)
+    for _ in range(args.workers):
+        spawn()
+
+    try:
+        while workers:
+            try:
+                pid, wait_status = os.wait()
+            except ChildProcessError:
+                break
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+            try:
+                os.unlink(os.path.join(broadcast_dir, f"{pid}.sock"))
+            except FileNotFoundError:
+                pass
+            if stopping:
+                continue
+            code = os.waitstatus_to_exitcode(wait_status)
+            if code != 0 and time.monotonic() - started < CRASH_SECONDS:
+                logger.error("Worker {} failed at startup with {}, starting another one in {}s", pid, code, CRASH_SECONDS)
+                time.sleep(CRASH_SECONDS)
+            elif code != 0:
+                logger.warning("Worker {} exited with {}, starting another one", pid, code)
+            else:
+                logger.info("Worker {} recycled", pid)
+            if not stopping:
+                spawn()
+    finally:
+        sock.close()
+        if own_dir:
+            shutil.rmtree(broadcast_dir, ignore_errors=True)
+    logger.info("Stopped")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.environ.get("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--max-requests", type=int, default=int(os.environ.get("MAX_REQUESTS", 0)), help="requests of a worker before it is recycled, 0 never")
+    parser.add_argument("--max-requests-jitter", type=int, default=int(os.environ.get("MAX_REQUESTS_JITTER", 0)))
+    parser.add_argument("--graceful-timeout", type=int, default=30, help="seconds a stopping worker waits for its requests")
+    parser.add_argument("--log-level", default="info")
+    return serve(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
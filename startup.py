@@ -0,0 +1,118 @@
+# startup.py
+"""
+Startup and shutdown of the API, run by the lifespan of the app rather than at
+import: importing main (a test, a CLI, a worker before it serves) neither
+connects to the database nor opens the log file.
+
+At startup come the log sinks, the schema (see migrations.py), the search
+index and the leaderboard clock, then the background workers and the channel
+to the other workers of serve.py. With STARTUP_PREWARM=true the first
+requests don't pay for the cold caches either: STARTUP_PREWARM_CONNECTIONS
+connections of each pool are opened and the recommendation model is built
+before the app takes requests. The duration of each step is logged.
+"""
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict
+
+from loguru import logger
+
+import broadcast, comment_feed, database, leaderboard, logs, migrations, passwords, recommend, response_cache, search, write_behind
+from database import DB_POOL_SIZE, SessionLocal, get_engine, get_replica_engines
+
+
+STARTUP_PREWARM = os.environ.get("STARTUP_PREWARM", "false").lower() in ("1", "true", "yes")
+STARTUP_PREWARM_CONNECTIONS = int(os.environ.get("STARTUP_PREWARM_CONNECTIONS", DB_POOL_SIZE))
+
+# Milliseconds taken by each step of the last startup
+timings: Dict[str, float] = {}
+
+
+@contextmanager
+def _step(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round((time.perf_counter() - started) * 1000, 3)
+
+
+def init_database(bind=None):
+    """What the requests expect to find in the database"""
+    bind = bind if bind is not None else get_engine()
+    if migrations.DB_MIGRATE_ON_STARTUP:
+        migrations.upgrade(bind)
+    search.init_search(bind)
+    leaderboard.init(bind)
+
+
+def prewarm_pool(db_engine, connections: int = STARTUP_PREWARM_CONNECTIONS):
+    """Opens connections of the pool at once, they go back to it open"""
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(db_engine.connect())
+    finally:
+        for connection in opened:
+            connection.close()
+
+
+async def prewarm_async_pool(db_engine, connections: int = STARTUP_PREWARM_CONNECTIONS):
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(await db_engine.connect().start())
+    finally:
+        for connection in opened:
+            await connection.close()
+
+
+async def prewarm():
+    for db_engine in [get_engine(), *get_replica_engines()]:
+        prewarm_pool(db_engine)
+    if database.AsyncSessionLocal is not None:
+        for db_engine in [database.get_async_engine(), *database.get_async_replica_engines()]:
+            await prewarm_async_pool(db_engine)
+    recommend.model.refresh(full=True)
+    with SessionLocal() as db:
+        leaderboard.clock(db)
+
+
+async def startup():
+    timings.clear()
+    started = time.perf_counter()
+    logs.setup()
+    with _step("database"):
+        init_database()
+    if STARTUP_PREWARM:
+        with _step("prewarm"):
+            await prewarm()
+    recommend.start(build=not STARTUP_PREWARM)
+    leaderboard.start()
+    response_cache.start()
+    write_behind.start()
+    broadcast.start()
+    timings["total"] = round((time.perf_counter() - started) * 1000, 3)
+    logger.info("Started in {} ms {}", timings["total"], timings)
+
+
+def shutdown():
+    # Commits the queued writes while the rest still runs
+    write_behind.stop()
+    recommend.stop()
+    leaderboard.stop()
+    response_cache.stop()
+    comment_feed.broker.close()
+    broadcast.stop()
+    passwords.shutdown()
+    logs.flush()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await startup()
+    try:
+        yield
+    finally:
+        shutdown()
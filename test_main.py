@@ -1,10 +1,58 @@
+import asyncio
+import csv
+import io
 import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+# Never the database or the log file of the app, whatever the environment says
+HERE = os.path.dirname(os.path.abspath(__file__))
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(HERE, 'test_moviestore_db')}"
+os.environ["DB_REPLICA_URLS"] = ""
+os.environ["LOG_FILE"] = ""
+# Every test request comes from the same client, test_rate_limiting sets its own budgets
+os.environ.setdefault("RATE_LIMITS", "")
+
+import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from loguru import logger
+from sqlalchemy import event
 from sqlalchemy.orm import Session
-from main import app, get_db
-from database import SessionLocal, engine
+from main import app, get_db, get_read_db
+from database import SessionLocal, engine, get_async_url
 from models import Base, User, Movie, Rating, Comment
+import auth
 import crud
+import database
+import schemas
+import user_cache
+import passwords
+import models
+import search
+import response_cache
+import benchmark
+import bulk
+import fast_json
+import logs
+import profiling
+import recommend
+import leaderboard
+import catalog
+import migrations
+import comment_feed
+import write_behind
+import ratelimit
+import startup
+import broadcast
 
 # Create a test client using TestClient
 client = TestClient(app)
@@ -18,11 +66,13 @@ def override_get_db():
         db.close()
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
 
 
 # Set up and tear down for tests
 def setup_module(module):
     Base.metadata.create_all(bind=engine)
+    startup.init_database(engine)
 
 def teardown_module(module):
     Base.metadata.drop_all(bind=engine)
@@ -91,3 +141,984 @@ def test_rate_movie():
     
     assert rating_response ["stars"]== rating_data ["stars"]
     assert rating_response["movie_id"] == movie_id
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def assert_constant_queries(small_url, large_url):
+    """
+    Fails when serving large_url takes more queries than small_url, i.e. when
+    the query count of an endpoint grows with the size of its result
+    """
+    with count_queries() as small:
+        small_items = client.get(small_url).json()
+    with count_queries() as large:
+        large_items = client.get(large_url).json()
+    assert len(large_items) > len(small_items)
+    assert len(large) == len(small), f"{large_url} ran {len(large)} queries, {small_url} ran {len(small)}"
+
+
+def auth_headers(username="moviefan", password="moviefanpassword"):
+    client.post("/Registration", json={
+        "username": username,
+        "full_name": "Movie Fan",
+        "password": password,
+        "email": f"{username}@example.com",
+    })
+    response = client.post("/login", data={"username": username, "password": password})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def create_test_movie(headers, **fields):
+    movie = {"title": "Untitled", "cast": "Nobody", "year_released": 2000}
+    movie.update(fields)
+    response = client.post("/movies/", json=movie, headers=headers)
+    assert response.status_code == 201
+    return response.json()
+
+
+def test_search_movies():
+    headers = auth_headers()
+    heat = create_test_movie(headers, title="Heat", cast="Al Pacino, Robert De Niro", director="Michael Mann")
+    insider = create_test_movie(headers, title="The Insider", cast="Russell Crowe", director="Michael Mann")
+
+    # Case insensitive prefix match on any indexed column, title hits ranked first
+    response = client.get("/movies/Search", params={"search": "HEA"})
+    assert [movie["id"] for movie in response.json()] == [heat["id"]]
+    response = client.get("/movies/Search", params={"search": "mich man"})
+    assert {movie["id"] for movie in response.json()} == {heat["id"], insider["id"]}
+    response = client.get("/movies/Search", params={"search": "pacino"})
+    assert [movie["id"] for movie in response.json()] == [heat["id"]]
+
+    # The index follows updates and deletes
+    updated = dict(heat, title="Heat (1995)", cast="Val Kilmer")
+    client.put(f"/movies/{heat['id']}", json=updated, headers=headers)
+    assert client.get("/movies/Search", params={"search": "pacino"}).json() == []
+    assert [movie["id"] for movie in client.get("/movies/Search", params={"search": "kilmer"}).json()] == [heat["id"]]
+    client.delete(f"/movies/{heat['id']}", headers=headers)
+    assert client.get("/movies/Search", params={"search": "heat"}).json() == []
+
+
+def test_inverted_index_backend():
+    backend = search.InvertedIndexBackend()
+    backend.index_movie(None, Movie(id=1, title="Alien", cast="Sigourney Weaver", director="Ridley Scott"))
+    backend.index_movie(None, Movie(id=2, title="Blade Runner", cast="Harrison Ford", director="Ridley Scott"))
+    assert backend.search(None, "ridley") == [1, 2]
+    assert backend.search(None, "BLADE rid") == [2]
+    assert backend.search(None, "al") == [1]
+    backend.remove_movie(None, 1)
+    assert backend.search(None, "ridley") == [2]
+
+    # Within a session the changes wait for its commit, a rollback drops them
+    with SessionLocal() as db:
+        backend.index_movie(db, Movie(id=3, title="Gladiator", cast="Russell Crowe", director="Ridley Scott"))
+        assert backend.search(None, "gladiator") == []
+        db.rollback()
+        backend.remove_movie(db, 2)
+        db.commit()
+    assert backend.search(None, "ridley") == []
+
+
+def test_list_queries_do_not_grow_with_results():
+    owners = [auth_headers(f"owner{index}") for index in range(3)]
+    movies = [create_test_movie(headers, title=f"Owned {index}") for index, headers in enumerate(owners)]
+    assert_constant_queries("/movies/?limit=1", "/movies/?limit=10")
+
+    few, many = movies[0]["id"], movies[1]["id"]
+    client.post(f"/movies/{few}/rate/", json={"rating": 4}, headers=owners[0])
+    client.post(f"/movies/{few}/comments/", json={"comment": "Nice"}, headers=owners[0])
+    for headers in owners:
+        client.post(f"/movies/{many}/rate/", json={"rating": 3}, headers=headers)
+        client.post(f"/movies/{many}/comments/", json={"comment": "Seen it"}, headers=headers)
+    assert_constant_queries(f"/movies/{few}/ratings/", f"/movies/{many}/ratings/")
+    assert_constant_queries(f"/movies/{few}/comments/", f"/movies/{many}/comments/")
+
+
+def collect_pages(url, headers=None, limit=2):
+    items, cursor = [], None
+    while True:
+        params = {"limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get(url, params=params, headers=headers)
+        assert response.status_code == 200
+        assert len(response.json()) <= limit
+        items.extend(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return items
+
+
+def test_cursor_pagination():
+    headers = auth_headers("pager")
+    created = [create_test_movie(headers, title=f"Paged {index}")["id"] for index in range(5)]
+    assert [movie["id"] for movie in collect_pages("/movies/List", headers)] == created
+    catalog = [movie["id"] for movie in collect_pages("/movies/", limit=3)]
+    assert catalog[-5:] == created and len(catalog) == len(set(catalog))
+
+    for index in range(3):
+        client.post(f"/movies/{created[0]}/comments/", json={"comment": f"Comment {index}"}, headers=headers)
+    comments = collect_pages(f"/movies/{created[0]}/comments/")
+    assert [comment["comment"] for comment in comments] == ["Comment 0", "Comment 1", "Comment 2"]
+
+    assert client.get("/movies/", params={"cursor": "not-a-cursor"}).status_code == 400
+    assert client.get("/movies/", params={"limit": 1000}).status_code == 422
+
+
+def test_rating_aggregates():
+    raters = [auth_headers(f"rater{index}") for index in range(3)]
+    movie = create_test_movie(raters[0], title="Rated")
+    assert movie["rating_stats"] == {"count": 0, "sum": 0, "average": None, "histogram": [0, 0, 0, 0, 0, 0]}
+    for headers, stars in zip(raters, [4, 4.5, 2]):
+        assert client.post(f"/movies/{movie['id']}/rate/", json={"rating": stars}, headers=headers).status_code == 201
+
+    expected = {"count": 3, "sum": 10.5, "average": 3.5, "histogram": [0, 0, 1, 0, 2, 0]}
+    assert client.get(f"/movies/{movie['id']}").json()["rating_stats"] == expected
+
+    # The repair job recomputes a damaged or missing aggregate from the ratings table
+    db = SessionLocal()
+    try:
+        db.query(models.MovieRatingStats).filter(models.MovieRatingStats.movie_id == movie["id"]).delete()
+        db.query(models.MovieScore).filter(models.MovieScore.movie_id == movie["id"]).delete()
+        db.commit()
+        response_cache.sync(db)
+        crud.rebuild_rating_stats(db)
+        # The API processes see the stored generation move and drop their cached responses
+        assert response_cache.sync(db)
+        assert db.get(models.MovieScore, movie["id"]) is not None
+    finally:
+        db.close()
+    assert client.get(f"/movies/{movie['id']}").json()["rating_stats"] == expected
+
+
+def test_async_session_mode():
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    from sqlalchemy.pool import NullPool
+
+    # Every TestClient request runs on its own event loop, so connections are not pooled
+    async_engine = create_async_engine(get_async_url(str(engine.url)), poolclass=NullPool)
+    async_sessions = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_async_db():
+        async with async_sessions() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_async_db
+    app.dependency_overrides[get_read_db] = override_get_async_db
+    try:
+        headers = auth_headers("asyncuser")
+        movie = create_test_movie(headers, title="Awaited")
+        assert movie["owner"]["username"] == "asyncuser"
+        response = client.post(f"/movies/{movie['id']}/rate/", json={"rating": 5}, headers=headers)
+        assert response.json()["created_by"]["username"] == "asyncuser"
+        response = client.post(f"/movies/{movie['id']}/comments/", json={"comment": "Async"}, headers=headers)
+        assert response.json()["posted_by"]["username"] == "asyncuser"
+        assert client.get(f"/movies/{movie['id']}").json()["rating_stats"]["count"] == 1
+        assert [comment["comment"] for comment in client.get(f"/movies/{movie['id']}/comments/").json()] == ["Async"]
+        assert [found["id"] for found in client.get("/movies/Search", params={"search": "awaited"}).json()] == [movie["id"]]
+    finally:
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[get_read_db] = override_get_db
+
+
+def test_password_pool():
+    headers = auth_headers("hasher")
+    completed = passwords.stats()["completed"]
+    duplicate = {"username": "hasher", "full_name": "Hasher", "password": "secret", "email": "hasher@example.com"}
+    assert client.post("/Registration", json=duplicate).status_code == 400
+    # A rejected signup never reaches bcrypt
+    assert passwords.stats()["completed"] == completed
+
+    # A hash made with other cost parameters is replaced on the next login
+    db = SessionLocal()
+    try:
+        user = crud.get_user_by_username(db, "hasher")
+        old_hash = passwords.CryptContext(schemes=["bcrypt"]).hash("moviefanpassword", rounds=5)
+        crud.update_user_password(db, user_id=user.id, hashed_password=old_hash)
+        assert client.post("/login", data={"username": "hasher", "password": "moviefanpassword"}).status_code == 201
+        db.expire_all()
+        new_hash = crud.get_user_by_username(db, "hasher").hashed_password
+        assert new_hash != old_hash and passwords.pwd_context.verify("moviefanpassword", new_hash)
+        assert not passwords.pwd_context.needs_update(new_hash)
+    finally:
+        db.close()
+
+    # A saturated pool sheds the request instead of queueing it
+    max_pending = passwords.PASSWORD_MAX_PENDING
+    passwords.PASSWORD_MAX_PENDING = 0
+    try:
+        response = client.post("/login", data={"username": "hasher", "password": "moviefanpassword"})
+    finally:
+        passwords.PASSWORD_MAX_PENDING = max_pending
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(passwords.PASSWORD_RETRY_AFTER)
+    assert passwords.stats()["rejected"] >= 1
+
+
+class FakeRedis:
+    """Local stand-in for the redis client, enough for user_cache.RedisBackend"""
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.values) if key.startswith(pattern.rstrip("*"))]
+
+
+def user_lookups(statements):
+    return [statement for statement in statements if "FROM users" in statement]
+
+
+def test_authenticated_user_cache():
+    headers = auth_headers("cached")
+    user_cache.get_backend().clear()
+    with count_queries() as first:
+        assert client.get("/movies/List", headers=headers).status_code == 200
+    with count_queries() as second:
+        assert client.get("/movies/List", headers=headers).status_code == 200
+    # The token carries the user id: one primary key lookup, then none at all
+    assert len(user_lookups(first)) == 1 and "users.id = ?" in user_lookups(first)[0]
+    assert user_lookups(second) == []
+
+    # Changing the user drops the cached entry
+    db = SessionLocal()
+    try:
+        user = crud.get_user_by_username(db, "cached")
+        crud.update_user_password(db, user_id=user.id, hashed_password=user.hashed_password)
+    finally:
+        db.close()
+    with count_queries() as third:
+        client.get("/movies/List", headers=headers)
+    assert len(user_lookups(third)) == 1
+
+    # Tokens issued before the user id was embedded still resolve
+    legacy = auth.create_access_token(data={"sub": "cached"})
+    assert client.get("/movies/List", headers={"Authorization": f"Bearer {legacy}"}).status_code == 200
+    assert user_cache.stats()["hits"] >= 2
+
+
+def test_shared_user_cache_backend():
+    backend = user_cache.RedisBackend(client=FakeRedis())
+    user = schemas.CurrentUser(id=7, username="shared", full_name=None, email="shared@example.com")
+    backend.set("shared", user, ttl=60)
+    assert backend.get("shared") == user
+    backend.delete("shared")
+    assert backend.get("shared") is None
+
+
+def test_conditional_get_and_response_cache():
+    headers = auth_headers("etagger")
+    movie = create_test_movie(headers, title="Cached")
+    url = f"/movies/{movie['id']}"
+    first = client.get(url)
+    etag = first.headers["ETag"]
+
+    # A matching ETag and a cached body are both served without a query
+    with count_queries() as statements:
+        assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+        cached = client.get(url)
+    assert statements == []
+    assert cached.content == first.content and cached.headers["ETag"] == etag
+
+    # Writes bump the versions the ETag is made of
+    client.post(f"{url}/rate/", json={"rating": 5}, headers=headers)
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert response.json()["rating_stats"]["count"] == 1
+    comments = client.get(f"{url}/comments/")
+    client.post(f"{url}/comments/", json={"comment": "Fresh"}, headers=headers)
+    assert client.get(f"{url}/comments/", headers={"If-None-Match": comments.headers["ETag"]}).json()[0]["comment"] == "Fresh"
+
+
+def test_response_cache_size_eviction():
+    cache = response_cache.ResponseCache(max_bytes=10)
+    cache.put("a", b"12345", {})
+    cache.put("b", b"12345", {})
+    assert cache.get("a") is not None
+    cache.put("c", b"123", {})
+    # "b" is the least recently used body
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["bytes"] == 8 and cache.stats()["evictions"] == 1
+
+
+def test_response_cache_max_age():
+    cache = response_cache.ResponseCache(max_age=0.05)
+    etag = cache.etag(["a"], "")
+    cache.put(etag, b"body", {})
+    assert cache.etag(["a"], "") == etag and cache.get(etag) is not None
+    time.sleep(0.1)
+    # Even without a bump the old body and ETag go
+    assert cache.etag(["a"], "") != etag and cache.get(etag) is None
+
+
+def test_response_cache_epoch_per_fork():
+    cache = response_cache.cache
+    before = cache.etag([response_cache.movie(3)], "/movies/3?")
+    cache.bump(response_cache.movie(3))
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # A worker forked later recomputes the ETag of its own versions
+        os.write(write, cache.etag([response_cache.movie(3)], "/movies/3?").encode())
+        os._exit(0)
+    os.close(write)
+    child = os.read(read, 100).decode()
+    os.close(read)
+    os.waitpid(pid, 0)
+    assert child not in (before, cache.etag([response_cache.movie(3)], "/movies/3?"))
+
+
+def test_response_cache_replica_lag():
+    cache = response_cache.ResponseCache(replica_lag=0.05)
+    assert not cache.settling(["a"])
+    cache.bump("a")
+    # A replica may not have the write yet
+    assert cache.settling(["a", "b"]) and not cache.settling(["b"])
+    time.sleep(0.1)
+    assert not cache.settling(["a"]) and cache.stats()["uncached"] == 1
+
+
+def test_database_configuration(monkeypatch):
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == database.DB_SQLITE_BUSY_TIMEOUT_MS
+
+    monkeypatch.setattr(database, "DB_STATEMENT_TIMEOUT_MS", 2500)
+    options = database.engine_options("postgresql://movies@db/movies")
+    assert options["pool_size"] == database.DB_POOL_SIZE and options["pool_pre_ping"] is database.DB_POOL_PRE_PING
+    assert options["connect_args"] == {"options": "-c statement_timeout=2500"}
+    options = database.engine_options(database.get_async_url("postgresql://movies@db/movies"))
+    assert options["connect_args"] == {"server_settings": {"statement_timeout": "2500"}}
+    assert "pool_size" not in database.engine_options("sqlite:///./movies")
+
+
+def test_benchmark_summary_and_baseline():
+    stats = benchmark.summarize([0.001 * n for n in range(1, 101)], errors=1, elapsed=2.0)
+    assert stats["requests"] == 100 and stats["errors"] == 1 and stats["throughput_rps"] == 50.0
+    assert stats["latency_ms"]["p50"] == 51.0 and stats["latency_ms"]["p99"] == 99.0 and stats["latency_ms"]["max"] == 100.0
+    baseline = {"routes": {"GET /": stats, "GET /movies/": stats}}
+    slower = dict(stats, latency_ms=dict(stats["latency_ms"], p99=150.0), throughput_rps=30.0)
+    results = {"routes": {"GET /": stats, "GET /movies/": slower, "POST /movies/": slower}}
+    regressions = benchmark.compare(results, baseline, tolerance=0.2)
+    assert len(regressions) == 2 and all(line.startswith("GET /movies/:") for line in regressions)
+    assert benchmark.compare(results, baseline, tolerance=1.0) == []
+
+
+def test_bulk_import_and_export(monkeypatch):
+    monkeypatch.setattr(bulk, "BULK_CHUNK_SIZE", 2)
+    headers = auth_headers("importer", "importerpassword")
+    ndjson = "\n".join([
+        json.dumps({"title": "Bulk One", "cast": "A", "year_released": 1990}),
+        "",
+        "{not json",
+        json.dumps({"title": "Bulk Two", "cast": "B"}),
+        json.dumps({"title": "Bulk Three", "cast": "C", "year_released": 1993, "director": "Zed"}),
+        json.dumps({"title": "Bulk Four", "cast": "D", "year_released": 1994}),
+    ])
+    response = client.post("/movies/bulk", content=ndjson, headers={**headers, "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 201
+    report = response.json()
+    assert report["created"] == 3 and report["failed"] == 2
+    assert [error["row"] for error in report["errors"]] == [3, 4]
+    assert report["errors"][1]["errors"][0]["loc"] == ["year_released"]
+
+    body = 'title,cast,year_released,description\nBulk Five,E,1995,"two\nlines"\nBulk Six,F,oops,\nBulk Seven,G\n'
+    response = client.post("/movies/bulk", content=body, headers={**headers, "Content-Type": "text/csv"})
+    report = response.json()
+    assert report["created"] == 1 and [error["row"] for error in report["errors"]] == [2, 3]
+    assert client.post("/movies/bulk", content="x", headers={**headers, "Content-Type": "text/plain"}).status_code == 415
+
+    # A chunk that can't be written is reported as failed rows, the other chunks are kept
+    create_movies = crud.create_movies
+
+    def failing_create_movies(db, movies, user_id):
+        if any(movie.title == "Bulk Broken" for movie in movies):
+            raise RuntimeError("boom")
+        return create_movies(db, movies, user_id)
+
+    monkeypatch.setattr(crud, "create_movies", failing_create_movies)
+    body = "title,cast,year_released\nBulk Kept,H,1996\nBulk Broken,I,1997\nBulk Lost,J,1998\nBulk Later,K,1999\n"
+    report = client.post("/movies/bulk", content=body, headers={**headers, "Content-Type": "text/csv"}).json()
+    assert report["created"] == 2 and [error["row"] for error in report["errors"]] == [1, 2]
+    monkeypatch.setattr(crud, "create_movies", create_movies)
+
+    # Imported movies are searchable and have their rating aggregate
+    found = client.get("/movies/Search", params={"search": "zed"}).json()
+    assert [movie["title"] for movie in found] == ["Bulk Three"]
+    assert found[0]["rating_stats"]["count"] == 0
+
+    response = client.get("/movies/export")
+    assert response.status_code == 200 and response.headers["content-type"].startswith("application/x-ndjson")
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [movie["id"] for movie in exported] == sorted(movie["id"] for movie in exported)
+    five = next(movie for movie in exported if movie["title"] == "Bulk Five")
+    assert five["description"] == "two\nlines" and five["year_released"] == 1995
+    response = client.get("/movies/export", params={"format": "csv"})
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == len(exported) and rows[0]["id"] == str(exported[0]["id"])
+
+
+def test_log_sampling_per_route(monkeypatch):
+    lines = []
+    handler_id = logger.add(lambda message: lines.append(message.record), level="INFO", filter=logs.sample_filter)
+    try:
+        monkeypatch.setattr(logs, "LOG_ROUTE_SAMPLE_RATES", {"GET /movies/": 0.0, "GET /movies/{movie_id}": 0.0})
+        client.get("/movies/", params={"limit": 7})
+        client.get("/movies/987654")
+        assert [record["message"] for record in lines] == ["Movie not found with id: 987654"]
+        assert lines[0]["extra"]["route"] == "GET /movies/{movie_id}"
+
+        lines.clear()
+        monkeypatch.setattr(logs, "LOG_ROUTE_SAMPLE_RATES", {})
+        client.get("/movies/", params={"limit": 8})
+        assert [record["message"] for record in lines] == ["Fetching list of movies"]
+        assert lines[0]["extra"] == {"route": "GET /movies/", "sampled": True}
+    finally:
+        logger.remove(handler_id)
+    assert logs.parse_sample_rates("GET /movies/{movie_id}=0.5, GET /=0") == {"GET /movies/{movie_id}": 0.5, "GET /": 0.0}
+
+
+def test_metrics():
+    headers = auth_headers()
+    movie = create_test_movie(headers, title="Metered")
+    client.get(f"/movies/{movie['id']}/comments/", params={"limit": 3})
+    client.get("/movies/987654")
+    body = client.get("/metrics").text
+    samples = {}
+    for line in body.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+    route = 'method="GET",route="/movies/{movie_id}/comments/"'
+    assert samples[f'http_requests_total{{{route},status="200"}}'] >= 1
+    assert samples['http_requests_total{method="GET",route="/movies/{movie_id}",status="404"}'] >= 1
+    assert samples[f'http_request_duration_seconds_bucket{{{route},le="+Inf"}}'] == samples[f"http_request_duration_seconds_count{{{route}}}"]
+    # The movie lookup and the comments page, no lazy loads
+    assert samples[f"http_request_db_queries_sum{{{route}}}"] >= 2
+    assert samples[f"http_request_db_duration_seconds_sum{{{route}}}"] > 0
+    assert samples[f"http_requests_in_flight{{{route}}}"] == 0
+    assert samples['db_queries_total{outcome="ok"}'] > 0
+    assert samples['db_pool_checkout_wait_seconds_count{pool="primary"}'] > 0
+    assert samples["password_pool_completed_total"] >= 1
+    assert "response_cache_misses_total" in samples and "user_cache_hits_total" in samples
+
+
+def test_request_profiling(monkeypatch):
+    headers = auth_headers()
+    movie = create_test_movie(headers, title="Profiled")
+    assert client.get("/profiling", headers={"X-Profile-Token": "secret"}).status_code == 404
+    response = client.get(f"/movies/{movie['id']}/comments/", headers={"X-Profile": "secret"})
+    assert "X-Profile-Id" not in response.headers
+
+    monkeypatch.setattr(profiling, "PROFILE_TOKEN", "secret")
+    token = {"X-Profile-Token": "secret"}
+    assert client.get("/profiling", headers={"X-Profile-Token": "wrong"}).status_code == 403
+    response = client.get(f"/movies/{movie['id']}/comments/", params={"limit": 4}, headers={"X-Profile": "secret"})
+    assert response.status_code == 200
+    report = client.get(f"/profiling/{response.headers['X-Profile-Id']}", headers=token).json()
+    assert report["route"] == "GET /movies/{movie_id}/comments/" and report["status_code"] == 200
+    assert len(report["statements"]) >= 2 and all(statement["duration"] >= 0 for statement in report["statements"])
+    assert any("get_comment_rows" in frame for statement in report["statements"] for frame in statement["stack"])
+    collapsed = client.get(f"/profiling/{report['id']}/collapsed", headers=token).text
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed.splitlines())
+
+    # Armed routes profile their next requests without the header
+    assert client.post("/profiling", json={"route": "GET /movies/{movie_id}", "count": 1}, headers=token).status_code == 200
+    assert "X-Profile-Id" in client.get(f"/movies/{movie['id']}").headers
+    assert "X-Profile-Id" not in client.get(f"/movies/{movie['id']}").headers
+    assert [profile["route"] for profile in client.get("/profiling", headers=token).json()[:2]] == ["GET /movies/{movie_id}", "GET /movies/{movie_id}/comments/"]
+
+
+def test_single_statement_writes():
+    headers = auth_headers()
+    other = auth_headers("otherfan", "otherfanpassword")
+    movie = create_test_movie(headers, title="Contested")
+    client.get("/movies/List", headers=other)  # caches the authenticated user
+
+    with count_queries() as statements:
+        response = client.post(f"/movies/{movie['id']}/rate/", json={"rating": 4}, headers=other)
+    assert response.status_code == 201 and response.json()["created_by"]["username"] == "otherfan"
+    # The INSERT ... SELECT of the rating, the update of the aggregate and the upsert of the leaderboard scores
+    assert len(statements) == 3
+    assert client.post(f"/movies/{movie['id']}/rate/", json={"rating": 2}, headers=other).status_code == 409
+    assert client.post("/movies/987654/rate/", json={"rating": 2}, headers=other).status_code == 404
+    assert client.get(f"/movies/{movie['id']}").json()["rating_stats"]["count"] == 1
+
+    with count_queries() as statements:
+        comment = client.post(f"/movies/{movie['id']}/comments/", json={"comment": "Mine"}, headers=other)
+    # The comment and the upsert of the leaderboard scores
+    assert comment.status_code == 201 and comment.json()["posted_by"]["username"] == "otherfan" and len(statements) == 2
+    assert client.post("/movies/987654/comments/", json={"comment": "Lost"}, headers=other).status_code == 404
+    assert client.delete(f"/comments/{comment.json()['id']}", headers=headers).status_code == 403
+    with count_queries() as statements:
+        assert client.delete(f"/comments/{comment.json()['id']}", headers=other).status_code == 204
+    assert len(statements) == 1
+    assert client.delete(f"/comments/{comment.json()['id']}", headers=other).status_code == 404
+
+    # A rated movie can't be deleted, and keeps its aggregate
+    assert client.delete(f"/movies/{movie['id']}", headers=other).status_code == 403
+    assert client.delete(f"/movies/{movie['id']}", headers=headers).status_code == 400
+    assert client.get(f"/movies/{movie['id']}").json()["rating_stats"]["count"] == 1
+    assert client.put(f"/movies/{movie['id']}", json={"title": "Mine now", "cast": "X", "year_released": 2001}, headers=other).status_code == 403
+    assert client.put(f"/movies/{movie['id']}", json={"title": "Renamed", "cast": "X", "year_released": 2001}, headers=headers).json()["title"] == "Renamed"
+    unrated = create_test_movie(headers, title="Unrated")
+    assert client.delete(f"/movies/{unrated['id']}", headers=headers).status_code == 204
+    assert client.get(f"/movies/{unrated['id']}").status_code == 404
+    assert client.delete(f"/movies/{unrated['id']}", headers=headers).status_code == 404
+
+    response = client.post("/Registration", json={"username": "newname", "full_name": "N", "password": "pw", "email": "otherfan@example.com"})
+    assert response.status_code == 400 and response.json()["detail"] == "Email already registered"
+    # A duplicate that got past the check is refused by the unique constraint
+    with SessionLocal() as db:
+        with pytest.raises(HTTPException) as error:
+            crud.create_user(db, schemas.UserCreate(username="otherfan", full_name="O", email="new@example.com", password="pw"), hashed_password="x")
+    assert error.value.detail == "Username already registered"
+
+
+def test_fast_json_matches_pydantic():
+    from pydantic import TypeAdapter
+
+    headers = auth_headers("fastjson")
+    movie = create_test_movie(headers, title="Serialized", description="Quotes \" and ünïcode", Runtime="2h")
+    client.post(f"/movies/{movie['id']}/rate/", json={"rating": 3}, headers=headers)
+    client.post(f"/movies/{movie['id']}/comments/", json={"comment": "Fast"}, headers=headers)
+    with SessionLocal() as db:
+        cases = [
+            (schemas.Movie, benchmark.load_objects(db, "movies"), crud.get_movie_rows(db, limit=100), fast_json.movies),
+            (schemas.Rating, benchmark.load_objects(db, "ratings", movie["id"]), crud.get_rating_rows(db, movie["id"]), fast_json.ratings),
+            (schemas.Comment, benchmark.load_objects(db, "comments", movie["id"]), crud.get_comment_rows(db, movie["id"]), fast_json.comments),
+        ]
+        for schema, objects, rows, dump in cases:
+            adapter = TypeAdapter(List[schema])
+            assert rows and json.loads(dump(rows)) == json.loads(adapter.dump_json(adapter.validate_python(objects, from_attributes=True)))
+        # The movie columns are found by name, whatever their order
+        row = crud.get_movie_rows(db, limit=1)[0]
+        expected = fast_json.movie(row)
+        try:
+            fast_json.bind_movie_row(crud.MOVIE_ROW[::-1])
+            assert fast_json.movie(tuple(row)[::-1]) == expected
+            with pytest.raises(ValueError):
+                fast_json.bind_movie_row(crud.MOVIE_ROW[1:])
+        finally:
+            fast_json.bind_movie_row(crud.MOVIE_ROW)
+    assert client.get("/movies/List", headers=headers).json() == [client.get(f"/movies/{movie['id']}").json()]
+
+
+def test_recommendations():
+    fans = [auth_headers(f"fan{index}") for index in range(4)]
+    alike, also, unlike = (create_test_movie(fans[0], title=title)["id"] for title in ("Alike", "Also alike", "Unlike"))
+    for headers, ratings in zip(fans, [(5, 5, 1), (1, 1, 5), (5, 5, None), (5, None, None)]):
+        for movie_id, stars in zip((alike, also, unlike), ratings):
+            if stars is not None:
+                client.post(f"/movies/{movie_id}/rate/", json={"rating": stars}, headers=headers)
+    recommend.model.refresh(full=True)
+
+    similar = client.get(f"/movies/{alike}/similar").json()
+    assert [movie["id"] for movie in similar] == [also] and 0 < similar[0]["score"] <= 1
+    assert client.get("/movies/987654/similar").status_code == 404
+    recommended = client.get("/users/me/recommendations", headers=fans[3]).json()
+    assert [movie["id"] for movie in recommended] == [also] and recommended[0]["title"] == "Also alike"
+
+    # A refresh only reads the new ratings and updates the lists they touch
+    client.post(f"/movies/{unlike}/rate/", json={"rating": 5}, headers=fans[3])
+    assert recommend.model.refresh() == 1
+    assert recommend.model.similar(unlike) == []
+    assert unlike not in [movie["id"] for movie in client.get("/users/me/recommendations", headers=fans[3]).json()]
+
+
+def test_leaderboards(monkeypatch):
+    headers = [auth_headers(f"critic{index}") for index in range(3)]
+    classic = create_test_movie(headers[0], title="Classic", genres="Drama, Crime", year_released=1972)["id"]
+    fresh = create_test_movie(headers[0], title="Fresh", genres="Comedy", year_released=2024)["id"]
+    once = create_test_movie(headers[0], title="Rated once", genres="Drama", year_released=2024)["id"]
+    for index, user in enumerate(headers):
+        client.post(f"/movies/{classic}/rate/", json={"rating": 5}, headers=user)
+        client.post(f"/movies/{fresh}/rate/", json={"rating": 3}, headers=user)
+        client.post(f"/movies/{fresh}/comments/", json={"comment": f"Talk {index}"}, headers=user)
+    client.post(f"/movies/{once}/rate/", json={"rating": 5}, headers=headers[0])
+
+    def ids(url, **params):
+        return [movie["id"] for movie in client.get(url, params=params).json() if movie["id"] in (classic, fresh, once)]
+
+    # A single 5 star rating is pulled towards the prior, below three of them
+    assert ids("/movies/top", limit=100) == [classic, once, fresh]
+    assert ids("/movies/top", genre="drama", limit=100) == [classic, once]
+    assert ids("/movies/top", year=2024, limit=100) == [once, fresh]
+    trending = client.get("/movies/trending", params={"limit": 100}).json()
+    assert [movie["id"] for movie in trending if movie["id"] in (classic, fresh, once)] == [fresh, classic, once]
+    assert trending[[movie["id"] for movie in trending].index(fresh)]["score"] == pytest.approx(4.5, rel=0.01)
+
+    # The compaction moves the epoch to a day later: the scores halve and keep their order
+    with SessionLocal() as db:
+        generation, epoch = leaderboard.clock(db, reload=True)
+    monkeypatch.setattr(leaderboard.time, "time", lambda: epoch + 24 * 3600)
+    with SessionLocal() as db:
+        assert leaderboard.compact(db)
+        assert leaderboard.clock(db) == (generation + 1, epoch + 24 * 3600)
+    trending = client.get("/movies/trending", params={"limit": 100}).json()
+    assert [movie["id"] for movie in trending if movie["id"] in (classic, fresh, once)] == [fresh, classic, once]
+    assert trending[[movie["id"] for movie in trending].index(fresh)]["score"] == pytest.approx(2.25, rel=0.01)
+    # A worker still on the old generation retries with the new one
+    monkeypatch.setattr(leaderboard, "_clock", (generation, epoch))
+    client.post(f"/movies/{once}/comments/", json={"comment": "Late"}, headers=headers[1])
+    assert leaderboard.clock(None)[0] == generation + 1
+    assert ids("/movies/trending", limit=100) == [fresh, classic, once]
+
+
+def test_batch_get():
+    headers = auth_headers("watcher")
+    first, second = (create_test_movie(headers, title=title)["id"] for title in ("Watch first", "Watch second"))
+    for index in range(3):
+        client.post(f"/movies/{second}/comments/", json={"comment": f"Note {index}"}, headers=headers)
+    client.post(f"/movies/{second}/rate/", json={"rating": 4}, headers=headers)
+
+    with count_queries() as statements:
+        response = client.post("/movies/batch-get", json={"ids": [second, 987654, first, second]})
+    assert response.status_code == 200 and len(statements) == 1
+    assert [movie["id"] for movie in response.json()["movies"]] == [second, first]
+    assert response.json()["missing"] == [987654]
+    assert "owner" not in response.json()["movies"][0]
+
+    body = {"ids": [first, second], "include": ["owner", "rating_stats", "latest_comments"], "comments_per_movie": 2}
+    with count_queries() as statements:
+        movies = client.post("/movies/batch-get", json=body).json()["movies"]
+    # One query for the movies and one per include
+    assert len(statements) == 4
+    assert movies[0]["latest_comments"] == [] and movies[0]["rating_stats"]["count"] == 0
+    assert movies[1]["owner"]["username"] == "watcher" and movies[1]["rating_stats"]["average"] == 4
+    assert [comment["comment"] for comment in movies[1]["latest_comments"]] == ["Note 2", "Note 1"]
+    assert movies[1]["latest_comments"][0]["posted_by"]["username"] == "watcher"
+
+    assert client.post("/movies/batch-get", json={"ids": list(range(schemas.BATCH_MAX_IDS + 1))}).status_code == 422
+    assert client.post("/movies/batch-get", json={"ids": [first], "include": ["ratings"]}).status_code == 422
+
+
+def test_filter_and_sort_movies():
+    headers = auth_headers("curator")
+    noir = dict(genres="Neo-Noir, Crime", language="Klingon", director="Ana Obscura")
+    short = create_test_movie(headers, title="Short", cast="Ida Lane, Bo Kim", Runtime="1h 25m", year_released=1990, **noir)["id"]
+    long = create_test_movie(headers, title="Long", cast="Bo Kim", Runtime="2hr.40mins", year_released=2010, **noir)["id"]
+    other = create_test_movie(headers, title="Other", cast="Ida Lane", genres="neo-noir", Runtime="100", year_released=2000, language="klingon ")["id"]
+    client.post(f"/movies/{short}/rate/", json={"rating": 5}, headers=headers)
+
+    def ids(**params):
+        response = client.get("/movies/", params={"genre": "NEO-NOIR", "limit": 100, **params})
+        assert response.status_code == 200
+        return [movie["id"] for movie in response.json()]
+
+    assert ids() == [short, long, other]
+    assert ids(cast="bo  kim") == [short, long]
+    assert ids(language="KLINGON", director="ana obscura") == [short, long]
+    assert ids(year_from=2000, year_to=2010) == [long, other]
+    assert ids(runtime_min=90, runtime_max=160) == [long, other]
+    assert ids(sort="-created") == [other, long, short]
+    assert ids(sort="-year") == [long, other, short]
+    # The single 5 star rating lifts its movie above the unrated ones at the prior
+    assert ids(sort="-rating") == [short, other, long]
+    assert client.get("/movies/", params={"sort": "title"}).status_code == 422
+
+    # Sorted pages follow each other through the cursor
+    first = client.get("/movies/", params={"genre": "neo-noir", "sort": "-year", "limit": 2})
+    assert [movie["id"] for movie in first.json()] == [long, other]
+    second = client.get("/movies/", params={"genre": "neo-noir", "sort": "-year", "limit": 2, "cursor": first.headers["X-Next-Cursor"]})
+    assert [movie["id"] for movie in second.json()] == [short]
+
+    # Movies added before the year was required sort as the oldest, and pages go past them
+    undated = create_test_movie(headers, title="Undated", cast="Ida Lane", genres="Neo-Noir", year_released=1980)["id"]
+    with SessionLocal() as db:
+        db.query(models.Movie).filter(models.Movie.id == undated).update({"year_released": None})
+        db.commit()
+    for sort, expected in (("year", [undated, short, other, long]), ("-year", [long, other, short, undated])):
+        pages, cursor = [], None
+        while True:
+            response = client.get("/movies/", params={"genre": "neo-noir", "sort": sort, "limit": 1, **({"cursor": cursor} if cursor else {})})
+            assert response.status_code == 200
+            pages += [movie["id"] for movie in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        assert pages == expected
+    client.delete(f"/movies/{undated}", headers=headers)
+
+    # Editing a movie replaces its genre rows
+    update = {"title": "Other", "cast": "Ida Lane", "genres": "Western", "year_released": 2000}
+    client.put(f"/movies/{other}", json=update, headers=headers)
+    assert ids() == [short, long]
+
+    assert [catalog.parse_runtime(value) for value in ("2hr.15mins", "2h 15m", "135 min", "1:45", "90", "1.5 hours", "n/a", None)] == [135, 135, 135, 105, 90, 90, None, None]
+
+    # Rows written before the catalog columns existed are filled in by the backfill
+    with SessionLocal() as db:
+        legacy = models.Movie(title="Legacy", cast="Old Timer", genres="Neo-Noir", Runtime="95 min", year_released=1950, owner_id=1)
+        db.add(legacy)
+        db.commit()
+        legacy_id = legacy.id
+        assert catalog.backfill(db) >= 1
+        assert db.get(models.Movie, legacy_id).runtime_minutes == 95
+    response_cache.bump(response_cache.MOVIES)
+    assert ids(cast="old timer") == [legacy_id]
+    assert not migrations.upgrade(engine)
+
+
+def test_comment_polling_and_stream(monkeypatch):
+    headers = auth_headers("chatter")
+    movie_id = create_test_movie(headers, title="Talked about")["id"]
+    url = f"/movies/{movie_id}/comments/"
+    for index in range(3):
+        client.post(url, json={"comment": f"Old {index}"}, headers=headers)
+
+    # Polling from the last cursor of a page returns only the newer comments
+    page = client.get(url)
+    assert [comment["comment"] for comment in page.json()] == ["Old 0", "Old 1", "Old 2"]
+    tail = page.headers["X-Last-Cursor"]
+    assert client.get(url, params={"cursor": tail}).json() == []
+    client.post(url, json={"comment": "New"}, headers=headers)
+    assert [comment["comment"] for comment in client.get(url, params={"cursor": tail}).json()] == ["New"]
+    since = page.json()[-1]["time_created"]
+    assert [comment["comment"] for comment in client.get(url, params={"since": since}).json()] == ["New"]
+
+    # The stream first replays what was missed since the last event id, then pushes the new comments
+    streamed = {}
+    follow = threading.Thread(target=lambda: streamed.update(response=client.get(f"{url}stream", headers={"Last-Event-ID": tail})))
+    follow.start()
+    for _ in range(200):
+        if comment_feed.broker.listening(movie_id):
+            break
+        time.sleep(0.01)
+    client.post(url, json={"comment": "Live"}, headers=headers)
+    comment_feed.broker.close()
+    follow.join(10)
+    response = streamed["response"]
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [chunk.split("\n") for chunk in response.text.split("\n\n") if chunk.startswith("id:")]
+    assert [json.loads(lines[2][len("data: "):])["comment"] for lines in events] == ["New", "Live"]
+    assert json.loads(events[1][2][len("data: "):])["posted_by"]["username"] == "chatter"
+    # Event ids are cursors of the comment list
+    assert client.get(url, params={"cursor": events[0][0][len("id: "):]}).json()[0]["comment"] == "Live"
+    assert not comment_feed.broker.listening(movie_id)
+    assert client.get("/movies/987654/comments/stream").status_code == 404
+
+    # Past the replay limit the stream ends, and goes on from its last event on reconnection
+    monkeypatch.setattr(comment_feed, "COMMENT_FEED_MAX_REPLAY", 1)
+    response = client.get(f"{url}stream", headers={"Last-Event-ID": tail})
+    events = [chunk.split("\n") for chunk in response.text.split("\n\n") if chunk.startswith("id:")]
+    assert [json.loads(lines[2][len("data: "):])["comment"] for lines in events] == ["New"]
+    assert not comment_feed.broker.listening(movie_id)
+
+    # A follower that can't keep up is reset instead of buffering without bound
+    async def overflow():
+        broker = comment_feed.Broker(queue_size=1)
+        follower = broker.follow(movie_id)
+        for comment_id in (1, 2, 3):
+            follower.offer((comment_id, b"event"))
+        return [chunk async for chunk in broker.stream(follower)]
+
+    assert asyncio.run(overflow()) == [comment_feed.RESET]
+
+
+def test_write_behind(monkeypatch):
+    headers = [auth_headers(f"live{index}") for index in range(3)]
+    movie_id = create_test_movie(headers[0], title="Live event")["id"]
+    # Large enough to take the six writes below in one batch
+    writer = write_behind.WriteBehind(batch_size=6, max_delay_ms=5000)
+    writer.start()
+    monkeypatch.setattr(write_behind, "writer", writer)
+    try:
+        writes = [client.post(f"/movies/{movie_id}/rate/", json={"rating": 4 + index % 2}, headers=user) for index, user in enumerate(headers)]
+        writes.append(client.post(f"/movies/{movie_id}/rate/", json={"rating": 1}, headers=headers[0]))
+        writes.append(client.post("/movies/987654/rate/", json={"rating": 1}, headers=headers[1]))
+        writes.append(client.post(f"/movies/{movie_id}/comments/", json={"comment": "Queued"}, headers=headers[2]))
+        assert [response.status_code for response in writes] == [202] * 6
+        assert client.post(f"/movies/{movie_id}/rate/", json={"rating": 9}, headers=headers[0]).status_code == 406
+
+        # The author's next read waits for the batch with their writes
+        comments = client.get(f"/movies/{movie_id}/comments/", headers=headers[2]).json()
+        assert [comment["comment"] for comment in comments] == ["Queued"]
+        assert writer.stats()["batches"] == 1 and writer.stats()["committed"] == 4
+
+        def status(index, user):
+            return client.get(f"/writes/{writes[index].json()['id']}", headers=user).json()
+
+        assert status(0, headers[0])["rating"]["rating"] == 4 and status(0, headers[0])["rating"]["created_by"]["username"] == "live0"
+        assert status(3, headers[0])["status_code"] == 409
+        assert status(4, headers[1])["status_code"] == 404
+        assert status(5, headers[2])["comment"]["posted_by"]["username"] == "live2"
+        assert client.get(f"/writes/{writes[0].json()['id']}", headers=headers[1]).status_code == 404
+        # The aggregates were updated once for the three ratings
+        movie = client.get(f"/movies/{movie_id}").json()
+        assert movie["rating_stats"]["count"] == 3 and movie["rating_stats"]["histogram"][4:] == [2, 1]
+    finally:
+        writer.stop()
+
+
+def test_write_behind_one_write_fails(monkeypatch):
+    def create_rating(*args):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(crud, "create_rating", create_rating)
+    user = schemas.CurrentUser(id=1, username="someone", email="someone@example.com")
+    error = write_behind.WriteBehind()._write_one(write_behind.Write(write_behind.RATING, 1, user, {"rating": 3}))
+    assert error.status_code == 500
+
+
+def test_rate_limiting(monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMITS", ratelimit.parse_budgets("GET /movies/Search=2/60, *=100/1"))
+    ratelimit.set_backend(ratelimit.MemoryBackend())
+    try:
+        searches = [client.get("/movies/Search", params={"search": "budget"}) for _ in range(3)]
+        assert [response.status_code for response in searches] == [200, 200, 429]
+        assert searches[0].headers["X-RateLimit-Remaining"] == "1"
+        assert searches[2].headers["Retry-After"] == "30"
+        # Users are limited on their own, and the other routes have their own budget
+        headers = auth_headers("budgeted")
+        assert client.get("/movies/Search", params={"search": "budget"}, headers=headers).status_code == 200
+        assert client.get("/").headers["X-RateLimit-Limit"] == "100"
+    finally:
+        ratelimit.set_backend(None)
+
+    # A token's key is kept only until the token expires
+    authorization = headers["Authorization"]
+    key = ratelimit._token_key(authorization)
+    assert key.startswith("user:") and ratelimit._token_keys[authorization][1] < time.time() + 24 * 3600
+    ratelimit._token_keys[authorization] = ("user:stale", time.time() - 1)
+    assert ratelimit._token_key(authorization) == key
+    assert ratelimit._token_key("Bearer not-a-token") is None
+
+    # Without a free slot the requests are shed after waiting in line, the metrics stay readable
+    monkeypatch.setattr(ratelimit, "admission", ratelimit.Admission(limit=0, timeout=0.01))
+    response = client.get("/")
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    assert client.get("/metrics").status_code == 200
+    assert "rate_limit_shed_total 1" in client.get("/metrics").text
+
+    async def admit():
+        gate = ratelimit.Admission(limit=1, timeout=0.01)
+        first, second = await gate.acquire(), await gate.acquire()
+        gate.release()
+        return first, second, await gate.acquire()
+
+    assert asyncio.run(admit()) == (True, False, True)
+
+
+def test_startup_runs_in_the_lifespan(tmp_path):
+    # Importing the app neither builds an engine, creates the database nor opens the log file
+    url = f"sqlite:///{tmp_path / 'startup_db'}"
+    probe = "import database, main; print(len(database._engines))"
+    result = subprocess.run(
+        [sys.executable, "-c", probe], env=dict(os.environ, DB_URL=url, LOG_FILE=str(tmp_path / "startup.log")),
+        capture_output=True, text=True, cwd=HERE,
+    )
+    assert result.stdout.strip() == "0" and not list(tmp_path.iterdir())
+
+    # The migrations create the schema of an empty database, a second run has nothing to do
+    from sqlalchemy import create_engine, inspect
+    startup_engine = create_engine(url)
+    migrations.upgrade(startup_engine)
+    assert {"movies", "movie_genres", "leaderboard_clock"} <= set(inspect(startup_engine).get_table_names())
+    assert not migrations.upgrade(startup_engine)
+
+    startup.prewarm_pool(startup_engine, 3)
+    assert startup_engine.pool.checkedin() == 3
+    startup_engine.dispose()
+
+    builds = recommend.model.stats()["builds"]
+    asyncio.run(startup.prewarm())
+    assert recommend.model.stats()["builds"] == builds + 1
+
+
+def test_health_and_readiness():
+    assert client.get("/health").json() == {"status": "ok", "pid": os.getpid()}
+    assert client.get("/ready").status_code == 200
+
+    from sqlalchemy import create_engine
+    unreachable = create_engine(f"sqlite:///{os.devnull}/missing/db")
+
+    def unreachable_db():
+        with Session(bind=unreachable) as db:
+            yield db
+
+    app.dependency_overrides[get_db] = unreachable_db
+    try:
+        assert client.get("/ready").status_code == 503
+    finally:
+        app.dependency_overrides[get_db] = override_get_db
+
+
+def test_broadcast_between_workers(tmp_path):
+    received = []
+    arrived = threading.Event()
+    broadcast.subscribe("test", lambda payload: (received.append(payload), arrived.set()))
+    first, second = broadcast.Channel(str(tmp_path), "first"), broadcast.Channel(str(tmp_path), "second")
+    try:
+        first.publish("test", {"movie_id": 1})
+        assert arrived.wait(5) and received == [{"movie_id": 1}]
+        assert first.stats()["sent"] == 1 and first.stats()["peers"] == 1
+
+        # A write in another worker bumps the response cache of this one
+        etag = response_cache.cache.etag([response_cache.movie(1)], "/movies/1")
+        first.publish("bump", [response_cache.movie(1)])
+        deadline = time.monotonic() + 5
+        while response_cache.cache.etag([response_cache.movie(1)], "/movies/1") == etag:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        first.close()
+        second.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_serve_recycles_workers(tmp_path):
+    import urllib.request
+    port = benchmark._free_port()
+    server = subprocess.Popen(
+        [sys.executable, "serve.py", "--workers", "2", "--port", str(port), "--max-requests", "2", "--log-level", "warning"],
+        env=dict(os.environ, DB_URL=f"sqlite:///{tmp_path / 'serve_db'}"), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=HERE,
+    )
+
+    def get(path):
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=10) as response:
+            return json.loads(response.read())
+
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                get("/ready")
+                break
+            except OSError:
+                assert time.monotonic() < deadline and server.poll() is None
+                time.sleep(0.2)
+        pids = set()
+        for _ in range(12):
+            try:
+                pids.add(get("/health")["pid"])
+            except OSError:
+                # The connection of a worker that was stopping
+                pass
+            time.sleep(0.2)
+        # Served by more processes than there are workers: they were replaced
+        assert len(pids) > 2
+    finally:
+        server.terminate()
+    assert server.wait(30) == 0
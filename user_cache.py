@@ -0,0 +1,143 @@
+# user_cache.py
+"""
+Cache of the users resolved from access tokens, so an authenticated request
+doesn't pay a users lookup. Entries are keyed by the token subject and never
+outlive the token they were resolved from.
+USER_CACHE_BACKEND=memory (default) keeps a per-process TTL/LRU cache,
+USER_CACHE_BACKEND=redis shares it between processes through REDIS_URL.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from loguru import logger
+
+import broadcast, schemas
+
+
+USER_CACHE_BACKEND = os.environ.get("USER_CACHE_BACKEND", "memory")
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+# Upper bound of the lifetime of an entry in seconds, 0 disables the cache
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 300))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+
+class MemoryBackend:
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[schemas.CurrentUser]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, key: str, user: schemas.CurrentUser, ttl: float):
+        with self._lock:
+            self._entries[key] = (user, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    prefix = "movieapp:user:"
+
+    def __init__(self, client=None):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(REDIS_URL)
+        self.client = client
+
+    def get(self, key: str) -> Optional[schemas.CurrentUser]:
+        value = self.client.get(self.prefix + key)
+        return schemas.CurrentUser.model_validate_json(value) if value is not None else None
+
+    def set(self, key: str, user: schemas.CurrentUser, ttl: float):
+        self.client.setex(self.prefix + key, max(int(ttl), 1), user.model_dump_json())
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+BACKENDS = {"memory": MemoryBackend, "redis": RedisBackend}
+
+if USER_CACHE_BACKEND not in BACKENDS:
+    raise ValueError(f"USER_CACHE_BACKEND must be one of {sorted(BACKENDS)}, not {USER_CACHE_BACKEND!r}")
+
+_backend = None
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[USER_CACHE_BACKEND]()
+        logger.info("Authenticated users are cached in the {} backend", USER_CACHE_BACKEND)
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def _count(counter: str):
+    with _lock:
+        _stats[counter] += 1
+
+
+def get(subject: str) -> Optional[schemas.CurrentUser]:
+    if USER_CACHE_TTL <= 0:
+        return None
+    user = get_backend().get(subject)
+    _count("hits" if user is not None else "misses")
+    return user
+
+
+def put(subject: str, user: schemas.CurrentUser, token_expires_at: Optional[float] = None):
+    ttl = USER_CACHE_TTL
+    if token_expires_at is not None:
+        ttl = min(ttl, token_expires_at - time.time())
+    if ttl > 0:
+        get_backend().set(subject, user, ttl)
+
+
+def invalidate(subject: str):
+    get_backend().delete(subject)
+    _count("invalidations")
+    # Each worker of serve.py has its own memory cache
+    if USER_CACHE_BACKEND == "memory":
+        broadcast.publish("user", subject)
+
+
+broadcast.subscribe("user", lambda subject: get_backend().delete(subject))
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, backend=USER_CACHE_BACKEND)
@@ -0,0 +1,234 @@
+# write_behind.py
+"""
+Optional write-behind mode of the rating and comment endpoints, on with
+WRITE_BEHIND=true. A validated write is queued and answered at once with 202
+and the id of the write. A worker thread takes the queued writes in batches of
+up to WRITE_BEHIND_BATCH_SIZE, waiting at most WRITE_BEHIND_MAX_DELAY_MS for a
+batch to fill, and commits each batch in one transaction with
+crud.write_batch, which updates the rating aggregates, the leaderboard scores
+and the caches once per movie. A batch that fails as a whole is retried write
+by write. GET /writes/{write_id} tells how a write ended.
+
+The GET requests of an author with queued writes wait for them to be
+committed first (read_your_writes), so they always see their own writes.
+
+The queue lives in the process: the writes still queued when it dies are lost,
+and the read-your-writes wait and the write statuses only cover the writes
+taken by the same worker.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from typing import Optional
+
+from fastapi import HTTPException, Request, status
+from loguru import logger
+
+import auth, crud, schemas
+from database import SessionLocal
+
+
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 500))
+WRITE_BEHIND_MAX_DELAY_MS = float(os.environ.get("WRITE_BEHIND_MAX_DELAY_MS", 20))
+# Writes waiting for a batch, beyond that the endpoints answer 503
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get("WRITE_BEHIND_QUEUE_SIZE", 10000))
+# Statuses of the finished writes kept for GET /writes/{write_id}
+WRITE_BEHIND_RESULTS = int(os.environ.get("WRITE_BEHIND_RESULTS", 10000))
+# Longest wait of a read for the writes of its author
+WRITE_BEHIND_READ_WAIT_SECONDS = float(os.environ.get("WRITE_BEHIND_READ_WAIT_SECONDS", 5))
+
+RATING, COMMENT = "rating", "comment"
+
+
+class Write:
+    __slots__ = ("id", "kind", "movie_id", "user", "values", "done")
+
+    def __init__(self, kind: str, movie_id: int, user: schemas.CurrentUser, values: dict):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.movie_id = movie_id
+        self.user = user
+        self.values = dict(values, movie_id=movie_id, user_id=user.id)
+        self.done: Future = Future()
+
+
+class WriteBehind:
+    def __init__(
+        self, batch_size: int = WRITE_BEHIND_BATCH_SIZE, max_delay_ms: float = WRITE_BEHIND_MAX_DELAY_MS,
+        queue_size: int = WRITE_BEHIND_QUEUE_SIZE, results: int = WRITE_BEHIND_RESULTS,
+    ):
+        self.batch_size = batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.max_results = results
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        # Queued writes per author, and the statuses by write id with their author
+        self._pending: "defaultdict[str, set]" = defaultdict(set)
+        self._results: "OrderedDict[str, tuple]" = OrderedDict()
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.committed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        """Commits what is queued and stops the worker"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, kind: str, movie_id: int, user: schemas.CurrentUser, values: dict) -> str:
+        write = Write(kind, movie_id, user, values)
+        # Known as pending before the worker can see it
+        with self._lock:
+            self._pending[user.username].add(write.done)
+            self._set_status(write, {"id": write.id, "kind": kind, "status": "queued"})
+        try:
+            self._queue.put_nowait(write)
+        except queue.Full:
+            self._forget(write)
+            with self._lock:
+                self._results.pop(write.id, None)
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many writes queued, please try again", headers={"Retry-After": "1"},
+            )
+        return write.id
+
+    def pending(self, username: str) -> list:
+        with self._lock:
+            return list(self._pending.get(username, ()))
+
+    def has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def status(self, write_id: str, username: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._results.get(write_id)
+        return entry[1] if entry is not None and entry[0] == username else None
+
+    def _set_status(self, write: Write, value: dict):
+        self._results[write.id] = (write.user.username, value)
+        self._results.move_to_end(write.id)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    def _forget(self, write: Write):
+        with self._lock:
+            futures = self._pending.get(write.user.username)
+            if futures is not None:
+                futures.discard(write.done)
+                if not futures:
+                    del self._pending[write.user.username]
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            write = self._queue.get()
+            if write is None:
+                break
+            batch = [write]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    write = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if write is None:
+                    stopping = True
+                    break
+                batch.append(write)
+            try:
+                self._commit(batch)
+            except Exception:
+                logger.exception("Write-behind batch of {} writes failed", len(batch))
+                for write in batch:
+                    self._finish(write, HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="The write failed"))
+
+    def _commit(self, batch: list):
+        ratings = [write for write in batch if write.kind == RATING]
+        comments = [write for write in batch if write.kind == COMMENT]
+        try:
+            with SessionLocal() as db:
+                results = crud.write_batch(
+                    db, [write.values for write in ratings], [write.values for write in comments],
+                    authors={write.user.id: write.user for write in comments},
+                )
+        except Exception:
+            logger.opt(exception=True).warning("Write-behind batch of {} writes failed, writing them one by one", len(batch))
+            results = ([self._write_one(write) for write in ratings], [self._write_one(write) for write in comments])
+        self.batches += 1
+        for writes, rows in zip((ratings, comments), results):
+            for write, row in zip(writes, rows):
+                self._finish(write, row)
+
+    def _write_one(self, write: Write):
+        try:
+            with SessionLocal() as db:
+                if write.kind == RATING:
+                    return crud.create_rating(db, schemas.RatingCreate(rating=write.values["rating"]), write.movie_id, write.user.id)
+                return crud.create_comment(db, schemas.CommentCreate(comment=write.values["comment"]), write.movie_id, write.user.id, author=write.user)
+        except HTTPException as error:
+            return error
+        except Exception:
+            # Fails this write alone, the others of the batch may be committed already
+            logger.exception("Write-behind {} {} failed", write.kind, write.id)
+            return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="The write failed")
+
+    def _finish(self, write: Write, row):
+        if isinstance(row, HTTPException):
+            self.failed += 1
+            value = {"id": write.id, "kind": write.kind, "status": "failed", "status_code": row.status_code, "detail": row.detail}
+        else:
+            self.committed += 1
+            author = "created_by" if write.kind == RATING else "posted_by"
+            value = {"id": write.id, "kind": write.kind, "status": "committed", write.kind: {**row._mapping, author: write.user}}
+        with self._lock:
+            self._set_status(write, value)
+        self._forget(write)
+        write.done.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(), "batches": self.batches, "committed": self.committed,
+            "failed": self.failed, "rejected": self.rejected,
+        }
+
+
+# The queue of this process, None unless WRITE_BEHIND is on
+writer: Optional[WriteBehind] = None
+
+
+def start():
+    global writer
+    if WRITE_BEHIND and writer is None:
+        writer = WriteBehind()
+        writer.start()
+
+
+def stop():
+    global writer
+    if writer is not None:
+        writer.stop()
+        writer = None
+
+
+async def read_your_writes(request: Request):
+    """Dependency of the app: holds a GET of an author with queued writes until they are committed"""
+    if writer is None or not writer.has_pending() or request.method != "GET":
+        return
+    username = auth.token_username(request.headers.get("authorization"))
+    pending = writer.pending(username) if username else []
+    if pending:
+        await asyncio.wait([asyncio.wrap_future(done) for done in pending], timeout=WRITE_BEHIND_READ_WAIT_SECONDS)